@@ -1,17 +1,34 @@
+import hmac
 import os
-import sqlite3
-from flask import Flask, flash, redirect, render_template, request, session, g, url_for,  jsonify, make_response
+import re
+import shutil
+from flask import Blueprint, Flask, current_app, flash, redirect, render_template, request, session, g, url_for,  jsonify, make_response, send_file, abort
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
 from flask_session import Session
-from werkzeug.security import check_password_hash, generate_password_hash
 import random
-from time import time as nowtime
-from io import BytesIO
-from werkzeug.datastructures import FileStorage
+from time import perf_counter
 import traceback
-
+from functools import partial
+
+import authz
+import cache
+import db
+import ingest
+import jobs
+import metrics
+import migrations
+import passwords
+import pipeline
+import quota
+import scratch
+import search_index
+import session_store
+import sweeper
+import uploads
 import video_helper
+from db import get_db
 from helpers import login_required, allowed_file
-from tomp4 import convert_to_mp4, video_size_save
 
 UPLOAD_FOLDER = 'static/uploads/vid/'
 SIZE_ALLOWED = 2 * 1024 * 1024 * 1024
@@ -23,87 +40,174 @@ ALLOWED_EXTENSIONS = [
         'rmvb', 'asf', 'dat', 'wmv', 'mpg'
     ]
 
-# Preverimo ali mapa za nalaganje datotek že obstaja, če ne jo ustvarimo
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-
-# Configure application
-app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['TEMP_FOLDER'] = 'static/uploads/tmp/'
-
-# Create database if it doesn't exist
-if not os.path.exists(DATABASE):
-    print("Creating database...")
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL UNIQUE,
-            hash TEXT NOT NULL,
-            size INTEGER
-        );
-    ''')
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS groups (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            description TEXT,
-            creator_id INTEGER NOT NULL,
-            created_at INTEGER NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            public BOOLEAN NOT NULL DEFAULT FALSE,
-            hash TEXT DEFAULT NULL,
-            FOREIGN KEY (creator_id) REFERENCES users (id)
-        )
-    ''')
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS group_members (
-            group_id INTEGER,
-            user_id INTEGER,
-            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            role TEXT DEFAULT "member",
-            PRIMARY KEY (group_id, user_id),
-            FOREIGN KEY (group_id) REFERENCES groups (id),
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS videos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            filepath TEXT NOT NULL,
-            user_id INTEGER NOT NULL,
-            image_path TEXT,
-            filetype TEXT NOT NULL,
-            description TEXT,
-            group_id INTEGER,
-            time INTEGER,
-            file_size INTEGER DEFAULT 0,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
-
-@app.after_request
+TEMP_FOLDER = 'static/uploads/tmp/'
+# hls.js for the players, an exact version served from static/ (`python danceshare.py vendor`)
+HLS_JS_VERSION = '1.5.20'
+HLS_JS = f'vendor/hls-{HLS_JS_VERSION}.min.js'
+HLS_JS_LICENSE = f'vendor/hls-{HLS_JS_VERSION}.LICENSE'
+# Number of videos converted at the same time (defaults to the available cores)
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', jobs.default_workers()))
+# Werkzeug method for password hashes, older hashes are upgraded at login (see passwords.py)
+PASSWORD_METHOD = os.environ.get('PASSWORD_METHOD', passwords.METHOD)
+# Processes hashing passwords (scrypt is slow on purpose)
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', max(1, jobs.default_workers() // 2)))
+# Where sessions are kept: "sqlite" (default) in the database, "memory" in
+# this process only or "filesystem" with Flask-Session (see session_store.py)
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'sqlite')
+
+# All pages, registered on the application by create_app()
+bp = Blueprint('main', __name__)
+
+# The objects below belong to one process, every web worker has its own
+
+# Rendered /search and /browse-groups-api results (see cache.py for invalidation)
+result_cache = cache.ResultCache(max_bytes=int(os.environ.get('RESULT_CACHE_BYTES', 16 * 1024 * 1024)),
+                                 ttl=int(os.environ.get('RESULT_CACHE_TTL', 60)))
+
+# Passwords are hashed and checked in worker processes
+password_hasher = passwords.PasswordHasher(PASSWORD_METHOD, PASSWORD_WORKERS)
+# Brute force protection: failed password attempts per IP address and per account or group,
+# counted in the database for all web workers
+ip_throttle = passwords.Throttle('ip', limit=30, window=5 * 60)
+account_throttle = passwords.Throttle('account', limit=10, window=15 * 60)
+
+def password_attempt(key=None):
+    """
+    Check whether this IP address (and key, an account or group) may try a password.
+
+    Returns:
+        int: seconds the client has to wait (answer 429), 0 if it may go on
+    """
+    con = get_db()
+    return max(ip_throttle.retry_after(con, request.remote_addr), account_throttle.retry_after(con, key) if key else 0)
+
+def password_failed(key):
+    """Count a wrong password from this IP address for key"""
+    con = get_db()
+    ip_throttle.hit(con, request.remote_addr)
+    account_throttle.hit(con, key)
+
+# Memberships and created groups per user (see authz.py)
+authz_cache = authz.AuthzCache(ttl=int(os.environ.get('AUTHZ_CACHE_TTL', 30)))
+
+def permissions():
+    """Permissions of the logged in user, usually without a query"""
+    return authz_cache.get(get_db(), session["user_id"])
+
+# Videos are converted in background worker processes. Web processes only
+# add jobs, the queue is run by start_background() (danceshare.py worker).
+transcode_queue = jobs.JobQueue(DATABASE, partial(ingest.process_upload, DATABASE, UPLOAD_FOLDER, SIZE_ALLOWED),
+                                max_workers=TRANSCODE_WORKERS)
+
+
+def create_app():
+    """Create the web application (python app.py, danceshare.py serve)"""
+    # Preverimo ali mapa za nalaganje datotek že obstaja, če ne jo ustvarimo
+    if not os.path.exists(UPLOAD_FOLDER):
+        os.makedirs(UPLOAD_FOLDER)
+
+    # Configure application
+    app = Flask(__name__)
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['DATABASE'] = DATABASE
+    app.config['TEMP_FOLDER'] = TEMP_FOLDER
+    # Convert uploads while they come in (see pipeline.py)
+    app.config['TRANSCODE_PIPELINE'] = os.environ.get('TRANSCODE_PIPELINE', '1') == '1'
+    # FFmpeg processes converting uploads while they come in, over all web workers
+    app.config['PIPELINE_MAX'] = int(os.environ.get('PIPELINE_MAX', pipeline.MAX_PIPELINES))
+    # Bytes uploads in progress and their conversions may use in TEMP_FOLDER (see scratch.py)
+    app.config['TEMP_BUDGET'] = int(os.environ.get('TEMP_BUDGET', scratch.TEMP_BUDGET))
+    # Size of the chunks uploads are sent in
+    app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_SIZE', uploads.CHUNK_SIZE))
+    # Let the web server (nginx, ...) send media files with X-Sendfile
+    app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '') == '1'
+    # Without hls.js browsers other than Safari play the mp4
+    app.config['HLS_JS'] = HLS_JS if os.path.exists(os.path.join(app.static_folder, HLS_JS)) else None
+    if app.config['HLS_JS'] is None:
+        print(f"static/{HLS_JS} is missing (python danceshare.py vendor), videos are played from mp4 (Safari uses HLS)")
+    # Reverse proxies (nginx, ...) in front of the app, their X-Forwarded-* headers are trusted
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+    if app.config['TRUSTED_PROXIES']:
+        # remote_addr (password throttling) is the client, not the proxy
+        proxies = app.config['TRUSTED_PROXIES']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)
+
+    # Create database if it doesn't exist, upgrade its schema if it is older
+    migrations.migrate(DATABASE)
+
+    # Connections are pooled and handed out per request (db.get_db())
+    db.init_app(app)
+
+    # Configure session to be kept on the server (instead of signed cookies)
+    app.config["SESSION_PERMANENT"] = False
+    if SESSION_BACKEND == "filesystem":
+        app.config["SESSION_TYPE"] = "filesystem"
+        Session(app)
+    elif SESSION_BACKEND == "memory":
+        session_backend = session_store.MemorySessionStore()
+        app.session_interface = session_store.ServerSessionInterface(session_backend)
+        session_store.start_cleanup(session_backend)
+    else:
+        # expired sessions are deleted by start_background()
+        app.session_interface = session_store.ServerSessionInterface(session_store.SqliteSessionStore(DATABASE, db.get_db))
+
+    app.register_blueprint(bp)
+    password_hasher.start()
+    metrics.start_flusher()
+    return app
+
+
+def start_background():
+    """Run the transcode queue and the maintenance threads in this process"""
+    migrations.migrate(DATABASE)
+    transcode_queue.start()
+    quota.start_reconciler(DATABASE)
+    sweeper.start_sweeper(DATABASE, UPLOAD_FOLDER)
+    scratch.start_janitor(DATABASE, TEMP_FOLDER)
+    metrics.start_flusher()
+    if SESSION_BACKEND == "sqlite":
+        session_store.start_cleanup(session_store.SqliteSessionStore(DATABASE, None))
+
+# How long browsers keep media files, they never change once uploaded
+MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+MEDIA_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.webp': 'image/webp',
+}
+
+@bp.before_app_request
+def before_request():
+    """Uploaded files are only served through /media, which checks access"""
+    g.request_start = perf_counter()
+    if request.path.startswith('/static/uploads/'):
+        abort(404)
+
+@bp.after_app_request
+def record_request(response):
+    """Count the request and its time for /metrics"""
+    start = g.get('request_start')
+    if start is not None:
+        endpoint = request.endpoint or 'none'
+        metrics.REQUEST_SECONDS.observe(perf_counter() - start, endpoint, request.method)
+        metrics.REQUESTS.inc(endpoint, request.method, str(response.status_code))
+    return response
+
+@bp.after_app_request
 def after_request(response):
     """Ensure responses aren't cached"""
+    if request.endpoint == "main.media":
+        return response
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Expires"] = 0
     response.headers["Pragma"] = "no-cache"
     return response
 
-@app.route("/", methods=["GET", "POST"])
+@bp.route("/", methods=["GET", "POST"])
 @login_required
 def index():
     # conect to db
-    con = sqlite3.connect(DATABASE)
+    con = get_db()
     cur = con.cursor()
 
     # get videos from user
@@ -111,103 +215,201 @@ def index():
     videos = cur.fetchall()
     num_videos = len(videos)
 
-    # get groups
     # get groups from user
-    cur.execute("""
-        SELECT g.id, g.name 
-        FROM group_members gm 
-        JOIN groups g ON gm.group_id = g.id 
-        WHERE gm.user_id = ?
-    """, (session["user_id"],))
-    groups = cur.fetchall()
-    con.close()
+    groups = permissions().group_list()
 
     return render_template("index.html", username=session["user_id"] , num_videos=num_videos, videos=videos, groups=groups)
 
-@app.route("/search", methods=["GET"])
+# Videos returned per /search request, more are loaded while scrolling
+SEARCH_PAGE_SIZE = 24
+
+def find_videos(cur, user_id, q, group_id=None, cursor=None, limit=SEARCH_PAGE_SIZE):
+    """
+    One page of the videos in the user's groups matching q.
+
+    Without q the newest videos come first, with q the best matches
+    (exact matches, fuzzy ones only if there are none). Pages are keyset
+    based: cursor is the next_cursor of the previous page.
+
+    Returns:
+        tuple: (videos, next_cursor), next_cursor is None on the last page
+    """
+    where = []
+    params = {"user_id": user_id, "limit": limit + 1}
+    group_filter = ""
+    if group_id is not None:
+        group_filter = " AND v.group_id = :group_id"
+        params["group_id"] = group_id
+
+    queries = search_index.match_queries(q, "videos")
+    if not queries:
+        if cursor is not None:
+            where.append("v.id < :after_id")
+            params["after_id"] = int(cursor)
+        cur.execute(f"""
+            SELECT v.filepath, v.name, v.id, g.name
+            FROM group_members gm
+            JOIN videos v ON v.group_id = gm.group_id
+            JOIN groups g ON g.id = v.group_id
+            WHERE gm.user_id = :user_id{group_filter}{''.join(' AND ' + w for w in where)}
+            ORDER BY v.id DESC
+            LIMIT :limit
+        """, params)
+        videos = cur.fetchall()
+        next_cursor = str(videos[limit - 1][2]) if len(videos) > limit else None
+        return videos[:limit], next_cursor
+
+    # cursor of a search: which query (exact / fuzzy), rank and id of the last video
+    modes = range(len(queries))
+    if cursor is not None:
+        mode, after_rank, after_id = cursor.split(":")
+        modes = [int(mode)]
+        where.append("(score > :after_rank OR (score = :after_rank AND id > :after_id))")
+        params["after_rank"] = float(after_rank)
+        params["after_id"] = int(after_id)
+
+    videos = []
+    for mode in modes:
+        fts_table, match = queries[mode]
+        params["match"] = match
+        cur.execute(f"""
+            SELECT filepath, name, id, group_name, score FROM (
+                SELECT v.filepath, v.name, v.id, g.name AS group_name, {search_index.rank(fts_table)} AS score
+                FROM {fts_table}
+                JOIN videos v ON v.id = {fts_table}.rowid
+                JOIN group_members gm ON gm.group_id = v.group_id AND gm.user_id = :user_id
+                JOIN groups g ON g.id = v.group_id
+                WHERE {fts_table} MATCH :match{group_filter}
+            )
+            {'WHERE ' + ' AND '.join(where) if where else ''}
+            ORDER BY score, id
+            LIMIT :limit
+        """, params)
+        videos = cur.fetchall()
+        if videos:
+            break
+
+    next_cursor = None
+    if len(videos) > limit:
+        last = videos[limit - 1]
+        next_cursor = f"{mode}:{last[4]!r}:{last[2]}"
+    return [video[:4] for video in videos[:limit]], next_cursor
+
+@bp.route("/search", methods=["GET"])
 @login_required
 def search():
     q = request.args.get("q")
     group = request.args.get("group")
+    cursor = request.args.get("cursor") or None
     # conect to db
-    con = sqlite3.connect(DATABASE)
+    con = get_db()
     cur = con.cursor()
-    # gets groups in vitch is user
-    cur.execute("""
-        SELECT g.id 
-        FROM group_members gm 
-        JOIN groups g ON gm.group_id = g.id 
-        WHERE gm.user_id = ?
-    """, (session["user_id"],))
-    groupsUserIsIn = cur.fetchall()
-    # get videos from user
-    if group == "All":
-        videos = []
-        for g in groupsUserIsIn:
-            cur.execute("SELECT filepath, videos.name, videos.id, groups.name FROM videos JOIN groups ON videos.group_id = groups.id WHERE videos.group_id = :group AND videos.name LIKE :q" ,{"group": g[0], "q": f"%{q}%"})
-            videos += cur.fetchall()
-            print(f"videos: {videos}")
-    else:
-        cur.execute("SELECT filepath, videos.name, videos.id, groups.name FROM videos JOIN groups ON videos.group_id = groups.id WHERE videos.group_id = :group AND videos.name LIKE :q AND videos.group_id = :group" ,{"group": group, "q": f"%{q}%", "group": group})
-        videos = cur.fetchall()
 
-    # get groups
-    # get groups from user
-    cur.execute("""
-        SELECT g.id, g.name
-        FROM group_members gm 
-        JOIN groups g ON gm.group_id = g.id 
-        WHERE gm.user_id = ?
-    """, (session["user_id"],))
-    groups = cur.fetchall()
-    con.close()
-    
-    return render_template("search.html", videos=videos)
+    try:
+        group_id = None if group == "All" else int(group)
+    except (TypeError, ValueError):
+        return "Invalid group", 400
 
-@app.route("/delete_account/<int:user_id>", methods=["POST", "GET"])
+    # the key changes whenever the user's memberships or one of the groups change
+    if group_id is None:
+        group_ids = list(permissions().groups)
+    else:
+        group_ids = [group_id]
+    key = ("search", session["user_id"], q, group_id, cursor, tuple(group_ids),
+           cache.versions(cur, [("user", session["user_id"])] + [("group", g) for g in group_ids]))
+    page = result_cache.get(key)
+    if page is not None:
+        return page
+
+    # one query over all groups the user is in (or the selected one)
+    try:
+        videos, next_cursor = find_videos(cur, session["user_id"], q, group_id, cursor)
+    except (ValueError, IndexError):
+        return "Invalid cursor", 400
+
+    page = render_template("search.html", videos=videos, next_cursor=next_cursor, first_page=cursor is None,
+                           thumbnail_widths=video_helper.THUMBNAIL_WIDTHS)
+    result_cache.set(key, page)
+    return page
+
+@bp.route("/media/<int:video_id>/<path:name>", methods=["GET"])
+@login_required
+def media(video_id, name):
+    """
+    Serve a video (video.mp4), its picture (poster.jpg), thumbnails of the
+    picture (poster-[width].webp / .jpg) or its HLS renditions (hls/...).
+
+    Only the owner and members of the video's group get the file. Range
+    requests (206), ETag / If-None-Match / If-Range are handled by send_file.
+    """
+    # conect to db
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("SELECT filepath, image_path, user_id, group_id FROM videos WHERE id = ?", (video_id,))
+    video = cur.fetchone()
+    if video is None or not permissions().can_view(video[2], video[3]):
+        abort(404)
+
+    thumbnail = re.fullmatch(r"poster-(\d+)\.(webp|jpg)", name)
+    if name == "video.mp4":
+        path = video[0]
+    elif name == "poster.jpg":
+        path = video[1]
+    elif thumbnail and video[1]:
+        path = video_helper.thumbnail_path(video[1], int(thumbnail[1]), thumbnail[2])
+        # the video is smaller than this thumbnail (or older than thumbnails)
+        if not os.path.isfile(path):
+            path = video[1]
+    elif name.startswith("hls/"):
+        path = safe_join(video_helper.hls_dir(video[0]), name[len("hls/"):])
+    else:
+        path = None
+    if not path or not os.path.isfile(path):
+        abort(404)
+
+    response = send_file(os.path.abspath(path), mimetype=MEDIA_TYPES.get(os.path.splitext(path)[1]),
+                         conditional=True, etag=True, max_age=MEDIA_MAX_AGE)
+    # private: the file is only for members of the group
+    response.headers["Cache-Control"] = f"private, max-age={MEDIA_MAX_AGE}, immutable"
+    return response
+
+@bp.route("/delete_account/<int:user_id>", methods=["POST", "GET"])
 @login_required
 def delete_account(user_id):
     if session["user_id"] == user_id:
         # conect to db
-        con = sqlite3.connect(DATABASE)
+        con = get_db()
         cur = con.cursor()
 
-        # get if of all videos to delete
-        cur.execute("SELECT `id` FROM `videos` WHERE `user_id` = ?", (user_id,))
-        videos = cur.fetchall()
-
-        # loop through videos and delete
-        for video in videos:
-            cur.execute("SELECT filepath, image_path FROM videos WHERE id = ?", (video[0],))
-            path = cur.fetchone()
-            result = video_helper.deleteVideoAndPicture(path[0], path[1])
-            # delete video from db
-            if result == True:
-                cur.execute("DELETE FROM `videos` WHERE `id` = ?", (video[0],))
-
-        # delete user
+        # delete user, its videos, memberships, uploads and jobs go with it (ON DELETE CASCADE)
+        # files no other video uses are deleted in the background (see sweeper.py)
         cur.execute("DELETE FROM users WHERE id = :user_id",{"user_id": user_id})
-        cur.execute("DELETE FROM group_members WHERE user_id = :user_id",{"user_id": user_id})
         con.commit()
-        con.close()
         session.clear()
         return redirect("/")
     else:
         return "You are not the owner of this account", 401
 
-@app.route("/logout", methods=["GET", "POST"])
+@bp.route("/logout", methods=["GET", "POST"])
 def logout():
     session.clear()
     return redirect("/")
 
-@app.route("/login", methods=["GET", "POST"])
+def log_in(user_id):
+    """Remember the logged in user in a session with a new id (against session fixation)"""
+    session["user_id"] = user_id
+    # session_store.py changes the id by itself, Flask-Session has to be asked
+    if SESSION_BACKEND == "filesystem":
+        current_app.session_interface.regenerate(session)
+
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     """Log user in"""
     # Forget any user_id
     session.clear()
 
     # conect to db
-    con = sqlite3.connect(DATABASE)
+    con = get_db()
     cur = con.cursor()
 
 
@@ -220,16 +422,29 @@ def login():
         elif not request.form.get("password"):
             return render_template("login.html", error="must provide password"), 403
 
+        # Slow down password guessing
+        account = "user:" + request.form.get("username")
+        wait = password_attempt(account)
+        if wait:
+            return render_template("login.html", error="Too many attempts, try again later."), 429, {"Retry-After": str(wait)}
+
         # Query database for username
         cur.execute("SELECT * FROM users WHERE username = :username",{"username": request.form.get("username")})
         rows = cur.fetchall()
 
         # Ensure username exists and password is correct
-        if len(rows) != 1 or not check_password_hash(rows[0][2], request.form.get("password")):
+        if len(rows) != 1 or not password_hasher.check(rows[0][2], request.form.get("password")):
+            password_failed(account)
             return render_template("login.html", error="invalid username and/or password"), 403
+        account_throttle.reset(con, account)
+
+        # Hash made with older parameters, store it again with the current ones
+        if password_hasher.needs_rehash(rows[0][2]):
+            cur.execute("UPDATE users SET hash = ? WHERE id = ?", (password_hasher.hash(request.form.get("password")), rows[0][0]))
+            con.commit()
 
         # Remember which user has logged in
-        session["user_id"] = rows[0][0]
+        log_in(rows[0][0])
 
         # Redirect user to home page
         return redirect("/")
@@ -238,11 +453,11 @@ def login():
     else:
         return render_template("login.html")
 
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/register", methods=["GET", "POST"])
 def register():
     if request.method == "POST":
         # conect to db
-        con = sqlite3.connect(DATABASE)
+        con = get_db()
         cur = con.cursor()
 
         # check if form is fealed
@@ -261,267 +476,192 @@ def register():
         if cur.fetchone():
             return render_template("register.html", error="username is taken"), 400
         
+        wait = password_attempt()
+        if wait:
+            return render_template("register.html", error="Too many attempts, try again later."), 429, {"Retry-After": str(wait)}
+
         # Save user in db
-        hash = generate_password_hash(password)
+        hash = password_hasher.hash(password)
         cur.execute("INSERT INTO users (username, hash, size) VALUES (?, ?, 0);", (username, hash))
         con.commit()
 
         # Get the id of the user from the database
         cur.execute("SELECT id FROM users WHERE username = ?", (username,))
-        session["user_id"] = cur.fetchone()[0]
-        con.close()
+        log_in(cur.fetchone()[0])
         return redirect("/")
     else:
         return render_template("register.html")
 
-@app.route("/upload", methods=["GET", "POST"])
+@bp.route("/upload", methods=["GET"])
 @login_required
 def uploade():
-    if request.method == "POST":
-        end = False
-        try:
-            print("Received upload request")
-            print("Form data:", request.form)
-            print("Files:", request.files)
-
-            if 'file' not in request.files:
-                return make_response(jsonify({'error': 'No file part'}), 400)
-            
-            file = request.files['file']
-            print("File received:", file.filename)
-            
-            # Get form data with error handling
-            try:
-                chunk_number = int(request.form.get('chunk_number', '0'))
-                total_chunks = int(request.form.get('total_chunks', '0'))
-                file_type = request.form.get('file_type', '')
-                video_name = request.form.get('video_name', '')
-                description = request.form.get('description', '')
-                group = request.form.get('group', '')
-                
-                # Get file extension from MIME type
-                extension = ''
-                if '/' in file_type:
-                    extension = '.' + file_type.split('/')[-1]
-                
-                filename = f"{session['user_id']}_{video_name}{extension}"
-            except ValueError as e:
-                print("Error parsing form data:", str(e))
-                return make_response(jsonify({'error': 'Invalid form data'}), 400)
-            
-            print(f"Processing chunk {chunk_number + 1} of {total_chunks} for file {filename}")
-            
-            # Create a temporary folder for chunks
-            temp_folder = os.path.join(app.config['TEMP_FOLDER'], filename)
-            if not os.path.exists(temp_folder):
-                os.makedirs(temp_folder)
-            
-            # Save the chunk
-            chunk_path = os.path.join(temp_folder, f'chunk_{chunk_number}')
-            print(f"Saving chunk to: {chunk_path}")
-            file.save(chunk_path)
-            
-            # If this is the last chunk, combine all chunks
-            if chunk_number == total_chunks - 1:
-                print("Processing final chunk, combining files...")
-                
-                try:
-                    # Create BytesIO object to store file in memory
-                    file_stream = BytesIO()
-                    
-                    # Combine all chunks into memory
-                    for i in range(total_chunks):
-                        chunk_file = os.path.join(temp_folder, f'chunk_{i}')
-                        if os.path.exists(chunk_file):
-                            with open(chunk_file, 'rb') as infile:
-                                file_stream.write(infile.read())
-                        else:
-                            raise Exception(f'Missing chunk {i}')
-                    
-                    # Reset stream position to start
-                    file_stream.seek(0)
-                    
-                    # Create FileStorage object
-                    file = FileStorage(
-                        stream=file_stream,
-                        filename=filename,
-                        content_type=file_type
-                    )
-                    
-                    # Save to disk (optional, you can remove this if you don't need it)
-                    #final_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    #final_file.save(final_path)
-                    
-                    # Prints all received metadata
-                    print(" Metadata" * 5 + ":")
-                    print(f'Name: {video_name}')
-                    print(f'Description: {description}')
-                    print(f'File Type: {file_type}')
-                    print(f'Group: {group}')
-                    print(f'FileStorage object created with size: {file_stream.tell()} bytes')
-                    
-                    # Clean up chunks
-                    for i in range(total_chunks):
-                        try:
-                            chunk_file = os.path.join(temp_folder, f'chunk_{i}')
-                            if os.path.exists(chunk_file):
-                                os.remove(chunk_file)
-                        except Exception as e:
-                            print(f"Error removing chunk {i}: {str(e)}")
-                    
-                    try:
-                        if os.path.exists(temp_folder):
-                            os.rmdir(temp_folder)
-                    except Exception as e:
-                        print(f"Error removing temp folder: {str(e)}")
-                    
-                    print(f"File reconstruction complete")
-                    # Do something with the final file ### END ###
-                    end = True
-                
-                except Exception as e:
-                    print(f"Error during file reconstruction: {str(e)}")
-                    traceback.print_exc()
-                    return make_response(jsonify({'error': f'File reconstruction failed: {str(e)}'}), 500)
-            
-            if end != True:
-                response = make_response(jsonify({'message': f'Chunk {chunk_number + 1} of {total_chunks} received'}))
-                return response, 200
-            
-        except Exception as e:
-            print("Error during upload:")
-            print(str(e))
-            traceback.print_exc()
-            response = make_response(jsonify({'error': str(e)}))
-            return response, 500
-#       file = request.files['video']
-#       group = request.form.get("group")
-#       name = request.form.get("name")
-#       description = request.form.get("description")
-
-        # Check if file was uploaded
-        if not file:
-            print("No file was uploaded.")
-            return make_response(jsonify({'error': "No file was uploaded."})), 400
-        
-        # Check if group is selected
-        if group is None:
-            print("No group was selected.")
-            return make_response(jsonify({'error': "No group was selected."})), 400
-        
-        # Check if file type is allowed
-        if allowed_file(file.filename, ALLOWED_EXTENSIONS):
-            print("File type not allowed.")
-            return make_response(jsonify({'error': "File type not allowed."})), 400
-
-        # conect to db
-        con = sqlite3.connect(DATABASE)
-        cur = con.cursor()
-        
-        # check next available id
-        cur.execute("SELECT MAX(id) FROM videos")
-        id_temp = cur.fetchone()
-        if id_temp[0] is not None:
-            id = id_temp[0] + 1
-        else:
-            id = 1
-        
-        # get file type
-        filetype = file.filename.split('.')[-1].lower()
-        
-
-        # check if file is mp4 widouth modification
-        if filetype != 'mp4':
-            print("Converting to mp4")
-            temp = convert_to_mp4(file)
-            if temp is None:
-                return make_response(jsonify({'error': "File conversion failed."})), 400
-            converted_file = temp[0]
-            file_size = temp[1]
-            print(f"Converted file: {converted_file}")
-            print(f"File size: {file_size}")
-            if converted_file is not None:
-                file = converted_file
-                print("Converted to mp4")
-        else:
-            # extract file size
-            f = video_size_save(file)
-            file_size = f[1]
-            file = f[0]
-
-            if file_size is None:
-                return make_response(jsonify({'error': "Failed to get video size(mp4)."})), 400
-
-        file_path = os.path.join(UPLOAD_FOLDER, f"{id}.mp4")
-        image_path = f"{UPLOAD_FOLDER}{id}.jpg"
-        print(f"File path: {file_path}")
-        
-        # check if user reached limit of all videos size
-        cur.execute("SELECT SUM(file_size) FROM videos WHERE user_id = :user_id",{"user_id": session["user_id"]})
-        t = cur.fetchone()
-        size = t[0]
-        if size is None:
-            size = 0
-
-        if size + file_size > SIZE_ALLOWED:
-            error = f"Space limit has been reached {SIZE_ALLOWED / 1024 / 1024 / 1024} GB. <br>You have {SIZE_ALLOWED / 1024 / 1024 / 1024 - size / 1024 / 1024 / 1024} <br>Upgrade your plan or delete some videos"
-            print(error)
-            return make_response(jsonify({'error': f"{error}"})), 400
-        # write to user table size
-        cur.execute("UPDATE users SET size = :size WHERE id = :user_id",{"size": size + file_size, "user_id": session["user_id"]})
-        con.commit()
-
-        if file:
-            # create folder if it doesent exist
-            if not os.path.exists(UPLOAD_FOLDER):
-                os.makedirs(UPLOAD_FOLDER)
-            file.save(file_path)
-        else:
-            return make_response(jsonify({'error': "Error 123"})), 400
-
-        # Get time from video
-        time = video_helper.video_length(file_path)
-
-        # Create picture
-        video_helper.extract_frame_at(file_path)
+    # get groups from user
+    groups = permissions().group_list()
 
-        # Video size
-        file_size = video_helper.video_size(file_path)
-        print(f"File size: {file_size}")
+    return render_template("uploade.html", groups=groups)
 
-        cur.execute("INSERT INTO `videos` (`name`, `filepath`, `user_id`, `filetype`, `description`, `group_id`, `time`, `image_path`, `file_size`) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
-                    , (video_name, file_path, session["user_id"], filetype, description, group, time, image_path, file_size))
-        con.commit()
+@bp.route("/uploads", methods=["POST"])
+@login_required
+def create_upload():
+    """Start an upload session, the video is then sent with PUT /uploads/<id>/chunks/<n>"""
+    data = request.get_json(silent=True) or {}
+    try:
+        file_size = int(data.get('file_size', 0))
+        group = int(data.get('group') or 0)
+    except (TypeError, ValueError):
+        return make_response(jsonify({'error': 'Invalid form data'}), 400)
+    file_type = str(data.get('file_type', ''))
+    video_name = str(data.get('video_name', ''))
+    description = str(data.get('description', ''))
+
+    # Get file extension from MIME type
+    extension = ''
+    if '/' in file_type:
+        extension = '.' + file_type.split('/')[-1]
+    filename = f"{session['user_id']}_{video_name}{extension}"
+
+    # Check if group is selected
+    if not group:
+        print("No group was selected.")
+        return make_response(jsonify({'error': "No group was selected."})), 400
+    if not video_name:
+        return make_response(jsonify({'error': "Name is required."})), 400
+    if file_size <= 0 or file_size > SIZE_ALLOWED:
+        return make_response(jsonify({'error': f"File must be between 1 byte and {SIZE_ALLOWED / 1024 / 1024 / 1024} GB."})), 400
+
+    # Check if file type is allowed
+    if allowed_file(filename, ALLOWED_EXTENSIONS):
+        print("File type not allowed.")
+        return make_response(jsonify({'error': "File type not allowed."})), 400
+
+    if not permissions().is_member(group):
+        return make_response(jsonify({'error': "You are not a member of this group."})), 403
+
+    con = get_db()
+    cur = con.cursor()
 
-        return make_response(jsonify({'error': "Video uploaded successfully"})), 200
-    else:
-        # conect to db
-        con = sqlite3.connect(DATABASE)
-        cur = con.cursor()
-        # get groups
-        # get groups from user
-        cur.execute("""
-            SELECT g.id, g.name 
-            FROM group_members gm 
-            JOIN groups g ON gm.group_id = g.id 
-            WHERE gm.user_id = ?
-        """, (session["user_id"],))
-        groups = cur.fetchall()
-        con.close()
+    # Hold the space before anything is uploaded or converted (committed with the session)
+    if not quota.reserve(cur, session["user_id"], file_size, SIZE_ALLOWED):
+        error = quota.limit_message(SIZE_ALLOWED, quota.used(cur, session["user_id"]))
+        print(error)
+        return make_response(jsonify({'error': error})), 400
+    # and room in the temp folder for the upload and its conversion
+    try:
+        scratch.admit(cur, current_app.config['TEMP_FOLDER'], file_size, current_app.config['TEMP_BUDGET'])
+    except scratch.TempFull as e:
+        con.rollback()
+        print(e)
+        response = make_response(jsonify({'error': str(e)}), 503)
+        response.headers['Retry-After'] = '60'
+        return response
+
+    upload = uploads.create_session(con, current_app.config['TEMP_FOLDER'], session["user_id"], filename, video_name,
+                                    description, group, file_size, current_app.config['UPLOAD_CHUNK_SIZE'])
+    print(f"Started upload {upload['id']} of {filename} ({file_size} bytes in {upload['total_chunks']} chunks)")
+    return make_response(jsonify(uploads.status(con, upload))), 201
+
+@bp.route("/uploads/<upload_id>", methods=["GET", "DELETE"])
+@login_required
+def upload_status(upload_id):
+    """Received chunks of an upload (to resume it) or abort it with DELETE"""
+    con = get_db()
+    upload = uploads.get_session(con, upload_id, session["user_id"])
+    if upload is None:
+        return make_response(jsonify({'error': "Upload does not exist."})), 404
+
+    if request.method == "DELETE":
+        uploads.delete_session(con, upload)
+        return make_response(jsonify({'message': "Upload deleted"})), 200
+    return make_response(jsonify(uploads.status(con, upload))), 200
+
+@bp.route("/uploads/<upload_id>/chunks/<int:chunk_number>", methods=["PUT"])
+@login_required
+def upload_chunk(upload_id, chunk_number):
+    """Raw chunk in the body, its CRC32 (hex) in the X-Chunk-CRC32 header"""
+    try:
+        crc32 = int(request.headers.get('X-Chunk-CRC32', ''), 16)
+    except ValueError:
+        return make_response(jsonify({'error': "Missing X-Chunk-CRC32 header."})), 400
+
+    con = get_db()
+    upload = uploads.get_session(con, upload_id, session["user_id"])
+    if upload is None:
+        return make_response(jsonify({'error': "Upload does not exist."})), 404
+
+    try:
+        received = uploads.put_chunk(con, upload, chunk_number, request.stream, request.content_length, crc32)
+        if received is not None and current_app.config['TRANSCODE_PIPELINE']:
+            # start converting as soon as the start of the file is here
+            pipeline.advance(current_app.config['DATABASE'], con, current_app.config['TEMP_FOLDER'], upload, received,
+                             max_pipelines=current_app.config['PIPELINE_MAX'])
+    except uploads.UploadError as e:
+        print(f"Upload {upload_id}: {e}")
+        return make_response(jsonify({'error': str(e)})), e.status
+    return make_response(jsonify({'message': f'Chunk {chunk_number + 1} of {upload["total_chunks"]} received'})), 200
+
+@bp.route("/uploads/<upload_id>/finalize", methods=["POST"])
+@login_required
+def finalize_upload(upload_id):
+    """Queue the conversion once every chunk is there"""
+    con = get_db()
+    upload = uploads.get_session(con, upload_id, session["user_id"])
+    if upload is None:
+        return make_response(jsonify({'error': "Upload does not exist."})), 404
+
+    try:
+        folder = uploads.finish_session(con, upload)
+        # Give the upload its job folder (the file is not copied)
+        work_dir = os.path.join(current_app.config['TEMP_FOLDER'], f"job_{upload_id}")
+        os.rename(folder, work_dir)
+        # the pipelined conversion reads the rest of the file
+        pipeline.complete(upload['pipeline_dir'])
+    except uploads.UploadError as e:
+        con.rollback()
+        return make_response(jsonify({'error': str(e)})), e.status
+    except OSError:
+        con.rollback()
+        traceback.print_exc()
+        return make_response(jsonify({'error': "Upload could not be finished."})), 500
+
+    # Conversion runs in the background, the client polls /jobs/<id> (enqueue commits)
+    job_id = transcode_queue.enqueue(con, session["user_id"], {
+        'source_path': os.path.join(work_dir, 'upload.part'),
+        'work_dir': work_dir,
+        'pipeline_dir': upload['pipeline_dir'],
+        # the space held for the upload is released by the job
+        'reserved': upload['file_size'],
+        'filename': upload['filename'],
+        'video_name': upload['video_name'],
+        'description': upload['description'],
+        'group': upload['group_id'],
+        'user_id': session["user_id"],
+    })
+    print(f"Queued job {job_id}")
+
+    return make_response(jsonify({'message': "Upload complete, processing video", 'job_id': job_id})), 202
+
+@bp.route("/jobs/<int:job_id>", methods=["GET"])
+@login_required
+def job_status(job_id):
+    # conect to db
+    con = get_db()
+    job = transcode_queue.get(con, job_id)
 
-        return render_template("uploade.html", groups=groups)
+    # users only see their own jobs
+    if job is None or job['user_id'] != session["user_id"]:
+        return make_response(jsonify({'error': "Job does not exist."})), 404
+    return make_response(jsonify(job)), 200
 
-@app.route("/options", methods=["GET"])
+@bp.route("/options", methods=["GET"])
 @login_required
 def options():
-    con = sqlite3.connect(DATABASE)
+    con = get_db()
     cur = con.cursor()
     cur.execute("SELECT username FROM users WHERE id = ?", (session["user_id"],))
     username = cur.fetchone()[0]
-    con.close()
     return render_template("options.html", user_id=session["user_id"], username=username)
 
-@app.route("/create-group", methods=["GET", "POST"])
+@bp.route("/create-group", methods=["GET", "POST"])
 @login_required
 def create_group():
     if request.method == "POST":
@@ -544,10 +684,13 @@ def create_group():
         if password == "" or password is None:
             hash = None
         else:
-            hash = generate_password_hash(password)
+            wait = password_attempt()
+            if wait:
+                return render_template("create-group.html", error="Too many attempts, try again later."), 429, {"Retry-After": str(wait)}
+            hash = password_hasher.hash(password)
 
         # conect to db
-        con = sqlite3.connect(DATABASE)
+        con = get_db()
         cur = con.cursor()
 
         # check if group exists
@@ -556,7 +699,6 @@ def create_group():
 
         # if group exists
         if result is not None:
-            con.close() # close db
             return render_template("create-group.html", error="Group name already exists!"), 400
 
         # create group
@@ -567,119 +709,69 @@ def create_group():
         cur.execute("SELECT last_insert_rowid()")
         group_id = cur.fetchone()[0]
 
-        con.close() # close db
         return redirect(f"/group/{group_id}/join")
     else:
         return render_template("create-group.html")
 
-@app.route("/video/<video_id>/edit", methods=["GET", "POST"])
+@bp.route("/video/<video_id>/edit", methods=["GET", "POST"])
 @login_required
 def edit_video(video_id):
-    if request.method == "GET":
-        # conect to db
-        con = sqlite3.connect(DATABASE)
-        cur = con.cursor()
+    # conect to db
+    con = get_db()
+    cur = con.cursor()
 
-        # check if video exists
-        cur.execute("SELECT * FROM videos WHERE id = ?", (video_id,))
-        video = cur.fetchone()
-        if video is None:
-            con.close()
-            return "Video does not exist! Go <a href='/'>home</a>.", 404
-        
-        user_is_allowed_to_edit = False
-        # check if user is allowed to edit video
-        # check if user is owner of video
-        cur.execute("SELECT user_id FROM videos WHERE id = ?", (video_id,))
-        video_user_id = cur.fetchone()[0]
-        if video_user_id == session["user_id"]:
-            user_is_allowed_to_edit = True
-
-        # check if user is creator of group in which video is
-        cur.execute("SELECT creator_id FROM groups WHERE id = (SELECT group_id FROM videos WHERE id = ?)", (video_id,))
-        group_user_id = cur.fetchone()[0]
-        if group_user_id == session["user_id"]:
-            user_is_allowed_to_edit = True
-
-        if not user_is_allowed_to_edit:
-            con.close()
-            return "You are not allowed to edit this video! Go <a href='/'>home</a>.", 403
-        
-        # get video data
-        cur.execute("SELECT name, filepath, description, time, file_size FROM videos WHERE id = ?", (video_id,))
-        video = cur.fetchone()
+    # check if video exists
+    cur.execute("SELECT name, filepath, description, time, file_size, user_id, group_id FROM videos WHERE id = ?", (video_id,))
+    video = cur.fetchone()
+    if video is None:
+        return "Video does not exist! Go <a href='/'>home</a>.", 404
+
+    # check if user is owner of video or creator of group in which video is
+    if not permissions().can_edit(video[5], video[6]):
+        return "You are not allowed to edit this video! Go <a href='/'>home</a>.", 403
 
-        con.close()
-        return render_template("edit-video.html", video_id=video_id, video=video)
+    if request.method == "GET":
+        return render_template("edit-video.html", video_id=video_id, video=video[:5])
     else:
         name = request.form.get("name")
         description = request.form.get("description")
 
-        # conect to db
-        con = sqlite3.connect(DATABASE)
-        cur = con.cursor()
-
-        user_is_allowed_to_edit = False
-        # check if user is allowed to edit video
-        # check if user is owner of video
-        cur.execute("SELECT user_id FROM videos WHERE id = ?", (video_id,))
-        video_user_id = cur.fetchone()[0]
-        if video_user_id == session["user_id"]:
-            user_is_allowed_to_edit = True
-
-        # check if user is creator of group in which video is
-        cur.execute("SELECT creator_id FROM groups WHERE id = (SELECT group_id FROM videos WHERE id = ?)", (video_id,))
-        group_user_id = cur.fetchone()[0]
-        if group_user_id == session["user_id"]:
-            user_is_allowed_to_edit = True
-
-        if not user_is_allowed_to_edit:
-            con.close()
-            return "You are not allowed to edit this video! Go <a href='/'>home</a>.", 40
-
         # update video
         cur.execute("UPDATE `videos` SET `name` = ?, `description` = ? WHERE `id` = ?", (name, description, video_id))
         con.commit()
 
-        con.close() # close db
         return redirect(f"/")
 
 
-@app.route("/video/<video_id>/delete", methods=["POST"])
+@bp.route("/video/<video_id>/delete", methods=["POST"])
 @login_required
 def delete_video(video_id):
     # conect to db
-    con = sqlite3.connect(DATABASE)
+    con = get_db()
     cur = con.cursor()
 
-    user_is_allowed_to_edit = False
-    # check if user is allowed to edit video
-    # check if user is owner of video
-    cur.execute("SELECT user_id FROM videos WHERE id = ?", (video_id,))
-    video_user_id = cur.fetchone()[0]
-    if video_user_id == session["user_id"]:
-        user_is_allowed_to_edit = True
-
-    # check if user is creator of group in which video is
-    cur.execute("SELECT creator_id FROM groups WHERE id = (SELECT group_id FROM videos WHERE id = ?)", (video_id,))
-    group_user_id = cur.fetchone()[0]
-    if group_user_id == session["user_id"]:
-        user_is_allowed_to_edit = True
-
-    if not user_is_allowed_to_edit:
-        con.close()
-        return "You are not allowed to edit this video! Go <a href='/'>home</a>.", 40
+    cur.execute("SELECT user_id, group_id FROM videos WHERE id = ?", (video_id,))
+    video = cur.fetchone()
+    if video is None:
+        return "Video does not exist! Go <a href='/'>home</a>.", 404
+
+    # check if user is owner of video or creator of group in which video is
+    if not permissions().can_edit(video[0], video[1]):
+        return "You are not allowed to edit this video! Go <a href='/'>home</a>.", 403
     
     # delit video
     cur.execute("DELETE FROM `videos` WHERE `id` = ?", (video_id,))
     con.commit()
 
-    con.close() # close db
     return redirect(f"/")
 
-@app.route("/group/<group_id>/edit", methods=["GET", "POST"])
+@bp.route("/group/<int:group_id>/edit", methods=["GET", "POST"])
 @login_required
 def edit_group(group_id):
+    # check if user is creator of group
+    if not permissions().is_creator(group_id):
+        return render_template("edit-group.html", error="You are not the creator of this group!"), 403
+
     if request.method == "POST":
         name = request.form.get("name")
         description = request.form.get("description")
@@ -697,7 +789,7 @@ def edit_group(group_id):
             public = False
 
         # conect to db
-        con = sqlite3.connect(DATABASE)
+        con = get_db()
         cur = con.cursor()
 
         # check if password is fealed
@@ -707,172 +799,231 @@ def edit_group(group_id):
             cur.execute("UPDATE `groups` SET `name` = ?, `description` = ?, `public` = ? WHERE `id` = ?", (name, description, public, group_id))
             con.commit()
         else:
-            hash = generate_password_hash(password)
+            wait = password_attempt()
+            if wait:
+                return "Too many attempts, try again later.", 429, {"Retry-After": str(wait)}
+            hash = password_hasher.hash(password)
             # update group
             cur.execute("UPDATE `groups` SET `name` = ?, `description` = ?, `public` = ?, `hash` = ? WHERE `id` = ?", (name, description, public, hash, group_id))
             con.commit()
 
-        con.close() # close db
+
         return redirect(f"/browse-groups")
     else:
         # conect to db
-        con = sqlite3.connect(DATABASE)
+        con = get_db()
         cur = con.cursor()
 
-        # check if user is creator of group
-        cur.execute("SELECT creator_id FROM `groups` WHERE `id` = ?", (group_id,))
-        result = cur.fetchone()[0]
-        # if user is not creator of group
-        if result != session["user_id"]:
-            con.close() # close db
-            return render_template("edit-group.html", error="You are not the creator of this group!"), 400
-
         # get group info
         cur.execute("SELECT name, description, public FROM groups WHERE `id` = ?", (group_id, ))
         result = cur.fetchone()
 
-        con.close() # close db
         return render_template("edit-group.html", group_id=group_id, name=result[0], description=result[1], public=result[2])
 
-@app.route("/browse-groups", methods=["GET"])
+@bp.route("/browse-groups", methods=["GET"])
 @login_required
 def browse_groups():
     return render_template("browse-groups.html")
 
-@app.route("/browse-groups-api", methods=["GET"])
+@bp.route("/browse-groups-api", methods=["GET"])
 @login_required
 def browse_groups_api():
     q = request.args.get("q")
     '''list of public groups and groups user is in'''
     # conect to db
-    con = sqlite3.connect(DATABASE)
+    con = get_db()
     cur = con.cursor()
 
+    # the key changes whenever the user's memberships or any group change
+    key = ("groups", session["user_id"], q, cache.versions(cur, [("user", session["user_id"]), ("groups", 0)]))
+    page = result_cache.get(key)
+    if page is not None:
+        return page
+
     # get groups with membership status for current user
     # Using LEFT JOIN to show all groups, even if user isn't a member
-    cur.execute("""
-        SELECT 
-            g.id, g.name, g.description, g.public, g.creator_id,
-            CASE 
-                WHEN gm.user_id IS NOT NULL THEN 1 
-                ELSE 0 
-            END as is_member
-        FROM groups g
-        LEFT JOIN group_members gm ON g.id = gm.group_id 
-            AND gm.user_id = ?
-        WHERE g.name LIKE ? OR g.description LIKE ?
-        ORDER BY is_member DESC
-    """, (session["user_id"], f"%{q}%", f"%{q}%"))
-    groups = cur.fetchall()
-
-    # close db
-    con.close()
-    return render_template("browse-groups-api.html", groups=groups, user_id=session["user_id"], q=q)
-
-@app.route("/group/<int:group_id>/join")
+    queries = search_index.match_queries(q, "groups")
+    if not queries:
+        cur.execute("""
+            SELECT 
+                g.id, g.name, g.description, g.public, g.creator_id,
+                CASE 
+                    WHEN gm.user_id IS NOT NULL THEN 1 
+                    ELSE 0 
+                END as is_member
+            FROM groups g
+            LEFT JOIN group_members gm ON g.id = gm.group_id 
+                AND gm.user_id = ?
+            ORDER BY is_member DESC
+        """, (session["user_id"],))
+        groups = cur.fetchall()
+
+    # exact matches first, fuzzy ones only if there are none
+    for fts_table, match in queries:
+        cur.execute(f"""
+            SELECT 
+                g.id, g.name, g.description, g.public, g.creator_id,
+                CASE 
+                    WHEN gm.user_id IS NOT NULL THEN 1 
+                    ELSE 0 
+                END as is_member
+            FROM {fts_table}
+            JOIN groups g ON g.id = {fts_table}.rowid
+            LEFT JOIN group_members gm ON g.id = gm.group_id 
+                AND gm.user_id = ?
+            WHERE {fts_table} MATCH ?
+            ORDER BY is_member DESC, {search_index.rank(fts_table)}
+        """, (session["user_id"], match))
+        groups = cur.fetchall()
+        if groups:
+            break
+
+    page = render_template("browse-groups-api.html", groups=groups, user_id=session["user_id"], q=q)
+    result_cache.set(key, page)
+    return page
+
+@bp.route("/group/<int:group_id>/join")
 @login_required
 def group(group_id):
     # conect to db
-    con = sqlite3.connect(DATABASE)
+    con = get_db()
     cur = con.cursor()
 
     # check if user is already in group
-    cur.execute("SELECT * FROM `group_members` WHERE `group_id` = ? AND `user_id` = ?", (group_id, session["user_id"]))
-    result = cur.fetchone()
-
-    # if user is already in group
-    if result is not None:
-        con.close() # close db
+    if permissions().is_member(group_id):
         return render_template("browse-groups.html", error="You are already in this group! Or group does not exist"), 400
 
     # check if group is password protected
     cur.execute("SELECT `hash` FROM `groups` WHERE `id` = ?", (group_id,))
-    hash = cur.fetchone()[0]
+    row = cur.fetchone()
+    if row is None:
+        return render_template("browse-groups.html", error="You are already in this group! Or group does not exist"), 400
+    hash = row[0]
     if hash is not None:
-        con.close() # close db
         return redirect("/group/" + str(group_id) + "/join/password")
 
     # add user to group
     cur.execute("INSERT INTO `group_members` (`group_id`, `user_id`) VALUES (?, ?)", (group_id, session["user_id"]))
     con.commit()
 
-    # close db
-    con.close()
     return redirect("/browse-groups")
 
-@app.route("/group/<int:group_id>/join/password", methods=["GET", "POST"])
+@bp.route("/group/<int:group_id>/join/password", methods=["GET", "POST"])
 @login_required
 def group_password(group_id):
     if request.method == "POST":
         password = request.form.get("password")
 
+        # Slow down password guessing
+        account = f"group:{group_id}"
+        wait = password_attempt(account)
+        if wait:
+            return render_template("group-password.html", group_id=group_id, error="Too many attempts, try again later."), 429, {"Retry-After": str(wait)}
+
         # check if password is correct
-        con = sqlite3.connect(DATABASE)
+        con = get_db()
         cur = con.cursor()
         cur.execute("SELECT `hash` FROM `groups` WHERE `id` = ?", (group_id,))
         hash = cur.fetchone()[0]
         if hash is None:
-            con.close() # close db
             return render_template("group-password.html", error="Group is not password protected!"), 400
-        if check_password_hash(hash, password):
+        if password_hasher.check(hash, password):
+            if password_hasher.needs_rehash(hash):
+                cur.execute("UPDATE `groups` SET `hash` = ? WHERE `id` = ?", (password_hasher.hash(password), group_id))
             cur.execute("INSERT INTO `group_members` (`group_id`, `user_id`) VALUES (?, ?)", (group_id, session["user_id"]))
             con.commit()
-            con.close() # close db
             return redirect("/browse-groups")
         else:
-            con.close() # close db
+            password_failed(account)
             return render_template("group-password.html", error="Incorrect password!"), 400
     else:
         return render_template("group-password.html", group_id=group_id)
 
-@app.route("/group/<int:group_id>/leave", methods=["GET"])
+@bp.route("/group/<int:group_id>/leave", methods=["GET"])
 @login_required
 def leave_group(group_id):
     # conect to db
-    con = sqlite3.connect(DATABASE)
+    con = get_db()
     cur = con.cursor()
 
     # remove user from group
     cur.execute("DELETE FROM `group_members` WHERE `group_id` = ? AND `user_id` = ?", (group_id, session["user_id"]))
     con.commit()
 
-    # close db
-    con.close()
     return redirect("/browse-groups")
 
-@app.route("/group/<int:group_id>/delete", methods=["POST"])
+@bp.route("/group/<int:group_id>/delete", methods=["POST"])
 @login_required
 def delete_group(group_id):
+    # only the creator may delete the group
+    if not permissions().is_creator(group_id):
+        return "You are not the creator of this group! Go <a href='/'>home</a>.", 403
+
     # conect to db
-    con = sqlite3.connect(DATABASE)
+    con = get_db()
     cur = con.cursor()
 
-    # delete all videos and pictures in group
-    # get if of all videos to delete
-    cur.execute("SELECT `id` FROM `videos` WHERE `group_id` = ?", (group_id,))
-    videos = cur.fetchall()
-
-    # loop through videos and delete
-    for video in videos:
-        cur.execute("SELECT filepath, image_path FROM videos WHERE id = ?", (video[0],))
-        path = cur.fetchone()
-        result = video_helper.deleteVideoAndPicture(path[0], path[1])
-        # delete video from db
-        if result == True:
-            cur.execute("DELETE FROM `videos` WHERE `id` = ?", (video[0],))
-            con.commit()
-    
-    # delete group
+    # uploads in progress into the group give back their space first
+    aborted = uploads.delete_group_sessions(cur, group_id)
+    # delete group, its videos and members go with it (ON DELETE CASCADE)
+    # files no other video uses are deleted in the background (see sweeper.py)
     cur.execute("DELETE FROM `groups` WHERE `id` = ?", (group_id,))
-    cur.execute("DELETE FROM `group_members` WHERE `group_id` = ?", (group_id,))
     con.commit()
+    for folder in aborted:
+        shutil.rmtree(folder, ignore_errors=True)
 
-    # close db
-    con.close()
     return redirect("/browse-groups")
 
-@app.errorhandler(404)
+@bp.route("/stats", methods=["GET"])
+@login_required
+def stats():
+    """Counters for sizing the caches and the temp folder"""
+    return make_response(jsonify({
+        'result_cache': result_cache.stats(),
+        'authz_cache': authz_cache.stats(),
+        'temp': scratch.usage(get_db(), current_app.config['TEMP_FOLDER'], current_app.config['TEMP_BUDGET']),
+    })), 200
+
+@bp.route("/metrics", methods=["GET"])
+def metrics_page():
+    """Request, query and conversion metrics of all processes in Prometheus text format"""
+    token = os.environ.get('METRICS_TOKEN')
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+            return "Unauthorized", 401
+    elif request.remote_addr not in ('127.0.0.1', '::1') or 'X-Forwarded-For' in request.headers:
+        # without a token only a scraper on this machine, not a client sent on by a proxy
+        return "Forbidden, set METRICS_TOKEN to scrape from elsewhere", 403
+
+    # this process' latest numbers, the others wrote theirs in the last few seconds
+    metrics.flush()
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("SELECT state, COUNT(*) FROM jobs WHERE state IN ('queued', 'running') GROUP BY state")
+    queue = {(('state', 'queued'),): 0, (('state', 'running'),): 0}
+    for state, count in cur.fetchall():
+        queue[(('state', state),)] = count
+    temp = scratch.usage(con, current_app.config['TEMP_FOLDER'], current_app.config['TEMP_BUDGET'])
+    gauges = [
+        ('danceshare_transcode_queue_jobs', "Transcode jobs waiting and running", queue),
+        ('danceshare_pipelines_running', "Uploads converted while they come in", {(): pipeline.running(con)}),
+        ('danceshare_temp_bytes', "Space of the temp folder",
+         {(('kind', kind),): temp[kind] for kind in ('budget', 'held', 'on_disk')}),
+        ('danceshare_upload_sessions', "Uploads in progress", {(): temp['sessions']}),
+    ]
+    return metrics.render(metrics.collect(), gauges), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@bp.app_errorhandler(passwords.HasherBusy)
+def hasher_busy(e):
+    return str(e), 503, {"Retry-After": "5"}
+
+@bp.app_errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
 
-app.run(host="0.0.0.0", port=8080)
\ No newline at end of file
+if __name__ == "__main__":
+    # everything in one process, for development (see danceshare.py for production)
+    metrics.clear_dir()
+    app = create_app()
+    start_background()
+    app.run(host="0.0.0.0", port=8080)
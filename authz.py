@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class Permissions:
+    """
+    What a user may see and change, loaded with one query.
+
+    Attributes:
+        groups: {group_id: name} of the groups the user is a member of
+        created: ids of the groups the user created
+        version: cache version of the user they were loaded at (see migrations.py)
+    """
+
+    __slots__ = ('user_id', 'groups', 'created', 'version')
+
+    def __init__(self, user_id, groups, created, version=0):
+        self.user_id = user_id
+        self.groups = groups
+        self.created = created
+        self.version = version
+
+    def group_list(self):
+        """(id, name) of the user's groups, for the group pickers"""
+        return list(self.groups.items())
+
+    def is_member(self, group_id):
+        return group_id in self.groups
+
+    def is_creator(self, group_id):
+        return group_id in self.created
+
+    def can_view(self, owner_id, group_id):
+        """Owner and members of the video's group"""
+        return owner_id == self.user_id or group_id in self.groups
+
+    def can_edit(self, owner_id, group_id):
+        """Owner of the video and creator of its group"""
+        return owner_id == self.user_id or group_id in self.created
+
+
+def load(cur, user_id):
+    """Permissions of a user straight from the database"""
+    cur.execute("""
+        SELECT 'member', g.id, g.name FROM group_members gm JOIN groups g ON g.id = gm.group_id WHERE gm.user_id = :user_id
+        UNION ALL
+        SELECT 'creator', id, NULL FROM groups WHERE creator_id = :user_id
+        UNION ALL
+        SELECT 'version', version, NULL FROM cache_versions WHERE kind = 'user' AND id = :user_id
+    """, {"user_id": user_id})
+    groups = {}
+    created = set()
+    version = 0
+    for kind, id, name in cur.fetchall():
+        if kind == 'member':
+            groups[id] = name
+        elif kind == 'creator':
+            created.add(id)
+        else:
+            version = id
+    return Permissions(user_id, groups, frozenset(created), version)
+
+
+def version(cur, user_id):
+    """Cache version of a user, bumped by triggers when their groups change"""
+    cur.execute("SELECT version FROM cache_versions WHERE kind = 'user' AND id = ?", (user_id,))
+    row = cur.fetchone()
+    return row[0] if row is not None else 0
+
+
+class AuthzCache:
+    """
+    In-process LRU cache of Permissions per user.
+
+    A cached entry is used while the user's version in cache_versions (one
+    primary key lookup) is the one it was loaded at. Triggers bump it when
+    the user's memberships or groups change, in whichever process.
+    """
+
+    def __init__(self, max_entries=4096, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, con, user_id):
+        """Permissions of a user, from the cache (checked with one lookup) or loaded with one query"""
+        cur = con.cursor()
+        current = version(cur, user_id)
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] >= monotonic() and entry[1].version == current:
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        permissions = load(cur, user_id)
+        with self.lock:
+            self.entries[user_id] = (monotonic() + self.ttl, permissions)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return permissions
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
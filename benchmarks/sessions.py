@@ -0,0 +1,161 @@
+"""
+Benchmark of the session backends (see session_store.py).
+
+Logs in a number of users on a small Flask app and then sends requests that
+only read the session (like upload chunks), with a few that change it, from
+several threads. Prints requests per second and latency percentiles for each
+backend as JSON:
+
+    python benchmarks/sessions.py
+    python benchmarks/sessions.py --backends sqlite filesystem --requests 20000 --threads 8
+    python benchmarks/sessions.py --write-ratio 0.1 --output results.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask, session
+from flask_session import Session
+
+import db
+import migrations
+import session_store
+
+BACKENDS = ('filesystem', 'sqlite', 'memory')
+
+
+def make_app(backend, folder):
+    """Flask app with the backend configured like app.py does"""
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'benchmark'
+    app.config['SESSION_PERMANENT'] = False
+    app.config['DATABASE'] = os.path.join(folder, 'sessions.db')
+    # keep stdout for the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        migrations.migrate(app.config['DATABASE'])
+    db.init_app(app)
+
+    if backend == 'filesystem':
+        app.config['SESSION_TYPE'] = 'filesystem'
+        app.config['SESSION_FILE_DIR'] = os.path.join(folder, 'flask_session')
+        Session(app)
+    elif backend == 'memory':
+        app.session_interface = session_store.ServerSessionInterface(session_store.MemorySessionStore())
+    else:
+        store = session_store.SqliteSessionStore(app.config['DATABASE'], db.get_db)
+        app.session_interface = session_store.ServerSessionInterface(store)
+
+    @app.route('/login/<int:user_id>')
+    def login(user_id):
+        session.clear()
+        session['user_id'] = user_id
+        return 'ok'
+
+    @app.route('/read')
+    def read():
+        return str(session['user_id'])
+
+    @app.route('/write')
+    def write():
+        session['counter'] = session.get('counter', 0) + 1
+        return 'ok'
+
+    return app
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def benchmark(backend, requests, threads, users, write_ratio):
+    folder = tempfile.mkdtemp(prefix='session-bench-')
+    app = make_app(backend, folder)
+
+    # one logged in client per user, the threads share them out
+    clients = []
+    for user_id in range(users):
+        client = app.test_client()
+        client.get(f'/login/{user_id}')
+        clients.append(client)
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def run(count, seed):
+        rng = random.Random(seed)
+        mine = clients[seed::threads]
+        times = []
+        for _ in range(count):
+            path = '/write' if rng.random() < write_ratio else '/read'
+            start = perf_counter()
+            response = rng.choice(mine).get(path)
+            times.append(perf_counter() - start)
+            if response.status_code != 200:
+                with lock:
+                    errors.append(response.status_code)
+        with lock:
+            latencies.extend(times)
+
+    workers = [threading.Thread(target=run, args=(requests // threads, i)) for i in range(threads)]
+    start = perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wall = perf_counter() - start
+
+    latencies.sort()
+    return {
+        'backend': backend,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'wall_time': round(wall, 3),
+        'requests_per_second': round(len(latencies) / wall, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the session backends")
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--users', type=int, default=100, help="logged in users (clients)")
+    parser.add_argument('--write-ratio', type=float, default=0.01, help="part of the requests that change the session")
+    parser.add_argument('--output', help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+    if args.users < args.threads:
+        parser.error("need at least one user per thread")
+
+    results = []
+    for backend in args.backends:
+        print(f"{backend}...", file=sys.stderr)
+        results.append(benchmark(backend, args.requests, args.threads, args.users, args.write_ratio))
+
+    report = {
+        'cpus': os.cpu_count(),
+        'threads': args.threads,
+        'users': args.users,
+        'write_ratio': args.write_ratio,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Benchmark of the x264 settings used by tomp4.convert_to_mp4().
+
+Generates reproducible test clips with FFmpeg's lavfi sources, encodes them
+with every combination of presets, CRF values and thread counts (or with
+named profiles) and prints the results as JSON:
+
+    python benchmarks/transcode.py
+    python benchmarks/transcode.py --presets veryfast medium --crf 20 23 26 --threads 0 2
+    python benchmarks/transcode.py --profiles fast balanced small
+    python benchmarks/transcode.py --profiles-file candidates.json --output results.json
+
+A profiles file is a JSON object like tomp4.TRANSCODE_PROFILES:
+{"name": {"preset": "faster", "crf": 24, "threads": 2}, ...}
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tomp4
+
+# lavfi sources of the test clips, all with audio
+CLIPS = {
+    # smooth test pattern, easy to encode
+    'pattern': 'testsrc2=size={width}x{height}:rate={fps}',
+    # spinning pattern with grain that changes every frame, close to a
+    # dancer moving in front of a camera in a dim room (worst case for x264)
+    'motion': 'testsrc2=size={width}x{height}:rate={fps},'
+              'rotate=angle=PI*t:fillcolor=black,'
+              'noise=alls=12:allf=t+u',
+}
+AUDIO = 'sine=frequency=440:beep_factor=4:sample_rate=48000'
+RESOLUTIONS = {'360p': (640, 360), '720p': (1280, 720), '1080p': (1920, 1080)}
+
+
+def make_clip(folder, name, resolution, duration, fps):
+    """
+    Render a test clip losslessly (the reference for PSNR/SSIM).
+
+    Returns:
+        str: path of the clip, reused when it already exists
+    """
+    width, height = RESOLUTIONS[resolution]
+    path = os.path.join(folder, f"{name}_{resolution}_{duration}s.mkv")
+    if os.path.exists(path):
+        return path
+    command = [
+        'ffmpeg', '-v', 'error',
+        '-f', 'lavfi', '-i', CLIPS[name].format(width=width, height=height, fps=fps),
+        '-f', 'lavfi', '-i', AUDIO,
+        '-t', str(duration),
+        '-c:v', 'libx264', '-qp', '0', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+        '-c:a', 'pcm_s16le',
+        '-y', path
+    ]
+    subprocess.run(command, check=True)
+    return path
+
+
+def run(command):
+    """
+    Run a command and measure it.
+
+    Returns:
+        tuple: (wall time in s, peak RSS in bytes, return code, stderr)
+    """
+    start = perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    # wait4 gives the resource usage of this child only
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall = perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    return wall, usage.ru_maxrss * 1024, process.returncode, stderr.decode(errors='replace')
+
+
+def quality(output_path, reference_path):
+    """PSNR (dB) and SSIM of the encoded video against the lossless clip"""
+    command = [
+        'ffmpeg', '-i', output_path, '-i', reference_path,
+        '-filter_complex', '[0:v]split[a][b];[1:v]split[c][d];[a][c]psnr;[b][d]ssim',
+        '-f', 'null', '-'
+    ]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    log = result.stderr.decode(errors='replace')
+    psnr = re.search(r"PSNR .*average:([\d.]+|inf)", log)
+    ssim = re.search(r"SSIM .*All:([\d.]+)", log)
+    return (float(psnr[1]) if psnr else None), (float(ssim[1]) if ssim else None)
+
+
+def benchmark(clip_path, duration, fps, name, profile, folder):
+    """Encode a clip with one profile like convert_to_mp4() does and return the measurements"""
+    output_path = os.path.join(folder, 'out.mp4')
+    command = tomp4.mp4_command(clip_path, output_path, profile=profile)
+    wall, peak_rss, returncode, stderr = run(['ffmpeg', '-v', 'error'] + command[1:])
+    result = {
+        'clip': os.path.basename(clip_path),
+        'profile': name,
+        'preset': profile['preset'],
+        'crf': profile['crf'],
+        'threads': profile.get('threads', 0),
+        'wall_time': round(wall, 3),
+    }
+    if returncode != 0:
+        result['error'] = stderr.strip()[-500:]
+        return result
+
+    frames = duration * fps
+    psnr, ssim = quality(output_path, clip_path)
+    result.update({
+        'encode_fps': round(frames / wall, 2),
+        # seconds of encoding per minute of footage
+        'seconds_per_minute': round(wall * 60 / duration, 2),
+        'peak_rss': peak_rss,
+        'output_size': os.path.getsize(output_path),
+        'bitrate': round(os.path.getsize(output_path) * 8 / duration),
+        'psnr': psnr,
+        'ssim': ssim,
+    })
+    os.remove(output_path)
+    return result
+
+
+def profiles_from_args(args):
+    """Named profiles to run: the given ones, or the preset x CRF x threads matrix"""
+    if args.profiles_file:
+        with open(args.profiles_file) as f:
+            return json.load(f)
+    if args.profiles:
+        return {name: tomp4.TRANSCODE_PROFILES[name] for name in args.profiles}
+    return {
+        f"{preset}-crf{crf}-t{threads}": {'preset': preset, 'crf': crf, 'threads': threads}
+        for preset in args.presets
+        for crf in args.crf
+        for threads in args.threads
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark x264 settings of tomp4 on generated clips")
+    parser.add_argument('--clips', nargs='+', default=list(CLIPS), choices=CLIPS)
+    parser.add_argument('--resolutions', nargs='+', default=list(RESOLUTIONS), choices=RESOLUTIONS)
+    parser.add_argument('--duration', type=int, default=10, help="length of the clips in seconds")
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--presets', nargs='+', default=['veryfast', 'faster', 'medium', 'slow'])
+    parser.add_argument('--crf', nargs='+', type=int, default=[20, 23, 26])
+    parser.add_argument('--threads', nargs='+', type=int, default=[0], help="0 lets x264 decide")
+    parser.add_argument('--profiles', nargs='+', choices=tomp4.TRANSCODE_PROFILES,
+                        help="run these profiles of tomp4.TRANSCODE_PROFILES instead of the matrix")
+    parser.add_argument('--profiles-file', help="JSON file with named profiles to run instead of the matrix")
+    parser.add_argument('--work-dir', help="folder for the clips (kept, so later runs reuse them)")
+    parser.add_argument('--output', help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    profiles = profiles_from_args(args)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='transcode-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = []
+    for clip in args.clips:
+        for resolution in args.resolutions:
+            clip_path = make_clip(work_dir, clip, resolution, args.duration, args.fps)
+            for name, profile in profiles.items():
+                print(f"{os.path.basename(clip_path)}: {name}", file=sys.stderr)
+                results.append(benchmark(clip_path, args.duration, args.fps, name, profile, work_dir))
+
+    report = {
+        'cpus': os.cpu_count(),
+        'ffmpeg': subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE).stdout.decode().splitlines()[0],
+        'duration': args.duration,
+        'fps': args.fps,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import hashlib
+
+# Hash of the original upload, names the stored files
+HASH = hashlib.sha256
+
+# Columns copied into every videos row using the blob (time is the duration in seconds)
+VIDEO_COLUMNS = ('filepath', 'image_path', 'filetype', 'time', 'file_size',
+                 'width', 'height', 'codec', 'bitrate', 'fps', 'rotation')
+BLOB_COLUMNS = ('digest',) + VIDEO_COLUMNS
+
+
+def file_digest(path, block_size=1024 * 1024):
+    """Hex digest of a file"""
+    hash = HASH()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            hash.update(block)
+    return hash.hexdigest()
+
+
+def find(cur, digest):
+    """Stored files of a blob as a dict, None if nobody uploaded this content yet"""
+    cur.execute(f"SELECT {', '.join(BLOB_COLUMNS)} FROM blobs WHERE digest = ?", (digest,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return dict(zip(BLOB_COLUMNS, row))
+
+
+def add(cur, blob):
+    """
+    Register stored files, the videos rows pointing at it keep the refcount.
+
+    Triggers delete the blob with its last video and tombstone its files,
+    sweeper.py deletes them from disk.
+    """
+    cur.execute(f"INSERT INTO blobs ({', '.join(BLOB_COLUMNS)}) VALUES ({', '.join('?' * len(BLOB_COLUMNS))})",
+                tuple(blob[column] for column in BLOB_COLUMNS))
+
@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+def versions(cur, keys):
+    """
+    Current versions of what cached results depend on, with one query.
+
+    Triggers bump them in the cache_versions table (see migrations.py):
+    ('user', id) when the user's groups change, ('group', id) when the
+    videos or the name of a group change and ('groups', 0) when any group
+    is added, changed or deleted.
+
+    Args:
+        keys: list of (kind, id)
+
+    Returns:
+        tuple: version of every key in order, 0 if it never changed
+    """
+    if not keys:
+        return ()
+    cur.execute(f"SELECT kind, id, version FROM cache_versions WHERE (kind, id) IN (VALUES {', '.join(['(?, ?)'] * len(keys))})",
+                [value for key in keys for value in key])
+    found = {(kind, id): version for kind, id, version in cur.fetchall()}
+    return tuple(found.get(key, 0) for key in keys)
+
+
+class ResultCache:
+    """
+    In-process LRU cache with a time to live for rendered results.
+
+    Entries are never deleted on writes. Instead the versions of the users
+    and groups a result depends on (see versions()) are part of the cache
+    key: a write bumps the version of what it changed, so later lookups in
+    every process build a new key and the old entries simply age out of the
+    LRU.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_entries=4096, ttl=60):
+        """
+        Args:
+            max_bytes: total size of the cached values (len of the strings)
+            max_entries: most entries kept
+            ttl: seconds an entry is valid
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Cached value for key, None if missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (monotonic() + self.ttl, value)
+            self.size += len(value)
+            while self.size > self.max_bytes or len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        expires, value = self.entries.pop(key)
+        self.size -= len(value)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+            }
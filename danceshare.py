@@ -0,0 +1,243 @@
+"""
+Production entry point of DANCEshare.
+
+    python danceshare.py serve                 web workers (gunicorn) and the transcoder
+    python danceshare.py serve --workers 3 --threads 8
+    python danceshare.py worker                only the transcoder (started by serve)
+    python danceshare.py vendor                download the pinned hls.js into static/vendor
+
+`serve` runs the web application in gunicorn worker processes with a few
+threads each. Videos are converted in a separate transcoder process (the
+job queue, its FFmpeg workers and the maintenance threads, see
+app.start_background()) with its own limits, so conversions never take the
+place of web workers. Uploads converted while they come in (pipeline.py)
+are fed from the web worker that receives them, their FFmpeg runs at the
+same lower priority in a session of its own and at most PIPELINE_MAX of
+them run at once over all workers. The gunicorn master starts the transcoder, starts it
+again when it dies and lets it finish its running conversions on reload
+(SIGHUP) and shutdown (SIGTERM).
+
+The defaults fit the 1 GB container of the README: 2 web workers with 4
+threads, 1 conversion and 1 upload converted while it comes in at a time
+and 1 password hashing process per web worker.
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import signal
+import subprocess
+import sys
+import tarfile
+import threading
+import traceback
+import urllib.request
+from time import sleep
+
+# Defaults for a small container (1 GB, 1-2 cores), the environment wins
+SMALL_DEFAULTS = {
+    'TRANSCODE_WORKERS': '1',
+    'PIPELINE_MAX': '1',
+    'PASSWORD_WORKERS': '1',
+}
+# How long (in seconds) the transcoder may finish running conversions on
+# reload or shutdown, unfinished ones are started again afterwards
+TRANSCODE_DRAIN_TIMEOUT = int(os.environ.get('TRANSCODE_DRAIN_TIMEOUT', 120))
+# Priority of the transcoder and FFmpeg, web requests go first
+TRANSCODE_NICE = int(os.environ.get('TRANSCODE_NICE', 10))
+# Wait before a transcoder that died is started again (in seconds)
+RESTART_DELAY = 5
+# Where `vendor` gets the npm packages of the third party scripts
+NPM_REGISTRY = 'https://registry.npmjs.org'
+
+
+class Transcoder:
+    """Supervises the transcoder process (danceshare.py worker) from the gunicorn master"""
+
+    def __init__(self, drain_timeout=TRANSCODE_DRAIN_TIMEOUT):
+        self.drain_timeout = drain_timeout
+        self.process = None
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            self.running = True
+            # own process group, so the conversions can be killed together
+            self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker'], start_new_session=True)
+            process = self.process
+        print(f"Transcoder started (pid {process.pid})")
+        threading.Thread(target=self._watch, args=(process,), name='transcoder-watch', daemon=True).start()
+
+    def _watch(self, process):
+        """Start the transcoder again when it dies on its own"""
+        # the exit code is not reliable, the gunicorn master reaps every child
+        process.wait()
+        with self.lock:
+            if not self.running or process is not self.process:
+                return
+        print(f"Transcoder (pid {process.pid}) died, starting it again in {RESTART_DELAY} s")
+        sleep(RESTART_DELAY)
+        with self.lock:
+            if not self.running or process is not self.process:
+                return
+        self.start()
+
+    def stop(self):
+        """Let the transcoder finish its conversions (up to drain_timeout), then kill what is left"""
+        with self.lock:
+            self.running = False
+            process = self.process
+        if process is None or process.poll() is not None:
+            return
+        print(f"Stopping transcoder (pid {process.pid})")
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(self.drain_timeout + 10)
+        except subprocess.TimeoutExpired:
+            print("Transcoder did not stop, killing it")
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.wait()
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+
+def serve(args):
+    """Run the web workers in gunicorn and supervise the transcoder"""
+    # imported here, the worker command doesn't need it
+    from gunicorn.app.base import BaseApplication
+
+    for name, value in SMALL_DEFAULTS.items():
+        os.environ.setdefault(name, value)
+
+    import app as danceshare
+    import metrics
+    import migrations
+
+    # once in the master, not in every worker at the same time
+    migrations.migrate(danceshare.DATABASE)
+    # counters of an earlier run would be added to the new ones
+    metrics.clear_dir()
+    transcoder = Transcoder()
+
+    def on_reload(arbiter):
+        # the web workers are replaced by gunicorn, the transcoder drains in the background
+        threading.Thread(target=transcoder.restart, name='transcoder-reload', daemon=True).start()
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', args.bind)
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', args.timeout)
+            self.cfg.set('graceful_timeout', args.graceful_timeout)
+            # workers are replaced now and then, so memory doesn't creep up
+            self.cfg.set('max_requests', args.max_requests)
+            self.cfg.set('max_requests_jitter', args.max_requests // 10)
+            self.cfg.set('when_ready', lambda arbiter: transcoder.start())
+            self.cfg.set('on_reload', on_reload)
+            self.cfg.set('on_exit', lambda arbiter: transcoder.stop())
+
+        def load(self):
+            # every worker makes its own app (database connections, password pool)
+            return danceshare.create_app()
+
+    Server().run()
+
+
+def worker(args):
+    """Run the transcode queue and the maintenance threads until SIGTERM"""
+    try:
+        os.nice(TRANSCODE_NICE)
+    except OSError:
+        pass
+
+    import app as danceshare
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    # reloads are handled by the master (it starts a new transcoder)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    danceshare.start_background()
+    stop.wait()
+
+    try:
+        drained = danceshare.transcode_queue.stop(TRANSCODE_DRAIN_TIMEOUT)
+    except Exception:
+        traceback.print_exc()
+        drained = False
+    if not drained:
+        # conversions still running (and their FFmpeg) go down with this process
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        os.killpg(os.getpgrp(), signal.SIGTERM)
+        sys.exit(1)
+
+
+def vendor(args):
+    """
+    Download hls.js (the version pinned in app.HLS_JS) and its license into static/vendor.
+
+    The package comes from the npm registry and is checked against the
+    integrity hash the registry publishes for it.
+    """
+    import app as danceshare
+
+    with urllib.request.urlopen(f"{NPM_REGISTRY}/hls.js/{danceshare.HLS_JS_VERSION}", timeout=30) as response:
+        dist = json.load(response)['dist']
+    with urllib.request.urlopen(dist['tarball'], timeout=60) as response:
+        package = response.read()
+    algorithm, expected = dist['integrity'].split('-', 1)
+    if base64.b64encode(hashlib.new(algorithm, package).digest()).decode() != expected:
+        sys.exit(f"hls.js {danceshare.HLS_JS_VERSION} does not match its integrity hash, not installed")
+
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    with tarfile.open(fileobj=io.BytesIO(package)) as archive:
+        for member, name in (('package/dist/hls.min.js', danceshare.HLS_JS), ('package/LICENSE', danceshare.HLS_JS_LICENSE)):
+            path = os.path.join(folder, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(archive.extractfile(member).read())
+            os.replace(path + '.tmp', path)
+            print(f"Saved static/{name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run DANCEshare")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help="web workers and the transcoder")
+    serve_parser.add_argument('--bind', default=os.environ.get('BIND', '0.0.0.0:8080'))
+    serve_parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_WORKERS', 2)),
+                              help="web worker processes")
+    serve_parser.add_argument('--threads', type=int, default=int(os.environ.get('WEB_THREADS', 4)),
+                              help="threads per web worker")
+    serve_parser.add_argument('--timeout', type=int, default=120,
+                              help="seconds a request may take before its worker is replaced")
+    serve_parser.add_argument('--graceful-timeout', type=int, default=30,
+                              help="seconds web workers get to finish their requests on reload and shutdown")
+    serve_parser.add_argument('--max-requests', type=int, default=1000,
+                              help="requests after which a web worker is replaced, 0 never")
+    serve_parser.set_defaults(run=serve)
+
+    worker_parser = commands.add_parser('worker', help="only the transcoder")
+    worker_parser.set_defaults(run=worker)
+
+    vendor_parser = commands.add_parser('vendor', help="download the pinned hls.js into static/vendor")
+    vendor_parser.set_defaults(run=vendor)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
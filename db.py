@@ -0,0 +1,146 @@
+import sqlite3
+import threading
+from time import perf_counter, time as nowtime
+
+from flask import current_app, g
+
+import metrics
+
+# Pragmas set on every new connection
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",        # readers don't block the writer and the other way around
+    "PRAGMA busy_timeout = 5000",       # wait up to 5 s for a lock instead of failing with "database is locked"
+    "PRAGMA synchronous = NORMAL",      # safe with WAL, fsync only on checkpoints
+    "PRAGMA cache_size = -8000",        # 8 MB page cache per connection
+    "PRAGMA mmap_size = 134217728",     # read the first 128 MB of the file through mmap
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA foreign_keys = ON",         # ON DELETE CASCADE (see migrations.py)
+)
+
+# Idle connections kept for reuse
+POOL_SIZE = 8
+# How often (in seconds) statistics are refreshed and the WAL is checkpointed
+MAINTENANCE_INTERVAL = 60 * 60
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor observing how long every statement takes (metrics.QUERY_SECONDS).
+
+    Only execute() is timed, for a SELECT that is finding the first row,
+    the rest comes with fetchall().
+    """
+
+    def execute(self, sql, parameters=()):
+        start = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.QUERY_SECONDS.observe(perf_counter() - start, metrics.statement(sql))
+
+    def executemany(self, sql, parameters):
+        start = perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            metrics.QUERY_SECONDS.observe(perf_counter() - start, metrics.statement(sql))
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors (also those of con.execute()) are TimedCursors"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+
+def connect(database):
+    """Open a new connection with the pragmas set"""
+    con = sqlite3.connect(database, timeout=5, check_same_thread=False, factory=TimedConnection)
+    for pragma in PRAGMAS:
+        con.execute(pragma)
+    return con
+
+
+class ConnectionPool:
+    """
+    Keeps idle connections so requests don't open (and set up) a new one each time.
+
+    Connections are handed out to one thread at a time, so they are opened
+    with check_same_thread=False.
+    """
+
+    def __init__(self, database, size=POOL_SIZE):
+        self.database = database
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.maintenance_lock = threading.Lock()
+        self.last_maintenance = nowtime()
+
+    def get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return connect(self.database)
+
+    def put(self, con):
+        # don't hand out a connection with an open transaction (early returns)
+        try:
+            con.rollback()
+        except sqlite3.Error:
+            con.close()
+            return
+
+        if nowtime() - self.last_maintenance > MAINTENANCE_INTERVAL:
+            self.maintenance(con)
+
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(con)
+                return
+        con.close()
+
+    def maintenance(self, con):
+        """Refresh query planner statistics and checkpoint the WAL, at most one thread at a time"""
+        if not self.maintenance_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_maintenance = nowtime()
+            run_maintenance(con)
+        finally:
+            self.maintenance_lock.release()
+
+
+def run_maintenance(con):
+    """ANALYZE what changed since the last run and move the WAL back into the database"""
+    try:
+        con.execute("PRAGMA analysis_limit = 400")
+        con.execute("PRAGMA optimize")
+        con.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    except sqlite3.Error as e:
+        print(f"Database maintenance failed: {e}")
+
+
+def init_app(app):
+    """Create the pool for app.config['DATABASE'] and return connections after each request"""
+    app.extensions['db_pool'] = ConnectionPool(app.config['DATABASE'])
+    app.teardown_appcontext(close_db)
+
+
+def get_db():
+    """Connection for the current request, the same one is returned for the whole request"""
+    if 'db' not in g:
+        g.db = current_app.extensions['db_pool'].get()
+    return g.db
+
+
+def close_db(e=None):
+    con = g.pop('db', None)
+    if con is not None:
+        current_app.extensions['db_pool'].put(con)
@@ -1,6 +1,7 @@
 from flask import redirect, session
 from functools import wraps
 import os
+import zlib
 
 def login_required(f):
     """
@@ -22,4 +23,38 @@ def allowed_file(filename, ALLOWED_EXTENSIONS):
     print(t)
     if t in ALLOWED_EXTENSIONS:
         return False # File type is allowed (now turnd off with False (all files are allowed)) can be turnd on with True
-    return False
\ No newline at end of file
+    return False
+
+def write_chunk(path, stream, offset=0, limit=None, block_size=1024 * 1024):
+    """
+    Write an uploaded chunk straight into the upload file on disk.
+
+    Chunks of one upload can be written at the same time, each one only
+    touches its own byte range.
+
+    Args:
+        path: file the whole upload is assembled in
+        stream: readable stream with the chunk data
+        offset: byte position of the chunk in the file
+        limit: most bytes read from the stream, None for all
+
+    Returns:
+        tuple: (number of bytes written, CRC32 of the written data)
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    written = 0
+    crc = 0
+    try:
+        while limit is None or written < limit:
+            block = stream.read(block_size if limit is None else min(block_size, limit - written))
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+            view = memoryview(block)
+            while view:
+                n = os.pwrite(fd, view, offset + written)
+                view = view[n:]
+                written += n
+    finally:
+        os.close(fd)
+    return written, crc
@@ -0,0 +1,230 @@
+import os
+import shutil
+
+import blobs
+import db
+import metrics
+import pipeline
+import quota
+import video_helper
+from tomp4 import build_hls_ladder, probe_video, to_browser_mp4
+
+
+class IngestError(Exception):
+    """Upload could not be turned into a video, the message is shown to the user"""
+
+
+def process_upload(database, upload_folder, size_allowed, job):
+    """
+    Turn a fully received upload into a stored video.
+
+    Runs in a transcode worker process. The video only ever lives on disk: it
+    is converted (or kept as is) inside the job's work folder, probed there and
+    then moved into upload_folder with a rename.
+
+    Args:
+        database: path of the sqlite database
+        upload_folder: folder the finished videos are stored in
+        size_allowed: storage limit per user in bytes
+        job: dict with source_path, work_dir, filename, video_name,
+             description, group and user_id, optionally digest,
+             pipeline_dir (see pipeline.py) and reserved (see quota.py)
+
+    Returns:
+        int: id of the inserted video
+    """
+    work_dir = job['work_dir']
+    try:
+        return _process_upload(database, upload_folder, size_allowed, job)
+    except Exception:
+        # the video was not stored, give back the space held for it
+        con = db.connect(database)
+        try:
+            quota.release(con.cursor(), job['user_id'], job.get('reserved', 0))
+            con.commit()
+        finally:
+            con.close()
+        raise
+    finally:
+        # Clean up whatever is left of the upload (part file, failed conversions)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if job.get('pipeline_dir'):
+            # also stops a pipelined conversion that is not needed any more
+            shutil.rmtree(job['pipeline_dir'], ignore_errors=True)
+        # worker processes have no flush thread
+        try:
+            metrics.flush()
+        except OSError as e:
+            print(f"Could not write metrics: {e}")
+
+
+def _process_upload(database, upload_folder, size_allowed, job):
+    source_path = job['source_path']
+    user_id = job['user_id']
+    # identical uploads share their files (see blobs.py), the upload is read
+    # once here instead of in the requests (jobs queued before have a digest)
+    digest = job.get('digest') or blobs.file_digest(source_path)
+
+    # somebody already uploaded the same file, use its converted video, picture and renditions
+    video_id = _store(database, upload_folder, size_allowed, job, digest)
+    if video_id is not None:
+        print(f"Upload is a duplicate of {digest}, not converting")
+        return video_id
+
+    blob, files = _convert(upload_folder, job, digest)
+    return _store(database, upload_folder, size_allowed, job, digest, blob, files)
+
+
+def _store(database, upload_folder, size_allowed, job, digest, blob=None, files=()):
+    """
+    Add the video of an upload, to the stored blob of digest if there is one.
+
+    Otherwise the converted blob is added and its files are moved into
+    upload_folder. Everything happens under the write lock the sweeper
+    takes, so it can't delete the blob between finding it and adding the
+    video, or the files between the move and the commit.
+
+    Returns:
+        int: id of the inserted video, None if nothing is stored under
+             digest and no blob was given
+    """
+    con = db.connect(database)
+    try:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            existing = blobs.find(cur, digest)
+            if existing is not None:
+                # a duplicate, or the same file was converted by another job in the meantime
+                # (ours is thrown away with work_dir)
+                video_id = _add_video(cur, size_allowed, job, existing)
+            elif blob is None:
+                video_id = None
+            else:
+                blobs.add(cur, blob)
+                video_id = _add_video(cur, size_allowed, job, blob)
+                _move_files(upload_folder, files)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    finally:
+        con.close()
+
+    return video_id
+
+
+def _move_files(upload_folder, files):
+    """
+    Move converted files into place (same filesystem, so a rename and not a copy).
+
+    No blob uses these paths, whatever is there belongs to a deleted video
+    with the same content that the sweeper didn't get to yet (blobs.add()
+    took away its tombstones), so it is replaced.
+    """
+    # create folder if it doesent exist
+    os.makedirs(upload_folder, exist_ok=True)
+    for path, final_path in files:
+        if not os.path.exists(path):
+            continue
+        if os.path.isdir(final_path):
+            # os.replace() can't replace a folder that isn't empty (HLS renditions)
+            shutil.rmtree(final_path)
+        os.replace(path, final_path)
+
+
+def _convert(upload_folder, job, digest):
+    """
+    Convert the upload and make its picture, thumbnails and renditions in work_dir.
+
+    Returns:
+        tuple: (blob dict for blobs.add(), list of (work path, final path) to move)
+    """
+    source_path = job['source_path']
+    work_dir = job['work_dir']
+
+    # get file type
+    filetype = job['filename'].split('.')[-1].lower()
+
+    # Everything about the video in one probe, the file is never opened again for it
+    probe = probe_video(source_path)
+    if probe is None:
+        raise IngestError("File is not a video.")
+    print(f"Probed video: {probe}")
+
+    video_path = os.path.join(work_dir, 'video.mp4')
+    if job.get('pipeline_dir') and pipeline.wait(job['pipeline_dir'], video_path, probe['duration']):
+        # converted while it was uploaded
+        route = 'transcode'
+    else:
+        # remux or keep browser playable videos, encode only what is needed
+        route = to_browser_mp4(source_path, video_path, probe)
+    if route is None:
+        raise IngestError("File conversion failed.")
+    if route == 'transcode':
+        # codec, bitrate and pixel format changed
+        probe = probe_video(video_path) or probe
+    source_path = video_path
+    print(f"Video ready ({route}): {video_path}")
+
+    # Create picture (next to the video, it is moved together with it)
+    video_helper.select_thumbnail(source_path, duration=probe['duration'])
+    picture_path = os.path.splitext(source_path)[0] + ".jpg"
+    # Thumbnails for the search results (WebP and JPEG in several widths)
+    video_helper.make_thumbnails(picture_path)
+
+    # Video size
+    file_size = os.path.getsize(source_path)
+    print(f"File size: {file_size}")
+
+    # HLS renditions for adaptive streaming, the mp4 stays as fallback
+    hls_work_dir = os.path.join(work_dir, 'hls')
+    if build_hls_ladder(source_path, hls_work_dir, probe=probe) is None:
+        print("HLS renditions not created, video will be played from mp4 only")
+
+    # files are named after the content, so every video with it uses the same ones
+    file_path = os.path.join(upload_folder, f"{digest}.mp4")
+    image_path = f"{upload_folder}{digest}.jpg"
+    print(f"File path: {file_path}")
+
+    files = [(source_path, file_path), (picture_path, image_path)]
+    files += zip(video_helper.thumbnail_paths(picture_path), video_helper.thumbnail_paths(image_path))
+    files.append((hls_work_dir, video_helper.hls_dir(file_path)))
+
+    blob = {
+        'digest': digest,
+        'filepath': file_path,
+        'image_path': image_path,
+        'filetype': filetype,
+        'time': probe['duration'],
+        'file_size': file_size,
+        'width': probe['width'],
+        'height': probe['height'],
+        'codec': probe['codec'],
+        'bitrate': probe['bitrate'],
+        'fps': probe['fps'],
+        'rotation': probe['rotation'],
+    }
+    return blob, files
+
+
+def _add_video(cur, size_allowed, job, blob):
+    """Insert the videos row pointing at blob and return its id (not committed)"""
+    user_id = job['user_id']
+
+    # the file's details are copied from the blob, so pages never have to look at the file
+    # (triggers add the size to users.size, unless the user already has this file)
+    cur.execute(f"INSERT INTO `videos` (`name`, `user_id`, `description`, `group_id`, `blob_digest`, {', '.join(blobs.VIDEO_COLUMNS)}) VALUES (?, ?, ?, ?, ?, {', '.join('?' * len(blobs.VIDEO_COLUMNS))})"
+                , (job['video_name'], user_id, job['description'], job['group'], blob['digest']) + tuple(blob[column] for column in blobs.VIDEO_COLUMNS))
+    video_id = cur.lastrowid
+
+    # the space held for the upload is replaced by the size of the stored video,
+    # which can be bigger than the upload (nothing is written if this fails)
+    quota.release(cur, user_id, job.get('reserved', 0))
+    used = quota.used(cur, user_id)
+    if used > size_allowed:
+        error = quota.limit_message(size_allowed, used - blob['file_size'])
+        print(error)
+        raise IngestError(error)
+
+    return video_id
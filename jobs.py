@@ -0,0 +1,255 @@
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from time import time as nowtime
+
+import db
+import metrics
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# A job whose worker process died this many times (killed, out of memory) fails
+MAX_CRASHES = 2
+
+
+def default_workers():
+    """Number of cores this process may run on (respects container cpu sets)"""
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return max(1, os.cpu_count() or 1)
+
+
+class JobQueue:
+    """
+    Queue of transcode jobs stored in the jobs table and run by a bounded pool
+    of worker processes.
+
+    A dispatcher thread hands queued jobs to the pool whenever a worker is
+    free. The next job always comes from the user with the fewest running
+    jobs, so one user uploading many videos can't starve everybody else.
+    When a worker process dies the pool is made again and its jobs are
+    queued again, a job that loses its worker MAX_CRASHES times fails.
+    """
+
+    def __init__(self, database, worker, max_workers=None, poll_interval=1.0, on_done=None):
+        """
+        Args:
+            database: path of the sqlite database
+            worker: picklable function called as worker(payload) in a worker
+                    process, returns the id of the created video
+            max_workers: size of the process pool, defaults to available cores
+            on_done: called as on_done(payload, video_id) in this process
+                     after a job succeeded
+        """
+        self.database = database
+        self.worker = worker
+        self.max_workers = max_workers or default_workers()
+        self.poll_interval = poll_interval
+        self.on_done = on_done
+        self.running = 0
+        self.wakeup = threading.Condition()
+        self.pool = None
+        # set when a worker process died, the dispatcher makes a new pool
+        self.broken = False
+        # times the worker of a job died, per job id
+        self.crashes = {}
+        self.thread = None
+        self.stopping = False
+
+    def start(self):
+        """Start the worker pool and the dispatcher thread"""
+        con = db.connect(self.database)
+        # jobs that were running when the server stopped are started again
+        con.execute("UPDATE jobs SET state = ?, started_at = NULL WHERE state = ?", (QUEUED, RUNNING))
+        con.commit()
+        con.close()
+
+        self.pool = self._new_pool()
+        self.thread = threading.Thread(target=self._dispatch, name='job-dispatcher', daemon=True)
+        self.thread.start()
+        print(f"Transcode queue started with {self.max_workers} workers")
+
+    def stop(self, timeout=None):
+        """
+        Stop taking jobs and wait for the running ones to finish.
+
+        Args:
+            timeout: longest wait in seconds, None waits as long as it takes
+
+        Returns:
+            bool: True if every running job finished, False if some are still
+                  running (they are started again by the next start())
+        """
+        deadline = nowtime() + timeout if timeout is not None else None
+        with self.wakeup:
+            self.stopping = True
+            self.wakeup.notify_all()
+            while self.running > 0:
+                left = deadline - nowtime() if deadline is not None else None
+                if left is not None and left <= 0:
+                    break
+                self.wakeup.wait(left)
+            drained = self.running == 0
+        if self.pool is not None:
+            self.pool.shutdown(wait=drained, cancel_futures=True)
+        print(f"Transcode queue stopped ({'drained' if drained else f'{self.running} jobs still running'})")
+        return drained
+
+    def _new_pool(self):
+        # fork, so the workers don't import the web application again
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('fork'))
+
+    def _submit(self, payload):
+        """Hand a job to the pool, a new one if a worker process died"""
+        with self.wakeup:
+            if self.broken:
+                # the jobs of the old pool were given back by _finished()
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = self._new_pool()
+                self.broken = False
+                print("Transcode worker pool started again")
+            pool = self.pool
+        return pool.submit(self.worker, payload)
+
+    def _requeue(self, con, job_id):
+        con.execute("UPDATE jobs SET state = ?, started_at = NULL WHERE id = ?", (QUEUED, job_id))
+        con.commit()
+
+    def enqueue(self, con, user_id, payload):
+        """Add a job to the queue and return its id"""
+        cur = con.cursor()
+        cur.execute("INSERT INTO jobs (user_id, state, payload, created_at) VALUES (?, ?, ?, ?)",
+                    (user_id, QUEUED, json.dumps(payload), nowtime()))
+        con.commit()
+        with self.wakeup:
+            self.wakeup.notify()
+        return cur.lastrowid
+
+    def get(self, con, job_id):
+        """Return the status of a job as a dict, None if it doesn't exist"""
+        cur = con.cursor()
+        cur.execute("SELECT id, user_id, state, video_id, error, created_at, started_at, finished_at FROM jobs WHERE id = ?", (job_id,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        job = dict(zip(('id', 'user_id', 'state', 'video_id', 'error', 'created_at', 'started_at', 'finished_at'), row))
+        if job['state'] == QUEUED:
+            cur.execute("SELECT COUNT(*) FROM jobs WHERE state = ? AND id < ?", (QUEUED, job_id))
+            job['position'] = cur.fetchone()[0]
+        return job
+
+    def _claim(self, con):
+        """Mark the next job as running and return it, None if the queue is empty"""
+        cur = con.cursor()
+        cur.execute("""
+            SELECT j.id, j.payload
+            FROM jobs j
+            WHERE j.state = 'queued'
+            ORDER BY (SELECT COUNT(*) FROM jobs r WHERE r.user_id = j.user_id AND r.state = 'running'), j.id
+            LIMIT 1
+        """)
+        row = cur.fetchone()
+        if row is None:
+            return None
+        cur.execute("UPDATE jobs SET state = ?, started_at = ? WHERE id = ? AND state = ?", (RUNNING, nowtime(), row[0], QUEUED))
+        con.commit()
+        if cur.rowcount != 1:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _dispatch(self):
+        con = db.connect(self.database)
+        while True:
+            with self.wakeup:
+                while self.running >= self.max_workers and not self.stopping:
+                    self.wakeup.wait()
+                if self.stopping:
+                    break
+            try:
+                job = self._claim(con)
+            except sqlite3.Error:
+                traceback.print_exc()
+                job = None
+            if job is None:
+                with self.wakeup:
+                    self.wakeup.wait(self.poll_interval)
+                continue
+
+            job_id, payload = job
+            with self.wakeup:
+                if self.stopping:
+                    # claimed while stopping, leave it to the next start()
+                    self._requeue(con, job_id)
+                    break
+                self.running += 1
+            print(f"Starting job {job_id}")
+            try:
+                future = self._submit(payload)
+            except BrokenProcessPool:
+                # a worker died before _finished() of its job noticed, try again with a new pool
+                print(f"Transcode worker pool is broken, queueing job {job_id} again")
+                self._requeue(con, job_id)
+                with self.wakeup:
+                    self.broken = True
+                    self.running -= 1
+                continue
+            future.add_done_callback(lambda f, job_id=job_id, payload=payload: self._finished(job_id, payload, f))
+        con.close()
+
+    def _finished(self, job_id, payload, future):
+        error = None
+        video_id = None
+        try:
+            video_id = future.result()
+        except BrokenProcessPool:
+            # a worker process died, every job running in the pool is lost with it
+            with self.wakeup:
+                self.broken = True
+                crashes = self.crashes[job_id] = self.crashes.get(job_id, 0) + 1
+            if crashes < MAX_CRASHES:
+                print(f"Job {job_id} lost its worker process, queueing it again")
+                con = db.connect(self.database)
+                try:
+                    self._requeue(con, job_id)
+                finally:
+                    con.close()
+                with self.wakeup:
+                    self.running -= 1
+                    self.wakeup.notify()
+                return
+            error = "The conversion process died (out of memory?)."
+            print(f"Job {job_id} failed: {error}")
+        except Exception as e:
+            error = str(e)
+            print(f"Job {job_id} failed: {error}")
+
+        with self.wakeup:
+            self.crashes.pop(job_id, None)
+        metrics.JOBS.inc(FAILED if error is not None else DONE)
+        con = db.connect(self.database)
+        try:
+            con.execute("UPDATE jobs SET state = ?, video_id = ?, error = ?, finished_at = ? WHERE id = ?",
+                        (FAILED if error is not None else DONE, video_id, error, nowtime(), job_id))
+            con.commit()
+        finally:
+            con.close()
+        print(f"Finished job {job_id}")
+
+        if error is None and self.on_done is not None:
+            try:
+                self.on_done(payload, video_id)
+            except Exception:
+                traceback.print_exc()
+
+        with self.wakeup:
+            self.running -= 1
+            self.wakeup.notify()
@@ -0,0 +1,320 @@
+import atexit
+import bisect
+import fcntl
+import functools
+import json
+import os
+import re
+import shutil
+import threading
+import traceback
+import uuid
+from time import perf_counter, sleep
+
+# Folder every process writes its counters to, /metrics adds them up
+METRICS_DIR = os.environ.get('METRICS_DIR', 'data/metrics/')
+# How often (in seconds) a process writes its counters
+FLUSH_INTERVAL = 10
+# Counters of exited processes, added up in one file
+DEAD_FILE = 'dead.json'
+
+# Histogram buckets (upper bounds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+CONVERT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+THROUGHPUT_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+# Every metric, in the order they are printed
+_metrics = []
+
+
+def _new_file_name():
+    # pids are reused, the random part keeps a new process from overwriting an old one's file
+    return f"{os.getpid()}-{uuid.uuid4().hex[:12]}.json"
+
+
+# File this process writes its counters to
+_file_name = _new_file_name()
+
+
+class Counter:
+    """Value per label combination that only goes up"""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+
+
+class Histogram(Counter):
+    """Observations per label combination counted into buckets, with their sum"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        # bucket counts (not cumulative), then +Inf, sum and count
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 3)
+            counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(labels), list(counts)] for labels, counts in self.values.items()]
+
+
+REQUESTS = Counter('danceshare_http_requests_total', "HTTP requests", ('endpoint', 'method', 'status'))
+REQUEST_SECONDS = Histogram('danceshare_http_request_duration_seconds', "Time to build the response",
+                            ('endpoint', 'method'))
+QUERY_SECONDS = Histogram('danceshare_sql_query_duration_seconds', "Time of SQLite statements by verb and table",
+                          ('statement',), QUERY_BUCKETS)
+UPLOAD_BYTES = Counter('danceshare_upload_bytes_total', "Bytes of upload chunks written")
+CHUNK_THROUGHPUT = Histogram('danceshare_upload_chunk_bytes_per_second', "Speed upload chunks are received and written at",
+                             buckets=THROUGHPUT_BUCKETS)
+CONVERT_SECONDS = Histogram('danceshare_convert_duration_seconds', "Time of convert_to_mp4()", ('outcome',), CONVERT_BUCKETS)
+THUMBNAIL_SECONDS = Histogram('danceshare_select_thumbnail_duration_seconds',
+                              "Time of select_thumbnail() (picking the picture of a video)", ('outcome',))
+JOBS = Counter('danceshare_transcode_jobs_total', "Finished transcode jobs", ('state',))
+
+
+def timed(histogram):
+    """
+    Decorator observing the run time of a function in histogram, labeled with
+    its outcome: "ok", "failed" (returned None or False) or "error" (raised).
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            outcome = 'error'
+            try:
+                result = function(*args, **kwargs)
+                outcome = 'failed' if result is None or result is False else 'ok'
+                return result
+            finally:
+                histogram.observe(perf_counter() - start, outcome)
+        return wrapper
+    return decorator
+
+
+@functools.lru_cache(maxsize=1024)
+def statement(sql):
+    """Label of a query, its verb and first table ("select videos"), so the label count stays small"""
+    words = sql.split(None, 1)
+    if not words:
+        return 'empty'
+    verb = words[0].lower()
+    table = re.search(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+([A-Za-z_]\w*)', sql, re.IGNORECASE)
+    return f"{verb} {table.group(1).lower()}" if table else verb
+
+
+def reset():
+    """Start from zero in a file of its own (a forked process must not count its parent's numbers again)"""
+    global _file_name
+    _file_name = _new_file_name()
+    for metric in _metrics:
+        metric.reset()
+
+
+os.register_at_fork(after_in_child=reset)
+
+
+def clear_dir(folder=METRICS_DIR):
+    """Forget the counters of earlier runs, call once before starting the processes"""
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def flush(folder=METRICS_DIR):
+    """Write the counters of this process to folder, replacing its last file"""
+    data = {metric.name: metric.snapshot() for metric in _metrics}
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, _file_name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+def start_flusher(folder=METRICS_DIR, interval=FLUSH_INTERVAL):
+    """Flush the counters of this process every interval seconds (and on exit), in a thread"""
+    atexit.register(flush, folder)
+
+    def run():
+        while True:
+            sleep(interval)
+            try:
+                flush(folder)
+            except Exception:
+                traceback.print_exc()
+
+    thread = threading.Thread(target=run, name='metrics-flush', daemon=True)
+    thread.start()
+    return thread
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _add(totals, data):
+    """Add the rows of a written file to totals"""
+    for metric_name, rows in data.items():
+        values = totals.setdefault(metric_name, {})
+        for labels, value in rows:
+            labels = tuple(labels)
+            if isinstance(value, list):
+                old = values.get(labels)
+                values[labels] = value if old is None else [a + b for a, b in zip(old, value)]
+            else:
+                values[labels] = values.get(labels, 0) + value
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def compact(folder=METRICS_DIR):
+    """
+    Add the files of processes that exited (recycled web workers, old
+    transcoders) to DEAD_FILE and delete them, so the folder doesn't grow.
+
+    A file is dead when its process is gone, or when its pid was reused
+    and a newer file has it.
+
+    Returns:
+        int: number of merged files
+    """
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, '.lock'), 'w') as lock:
+        # one scrape at a time, or a file could be added twice
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        by_pid = {}
+        for name in os.listdir(folder):
+            if not name.endswith('.json') or name == DEAD_FILE:
+                continue
+            try:
+                pid = int(name.split('-', 1)[0])
+                mtime = os.stat(os.path.join(folder, name)).st_mtime
+            except (ValueError, OSError):
+                continue
+            by_pid.setdefault(pid, []).append((mtime, name))
+
+        dead = []
+        for pid, files in by_pid.items():
+            files.sort()
+            dead += [name for _, name in (files[:-1] if _alive(pid) else files)]
+        if not dead:
+            return 0
+
+        dead_path = os.path.join(folder, DEAD_FILE)
+        totals = {}
+        _add(totals, _read(dead_path) or {})
+        merged = []
+        for name in dead:
+            data = _read(os.path.join(folder, name))
+            if data is not None:
+                _add(totals, data)
+                merged.append(name)
+        data = {name: [[list(labels), value] for labels, value in values.items()] for name, values in totals.items()}
+        with open(dead_path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(dead_path + '.tmp', dead_path)
+        for name in merged:
+            os.remove(os.path.join(folder, name))
+        return len(merged)
+
+
+def collect(folder=METRICS_DIR):
+    """
+    Add up the counters every process wrote to folder.
+
+    Files of processes that exited are first merged into DEAD_FILE, their
+    counts still belong to the totals.
+
+    Returns:
+        dict: {metric name: {labels tuple: value or bucket counts}}
+    """
+    totals = {metric.name: {} for metric in _metrics}
+    if not os.path.isdir(folder):
+        return totals
+    compact(folder)
+    for name in os.listdir(folder):
+        if name.endswith('.json'):
+            # None while being replaced
+            _add(totals, _read(os.path.join(folder, name)) or {})
+    return totals
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, le=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render(totals, gauges=()):
+    """
+    Prometheus text format of the added up counters.
+
+    Args:
+        totals: from collect()
+        gauges: (name, help, {((label, value), ...): value}) measured right now
+    """
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for labels, value in sorted(totals.get(metric.name, {}).items()):
+            if metric.type == 'counter':
+                lines.append(f"{metric.name}{_labels(metric.labels, labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ('+Inf',), value):
+                cumulative += count
+                lines.append(f"{metric.name}_bucket{_labels(metric.labels, labels, bound)} {cumulative}")
+            lines.append(f"{metric.name}_sum{_labels(metric.labels, labels)} {value[-2]}")
+            lines.append(f"{metric.name}_count{_labels(metric.labels, labels)} {value[-1]}")
+    for name, help, values in gauges:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in values.items():
+            lines.append(f"{name}{_labels([k for k, _ in labels], [v for _, v in labels])} {value}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,540 @@
+import os
+import sqlite3
+
+# Schema versions, applied in order. The version of a database is kept in
+# PRAGMA user_version, so every migration runs exactly once per database.
+# Never change a migration that was released, add a new one instead.
+MIGRATIONS = [
+    (1, "base schema", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            hash TEXT NOT NULL,
+            size INTEGER
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT,
+            creator_id INTEGER NOT NULL,
+            created_at INTEGER NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            public BOOLEAN NOT NULL DEFAULT FALSE,
+            hash TEXT DEFAULT NULL,
+            FOREIGN KEY (creator_id) REFERENCES users (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS group_members (
+            group_id INTEGER,
+            user_id INTEGER,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            role TEXT DEFAULT "member",
+            PRIMARY KEY (group_id, user_id),
+            FOREIGN KEY (group_id) REFERENCES groups (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS videos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            filepath TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            image_path TEXT,
+            filetype TEXT NOT NULL,
+            description TEXT,
+            group_id INTEGER,
+            time INTEGER,
+            file_size INTEGER DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'queued',
+            payload TEXT NOT NULL,
+            video_id INTEGER,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+    ]),
+    (2, "indexes for the common lookups", [
+        # videos of a user and the quota SUM(file_size) (covering)
+        "CREATE INDEX IF NOT EXISTS videos_user_id ON videos (user_id, file_size)",
+        # videos of a group, by name
+        "CREATE INDEX IF NOT EXISTS videos_group_id ON videos (group_id, name)",
+        # groups of a user (the primary key starts with group_id)
+        "CREATE INDEX IF NOT EXISTS group_members_user_id ON group_members (user_id, group_id)",
+        # group name check in create-group
+        "CREATE INDEX IF NOT EXISTS groups_name ON groups (name)",
+        # next job for the dispatcher
+        "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, user_id)",
+    ]),
+    (3, "foreign keys with ON DELETE CASCADE", [
+        # SQLite can't change foreign keys of a table, so the tables are
+        # rebuilt. Rows pointing at deleted users or groups are left out
+        # (deleting those would have removed them with CASCADE).
+        '''
+        CREATE TABLE groups_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT,
+            creator_id INTEGER,
+            created_at INTEGER NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            public BOOLEAN NOT NULL DEFAULT FALSE,
+            hash TEXT DEFAULT NULL,
+            FOREIGN KEY (creator_id) REFERENCES users (id) ON DELETE SET NULL
+        )
+        ''',
+        '''
+        INSERT INTO groups_new (id, name, description, creator_id, created_at, public, hash)
+        SELECT id, name, description,
+               CASE WHEN creator_id IN (SELECT id FROM users) THEN creator_id END,
+               created_at, public, hash
+        FROM groups
+        ''',
+        "DROP TABLE groups",
+        "ALTER TABLE groups_new RENAME TO groups",
+        "CREATE INDEX groups_name ON groups (name)",
+        '''
+        CREATE TABLE group_members_new (
+            group_id INTEGER,
+            user_id INTEGER,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            role TEXT DEFAULT "member",
+            PRIMARY KEY (group_id, user_id),
+            FOREIGN KEY (group_id) REFERENCES groups (id) ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        INSERT INTO group_members_new (group_id, user_id, joined_at, role)
+        SELECT group_id, user_id, joined_at, role
+        FROM group_members
+        WHERE group_id IN (SELECT id FROM groups) AND user_id IN (SELECT id FROM users)
+        ''',
+        "DROP TABLE group_members",
+        "ALTER TABLE group_members_new RENAME TO group_members",
+        "CREATE INDEX group_members_user_id ON group_members (user_id, group_id)",
+        '''
+        CREATE TABLE videos_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            filepath TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            image_path TEXT,
+            filetype TEXT NOT NULL,
+            description TEXT,
+            group_id INTEGER,
+            time INTEGER,
+            file_size INTEGER DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            FOREIGN KEY (group_id) REFERENCES groups (id) ON DELETE CASCADE
+        )
+        ''',
+        # videos uploaded without a group have group_id 'None'
+        '''
+        INSERT INTO videos_new (id, name, filepath, user_id, image_path, filetype, description, group_id, time, file_size)
+        SELECT id, name, filepath, user_id, image_path, filetype, description,
+               CASE WHEN group_id IN (SELECT id FROM groups) THEN group_id END,
+               time, file_size
+        FROM videos
+        WHERE user_id IN (SELECT id FROM users)
+        ''',
+        "DROP TABLE videos",
+        "ALTER TABLE videos_new RENAME TO videos",
+        "CREATE INDEX videos_user_id ON videos (user_id, file_size)",
+        "CREATE INDEX videos_group_id ON videos (group_id, name)",
+        '''
+        CREATE TABLE jobs_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'queued',
+            payload TEXT NOT NULL,
+            video_id INTEGER,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        INSERT INTO jobs_new
+        SELECT id, user_id, state, payload, video_id, error, created_at, started_at, finished_at
+        FROM jobs
+        WHERE user_id IN (SELECT id FROM users)
+        ''',
+        "DROP TABLE jobs",
+        "ALTER TABLE jobs_new RENAME TO jobs",
+        "CREATE INDEX jobs_state ON jobs (state, user_id)",
+    ]),
+    (4, "full-text search on videos and groups", [
+        # Two indexes per table, both external content (the text is only
+        # stored in videos / groups): word prefixes for queries shorter than
+        # three characters and trigrams for substring and fuzzy matches.
+        '''
+        CREATE VIRTUAL TABLE videos_fts USING fts5(
+            name, description, content='videos', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='1 2')
+        ''',
+        '''
+        CREATE VIRTUAL TABLE videos_trgm USING fts5(
+            name, description, content='videos', content_rowid='id', tokenize='trigram')
+        ''',
+        '''
+        CREATE VIRTUAL TABLE groups_fts USING fts5(
+            name, description, content='groups', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='1 2')
+        ''',
+        '''
+        CREATE VIRTUAL TABLE groups_trgm USING fts5(
+            name, description, content='groups', content_rowid='id', tokenize='trigram')
+        ''',
+    ] + [
+        statement
+        for table in ("videos", "groups")
+        for index in (f"{table}_fts", f"{table}_trgm")
+        for statement in (
+            f'''
+            CREATE TRIGGER {index}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {index} (rowid, name, description) VALUES (new.id, new.name, new.description);
+            END
+            ''',
+            f'''
+            CREATE TRIGGER {index}_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {index} ({index}, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+            END
+            ''',
+            f'''
+            CREATE TRIGGER {index}_update AFTER UPDATE OF name, description ON {table} BEGIN
+                INSERT INTO {index} ({index}, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+                INSERT INTO {index} (rowid, name, description) VALUES (new.id, new.name, new.description);
+            END
+            ''',
+            f"INSERT INTO {index} ({index}) VALUES ('rebuild')",
+        )
+    ]),
+    (5, "resumable upload sessions", [
+        '''
+        CREATE TABLE upload_sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            video_name TEXT NOT NULL,
+            description TEXT,
+            group_id INTEGER NOT NULL,
+            file_size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            total_chunks INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            FOREIGN KEY (group_id) REFERENCES groups (id) ON DELETE CASCADE
+        )
+        ''',
+        "CREATE INDEX upload_sessions_user_id ON upload_sessions (user_id)",
+        # one row per received chunk (chunks arrive in parallel and in any order)
+        '''
+        CREATE TABLE upload_chunks (
+            upload_id TEXT NOT NULL,
+            chunk_number INTEGER NOT NULL,
+            crc32 INTEGER NOT NULL,
+            PRIMARY KEY (upload_id, chunk_number),
+            FOREIGN KEY (upload_id) REFERENCES upload_sessions (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (6, "content-addressed video files", [
+        # Stored files keyed by the hash of the uploaded bytes, shared by all
+        # videos with the same content. refcount is kept by the triggers below
+        # (they also run for ON DELETE CASCADE).
+        '''
+        CREATE TABLE blobs (
+            digest TEXT PRIMARY KEY,
+            filepath TEXT NOT NULL,
+            image_path TEXT,
+            filetype TEXT NOT NULL,
+            time INTEGER,
+            file_size INTEGER DEFAULT 0,
+            refcount INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        "ALTER TABLE videos ADD COLUMN blob_digest TEXT REFERENCES blobs (digest)",
+        # existing videos get a blob each (their original bytes are gone, so no real hash)
+        '''
+        INSERT INTO blobs (digest, filepath, image_path, filetype, time, file_size, refcount)
+        SELECT 'video:' || id, filepath, image_path, filetype, time, file_size, 1 FROM videos
+        ''',
+        "UPDATE videos SET blob_digest = 'video:' || id",
+        "CREATE INDEX videos_blob_digest ON videos (blob_digest)",
+        '''
+        CREATE TRIGGER blobs_ref AFTER INSERT ON videos WHEN new.blob_digest IS NOT NULL BEGIN
+            UPDATE blobs SET refcount = refcount + 1 WHERE digest = new.blob_digest;
+        END
+        ''',
+        '''
+        CREATE TRIGGER blobs_unref AFTER DELETE ON videos WHEN old.blob_digest IS NOT NULL BEGIN
+            UPDATE blobs SET refcount = refcount - 1 WHERE digest = old.blob_digest;
+        END
+        ''',
+        '''
+        CREATE TRIGGER blobs_reref AFTER UPDATE OF blob_digest ON videos BEGIN
+            UPDATE blobs SET refcount = refcount - 1 WHERE digest = old.blob_digest;
+            UPDATE blobs SET refcount = refcount + 1 WHERE digest = new.blob_digest;
+        END
+        ''',
+    ]),
+    (7, "probed video details", [
+        # filled from one ffprobe run on upload (videos.time is the duration),
+        # NULL for videos uploaded before
+        f"ALTER TABLE {table} ADD COLUMN {column}"
+        for table in ("blobs", "videos")
+        for column in ("width INTEGER", "height INTEGER", "codec TEXT", "bitrate INTEGER", "fps REAL", "rotation INTEGER")
+    ]),
+    (8, "pipelined conversion of uploads", [
+        # folder of the FFmpeg process converting the upload while it comes in,
+        # '' if it is converted after the upload, NULL while not decided
+        "ALTER TABLE upload_sessions ADD COLUMN pipeline_dir TEXT",
+    ]),
+    (9, "quota counters", [
+        # users.size is the space the user's files take (each file once),
+        # users.reserved the space held for uploads that are not stored yet
+        # (see quota.py)
+        "ALTER TABLE users ADD COLUMN reserved INTEGER NOT NULL DEFAULT 0",
+        "DROP INDEX videos_user_id",
+        "CREATE INDEX videos_user_id ON videos (user_id, blob_digest, file_size)",
+        '''
+        UPDATE users SET size = (
+            SELECT COALESCE(SUM(v.file_size), 0)
+            FROM videos v
+            WHERE v.user_id = users.id
+              AND v.id = (SELECT MIN(w.id) FROM videos w WHERE w.user_id = v.user_id AND w.blob_digest IS v.blob_digest)
+        )
+        ''',
+        "UPDATE users SET reserved = (SELECT COALESCE(SUM(file_size), 0) FROM upload_sessions WHERE user_id = users.id)",
+        # the first video of a user with a file adds it, the last one removes it
+        # (also for videos deleted with their group)
+        '''
+        CREATE TRIGGER users_size_add AFTER INSERT ON videos
+        WHEN NOT EXISTS (SELECT 1 FROM videos WHERE user_id = new.user_id AND blob_digest IS new.blob_digest AND id != new.id) BEGIN
+            UPDATE users SET size = COALESCE(size, 0) + COALESCE(new.file_size, 0) WHERE id = new.user_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER users_size_remove AFTER DELETE ON videos
+        WHEN NOT EXISTS (SELECT 1 FROM videos WHERE user_id = old.user_id AND blob_digest IS old.blob_digest) BEGIN
+            UPDATE users SET size = COALESCE(size, 0) - COALESCE(old.file_size, 0) WHERE id = old.user_id;
+        END
+        ''',
+    ]),
+    (10, "file tombstones", [
+        # Files to delete from disk, removed in the background by sweeper.py.
+        # kind is 'video' (with its HLS renditions), 'picture' (with its
+        # thumbnails) or 'file' (found in the upload folder without a blob)
+        '''
+        CREATE TABLE file_tombstones (
+            path TEXT PRIMARY KEY,
+            kind TEXT NOT NULL DEFAULT 'file',
+            deleted_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+        ) WITHOUT ROWID
+        ''',
+        # a blob nobody points at is deleted in the same transaction as its last video
+        '''
+        CREATE TRIGGER blobs_free AFTER UPDATE OF refcount ON blobs WHEN new.refcount <= 0 BEGIN
+            DELETE FROM blobs WHERE digest = new.digest;
+        END
+        ''',
+        '''
+        CREATE TRIGGER blobs_tombstone AFTER DELETE ON blobs BEGIN
+            INSERT OR REPLACE INTO file_tombstones (path, kind) VALUES (old.filepath, 'video');
+            INSERT OR REPLACE INTO file_tombstones (path, kind) SELECT old.image_path, 'picture' WHERE old.image_path IS NOT NULL;
+        END
+        ''',
+        # the same file uploaded again before the sweeper got to it
+        '''
+        CREATE TRIGGER blobs_untombstone AFTER INSERT ON blobs BEGIN
+            DELETE FROM file_tombstones WHERE path IN (new.filepath, new.image_path);
+        END
+        ''',
+        "DELETE FROM blobs WHERE refcount <= 0",
+    ]),
+    (11, "server-side sessions", [
+        # see session_store.py, data is Flask's tagged JSON
+        '''
+        CREATE TABLE sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX sessions_expires_at ON sessions (expires_at)",
+    ]),
+    (12, "claimed upload chunks", [
+        # set while a request writes the chunk, NULL once it is received (see uploads.put_chunk())
+        "ALTER TABLE upload_chunks ADD COLUMN writing_since REAL",
+    ]),
+    (13, "password failures", [
+        # wrong passwords per IP address and account or group (see passwords.Throttle)
+        '''
+        CREATE TABLE password_failures (
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            at REAL NOT NULL
+        )
+        ''',
+        "CREATE INDEX password_failures_key ON password_failures (scope, key, at)",
+    ]),
+    (14, "cache versions of users", [
+        # Bumped by the triggers below whenever something cached per user
+        # changes, so every process sees it (see authz.AuthzCache).
+        # kind 'user': the groups a user is a member of or created
+        '''
+        CREATE TABLE cache_versions (
+            kind TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (kind, id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TRIGGER cache_member_insert AFTER INSERT ON group_members BEGIN
+            INSERT INTO cache_versions (kind, id, version) VALUES ('user', new.user_id, 1)
+            ON CONFLICT (kind, id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER cache_member_delete AFTER DELETE ON group_members BEGIN
+            INSERT INTO cache_versions (kind, id, version) VALUES ('user', old.user_id, 1)
+            ON CONFLICT (kind, id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER cache_group_insert AFTER INSERT ON groups WHEN new.creator_id IS NOT NULL BEGIN
+            INSERT INTO cache_versions (kind, id, version) VALUES ('user', new.creator_id, 1)
+            ON CONFLICT (kind, id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        # members see the group name in their group lists
+        '''
+        CREATE TRIGGER cache_group_update AFTER UPDATE OF name, creator_id ON groups BEGIN
+            INSERT INTO cache_versions (kind, id, version)
+            SELECT 'user', user_id, 1 FROM (
+                SELECT user_id FROM group_members WHERE group_id = new.id
+                UNION SELECT old.creator_id UNION SELECT new.creator_id
+            ) WHERE user_id IS NOT NULL
+            ON CONFLICT (kind, id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        # the memberships are deleted by ON DELETE CASCADE, which runs cache_member_delete
+        '''
+        CREATE TRIGGER cache_group_delete AFTER DELETE ON groups WHEN old.creator_id IS NOT NULL BEGIN
+            INSERT INTO cache_versions (kind, id, version) VALUES ('user', old.creator_id, 1)
+            ON CONFLICT (kind, id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+    ]),
+    (15, "cache versions of groups", [
+        # kind 'group': the videos of a group and its name, kind 'groups'
+        # (id 0): the list of groups (see cache.versions())
+        '''
+        CREATE TRIGGER cache_video_insert AFTER INSERT ON videos WHEN new.group_id IS NOT NULL BEGIN
+            INSERT INTO cache_versions (kind, id, version) VALUES ('group', new.group_id, 1)
+            ON CONFLICT (kind, id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER cache_video_delete AFTER DELETE ON videos WHEN old.group_id IS NOT NULL BEGIN
+            INSERT INTO cache_versions (kind, id, version) VALUES ('group', old.group_id, 1)
+            ON CONFLICT (kind, id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER cache_video_update AFTER UPDATE ON videos BEGIN
+            INSERT INTO cache_versions (kind, id, version)
+            SELECT 'group', group_id, 1 FROM (SELECT old.group_id AS group_id UNION SELECT new.group_id)
+            WHERE group_id IS NOT NULL
+            ON CONFLICT (kind, id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER cache_groups_insert AFTER INSERT ON groups BEGIN
+            INSERT INTO cache_versions (kind, id, version) VALUES ('groups', 0, 1)
+            ON CONFLICT (kind, id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER cache_groups_update AFTER UPDATE ON groups BEGIN
+            INSERT INTO cache_versions (kind, id, version) VALUES ('group', new.id, 1), ('groups', 0, 1)
+            ON CONFLICT (kind, id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER cache_groups_delete AFTER DELETE ON groups BEGIN
+            INSERT INTO cache_versions (kind, id, version) VALUES ('group', old.id, 1), ('groups', 0, 1)
+            ON CONFLICT (kind, id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+    ]),
+]
+
+# From this version on the data satisfies all foreign keys (older databases
+# may still have rows pointing at deleted users or groups)
+FOREIGN_KEYS_VERSION = 3
+
+
+def schema_version(con):
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(database, migrations=MIGRATIONS):
+    '''
+    Create the database or upgrade it in place to the newest schema version.
+
+    Each migration runs in its own transaction together with the version
+    bump, so a failed migration leaves the database at the previous version.
+    Safe to call from several processes at once.
+    '''
+    os.makedirs(os.path.dirname(database) or '.', exist_ok=True)
+    # autocommit mode, transactions are started by hand
+    con = sqlite3.connect(database, timeout=30, isolation_level=None)
+    try:
+        con.execute("PRAGMA journal_mode = WAL")
+        # tables are rebuilt, so foreign keys are checked once at the end of each migration
+        con.execute("PRAGMA foreign_keys = OFF")
+        for version, description, statements in migrations:
+            if version <= schema_version(con):
+                continue
+
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                # another process may have migrated while we waited for the lock
+                if version <= schema_version(con):
+                    con.execute("ROLLBACK")
+                    continue
+
+                print(f"Migrating database to version {version}: {description}")
+                for statement in statements:
+                    con.execute(statement)
+
+                problems = con.execute("PRAGMA foreign_key_check").fetchall() if version >= FOREIGN_KEYS_VERSION else []
+                if problems:
+                    raise sqlite3.IntegrityError(f"Foreign key check failed: {problems[:10]}")
+
+                con.execute(f"PRAGMA user_version = {int(version)}")
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                raise
+    finally:
+        con.close()
@@ -0,0 +1,104 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from time import time as nowtime
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Werkzeug hash method, "scrypt:n:r:p" or "pbkdf2:sha256:iterations". Stored
+# hashes made with other parameters are replaced at the next login.
+METHOD = 'scrypt:32768:8:1'
+# Longest a request waits (in seconds) for its turn in the pool before it gets 503
+WAIT_TIMEOUT = 5
+# Hashes waiting or running per worker, more requests have to wait
+PENDING_PER_WORKER = 8
+
+
+class HasherBusy(Exception):
+    """Too many password hashes waiting, try again later"""
+
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords in a bounded pool of worker processes.
+
+    scrypt takes tens of milliseconds of CPU per password, in the pool a
+    burst of logins doesn't hold up every other request of the worker.
+    """
+
+    def __init__(self, method=METHOD, max_workers=1, max_pending=None, timeout=WAIT_TIMEOUT):
+        self.method = method
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_pending or max_workers * PENDING_PER_WORKER)
+        self.pool = None
+
+    def start(self):
+        # fork, so the workers don't import the web application again
+        self.pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('fork'))
+        print(f"Password hasher started with {self.max_workers} workers ({self.method})")
+
+    def _run(self, function, *args):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise HasherBusy("Too many logins right now, try again in a moment.")
+        if self.pool is None:
+            # not started (scripts), hash in this process
+            try:
+                return function(*args)
+            finally:
+                self.slots.release()
+        future = self.pool.submit(function, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future.result()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, hash, password):
+        return self._run(check_password_hash, hash, password)
+
+    def needs_rehash(self, hash):
+        """True if hash was made with other parameters than method"""
+        return hash.split('$', 1)[0] != self.method
+
+
+class Throttle:
+    """
+    Counts failed attempts per key (IP address, account) in a sliding window.
+
+    Kept in the password_failures table (see migrations.py), so all web
+    workers see the same counts.
+    """
+
+    def __init__(self, scope, limit, window):
+        """
+        Args:
+            scope: name of the counted keys ("ip", "account")
+            limit: failed attempts allowed per key in window
+            window: length of the window in seconds
+        """
+        self.scope = scope
+        self.limit = limit
+        self.window = window
+
+    def retry_after(self, con, key):
+        """Seconds until key may try again, 0 if it may now"""
+        now = nowtime()
+        # the attempt that has to leave the window before the next one is allowed
+        row = con.execute("SELECT at FROM password_failures WHERE scope = ? AND key = ? AND at > ? "
+                          "ORDER BY at DESC LIMIT 1 OFFSET ?",
+                          (self.scope, key, now - self.window, self.limit - 1)).fetchone()
+        if row is None:
+            return 0
+        return int(row[0] + self.window - now) + 1
+
+    def hit(self, con, key):
+        now = nowtime()
+        # forget attempts that left the window
+        con.execute("DELETE FROM password_failures WHERE scope = ? AND at <= ?", (self.scope, now - self.window))
+        con.execute("INSERT INTO password_failures (scope, key, at) VALUES (?, ?, ?)", (self.scope, key, now))
+        con.commit()
+
+    def reset(self, con, key):
+        con.execute("DELETE FROM password_failures WHERE scope = ? AND key = ?", (self.scope, key))
+        con.commit()
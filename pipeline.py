@@ -0,0 +1,295 @@
+import json
+import os
+import shutil
+import subprocess
+import threading
+import traceback
+from time import sleep, time as nowtime
+
+import db
+import uploads
+from tomp4 import codec_route, ffmpeg_timeout, mp4_command, probe_video, streamable
+
+# Bytes from the start of an upload needed to decide whether it is pipelined
+HEAD_SIZE = 4 * 1024 * 1024
+# How often the feeder looks for newly received chunks (in seconds)
+POLL_INTERVAL = 0.5
+# Longest a transcode job waits for a pipelined conversion (in seconds), at
+# least, longer videos get tomp4.ffmpeg_timeout()
+WAIT_TIMEOUT = 30 * 60
+# A pipeline whose upload got no new bytes for this long (in seconds) gives
+# up its slot, the upload is converted after it is finished
+IDLE_TIMEOUT = int(os.environ.get('PIPELINE_IDLE_TIMEOUT', 5 * 60))
+# FFmpeg processes fed by uploads at the same time, over all web workers
+# (each takes a core and a few hundred MB, more uploads are converted after)
+MAX_PIPELINES = 2
+# Priority of their FFmpeg, like the transcoder's (danceshare.py), web requests go first
+NICE = int(os.environ.get('TRANSCODE_NICE', 10))
+
+# Pipelined conversions of uploads in progress and of jobs that wait for them
+RUNNING_SQL = '''
+    SELECT (SELECT COUNT(*) FROM upload_sessions WHERE pipeline_dir != '')
+         + (SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'running') AND json_extract(payload, '$.pipeline_dir') != '')
+'''
+
+# Files in the pipeline folder
+OUTPUT = 'video.mp4'
+STATUS = 'status.json'
+OWNER = 'owner.pid'
+COMPLETE = 'complete'
+LOG = 'ffmpeg.log'
+
+# Uploads this process is deciding about
+_deciding = set()
+_deciding_lock = threading.Lock()
+
+
+def advance(database, con, temp_folder, session, received, profile=None, max_pipelines=MAX_PIPELINES):
+    """
+    Start converting an upload while it is still coming in.
+
+    Called after every chunk. Once the start of the file is there it is
+    probed: a streamable container (Matroska/WebM, MPEG-TS, MP4/MOV with the
+    moov box first) that has to be encoded gets an FFmpeg process that is fed
+    the chunks in order from a thread of the web worker (FFmpeg runs at the
+    transcoder's lower priority, at most max_pipelines at once over all
+    workers). Everything else (and uploads that
+    are small enough to arrive before they could be decided) is converted
+    after the upload as before. The decision is stored in
+    upload_sessions.pipeline_dir, '' for no pipeline.
+
+    Args:
+        database: path of the sqlite database (for the feeder thread)
+        con: connection of the request
+        temp_folder: folder the pipeline folder is made in
+        session: upload from uploads.get_session()
+        received: bytes from the start of the file received without a gap
+        profile: x264 settings, see tomp4.video_encode_args()
+        max_pipelines: pipelined conversions allowed at once
+    """
+    if session['pipeline_dir'] is not None or received < min(HEAD_SIZE, session['file_size']):
+        return
+    with _deciding_lock:
+        if session['id'] in _deciding:
+            return
+        _deciding.add(session['id'])
+    try:
+        route = None
+        probe = None
+        # nothing left to overlap with when the whole file is already here
+        # (the limit is checked again when the slot is claimed, this only saves the probe)
+        if received < session['file_size'] and running(con) < max_pipelines:
+            with open(session['path'], 'rb') as f:
+                head = f.read(HEAD_SIZE)
+            if streamable(head):
+                probe = probe_video(None, data=head)
+                route = codec_route(probe) if probe is not None else None
+
+        folder = os.path.join(temp_folder, f"pipe_{session['id']}") if route else ''
+        if folder:
+            os.makedirs(folder)
+            # the job checks whether this process is still alive to feed FFmpeg
+            with open(os.path.join(folder, OWNER), 'w') as f:
+                f.write(str(os.getpid()))
+
+        cur = con.cursor()
+        claimed = False
+        if folder:
+            # the slot is taken in the same statement that counts them, so two workers can't both get the last one
+            cur.execute(f"UPDATE upload_sessions SET pipeline_dir = ? WHERE id = ? AND pipeline_dir IS NULL AND ({RUNNING_SQL}) < ?",
+                        (folder, session['id'], max_pipelines))
+            claimed = cur.rowcount == 1
+            if not claimed:
+                os.remove(os.path.join(folder, OWNER))
+                os.rmdir(folder)
+                folder = ''
+        if not claimed:
+            cur.execute("UPDATE upload_sessions SET pipeline_dir = '' WHERE id = ? AND pipeline_dir IS NULL", (session['id'],))
+        con.commit()
+        if not claimed and cur.rowcount != 1:
+            # decided by another process
+            return
+        session['pipeline_dir'] = folder
+
+        if folder:
+            print(f"Pipelining upload {session['id']}: {route}")
+            Pipeline(database, session, folder, route, probe, profile).start()
+    finally:
+        with _deciding_lock:
+            _deciding.discard(session['id'])
+
+
+def running(con):
+    """Pipelined conversions of uploads in progress and of jobs that wait for them"""
+    cur = con.cursor()
+    cur.execute(RUNNING_SQL)
+    return cur.fetchone()[0]
+
+
+def complete(folder):
+    """The upload is finalized, the feeder sends the rest of the file and closes the pipe"""
+    if folder:
+        try:
+            open(os.path.join(folder, COMPLETE), 'w').close()
+        except FileNotFoundError:
+            # the pipeline gave up, the job converts the upload itself
+            pass
+
+
+class Pipeline(threading.Thread):
+    """Feeds the received start of an upload to FFmpeg, as far as it is received"""
+
+    def __init__(self, database, session, folder, route, probe, profile=None):
+        super().__init__(name=f"pipeline-{session['id']}", daemon=True)
+        self.database = database
+        self.session = session
+        self.folder = folder
+        self.route = route
+        self.probe = probe
+        self.profile = profile
+
+    def run(self):
+        returncode = None
+        try:
+            returncode = self._run()
+        except Exception:
+            traceback.print_exc()
+
+        # written last, the job waits for it
+        try:
+            status_path = os.path.join(self.folder, STATUS)
+            with open(status_path + '.tmp', 'w') as f:
+                json.dump({'returncode': returncode, 'route': self.route}, f)
+            os.replace(status_path + '.tmp', status_path)
+        except OSError:
+            # upload deleted or job done without us
+            pass
+        print(f"Pipeline of upload {self.session['id']} finished with {returncode}")
+
+    def _run(self, block_size=1024 * 1024):
+        command = mp4_command('pipe:0', os.path.join(self.folder, OUTPUT),
+                              copy_video=self.route == 'transcode_audio',
+                              copy_audio=self.route == 'transcode' and self.probe['audio_codec'] == 'aac',
+                              profile=self.profile)
+        file_size = self.session['file_size']
+        con = db.connect(self.database)
+        # opened once, the upload folder is renamed when the upload is finalized
+        source = os.open(self.session['path'], os.O_RDONLY)
+        try:
+            with open(os.path.join(self.folder, LOG), 'wb') as log:
+                # own session, so signals for the web worker (reload, ^C) don't reach it
+                process = subprocess.Popen(['ffmpeg', '-v', 'error'] + command[1:], start_new_session=True,
+                                           stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=log)
+            try:
+                # lowered before it gets any input, so before it starts its encoder threads
+                # (preexec_fn is not safe in a threaded web worker)
+                os.setpriority(os.PRIO_PROCESS, process.pid, NICE)
+            except OSError:
+                pass
+            offset = 0
+            last_progress = nowtime()
+            try:
+                while offset < file_size:
+                    if not os.path.isdir(self.folder):
+                        # upload deleted (or the job gave up on us)
+                        process.kill()
+                        process.wait()
+                        return None
+
+                    if os.path.exists(os.path.join(self.folder, COMPLETE)):
+                        received = file_size
+                    else:
+                        received = uploads.received_bytes(con, self.session, offset // self.session['chunk_size'])
+
+                    if received <= offset:
+                        if nowtime() - last_progress > IDLE_TIMEOUT and self._give_up(con):
+                            print(f"Upload {self.session['id']} got nothing for {IDLE_TIMEOUT} s, stopping its pipeline")
+                            process.kill()
+                            process.wait()
+                            shutil.rmtree(self.folder, ignore_errors=True)
+                            return None
+                        sleep(POLL_INTERVAL)
+                        continue
+                    last_progress = nowtime()
+                    while offset < received:
+                        block = os.pread(source, min(block_size, received - offset), offset)
+                        if not block:
+                            break
+                        process.stdin.write(block)
+                        offset += len(block)
+                process.stdin.close()
+            except BrokenPipeError:
+                # FFmpeg stopped reading (broken input), its exit code tells
+                pass
+            # the job removes the folder when it stops waiting, FFmpeg must not go on next to its own encode
+            while process.poll() is None:
+                if not os.path.isdir(self.folder):
+                    process.kill()
+                    process.wait()
+                    return None
+                sleep(POLL_INTERVAL)
+            return process.returncode
+        finally:
+            os.close(source)
+            con.close()
+
+    def _give_up(self, con):
+        """
+        Take the pipeline away from an abandoned upload, so it doesn't hold a slot.
+
+        Returns:
+            bool: False if the upload was finalized (or deleted) meanwhile,
+                  its job may be waiting for the pipeline
+        """
+        cur = con.cursor()
+        cur.execute("UPDATE upload_sessions SET pipeline_dir = '' WHERE id = ? AND pipeline_dir = ?",
+                    (self.session['id'], self.folder))
+        con.commit()
+        return cur.rowcount == 1
+
+
+def wait(folder, video_path, duration=None):
+    """
+    In the transcode job: wait for the pipelined conversion of the upload.
+
+    Args:
+        folder: pipeline folder of the upload
+        video_path: where the converted video is moved to
+        duration: length of the video in seconds, for the timeout
+
+    Returns:
+        bool: True if the converted video was moved to video_path, False if
+              the job has to convert the upload itself
+    """
+    status_path = os.path.join(folder, STATUS)
+    deadline = nowtime() + ffmpeg_timeout(duration, WAIT_TIMEOUT)
+    while not os.path.exists(status_path):
+        if not _owner_alive(folder) or nowtime() > deadline:
+            print(f"Pipelined conversion in {folder} did not finish")
+            # stops its FFmpeg (see Pipeline._run()), the job encodes the upload itself
+            shutil.rmtree(folder, ignore_errors=True)
+            return False
+        sleep(0.2)
+
+    with open(status_path) as f:
+        status = json.load(f)
+    output = os.path.join(folder, OUTPUT)
+    if status['returncode'] != 0 or not os.path.exists(output) or os.path.getsize(output) == 0:
+        try:
+            with open(os.path.join(folder, LOG), errors='replace') as f:
+                print(f"Pipelined conversion failed ({status['returncode']}): {f.read()[-2000:]}")
+        except OSError:
+            pass
+        return False
+
+    os.replace(output, video_path)
+    return True
+
+
+def _owner_alive(folder):
+    try:
+        with open(os.path.join(folder, OWNER)) as f:
+            os.kill(int(f.read()), 0)
+        return True
+    except (OSError, ValueError):
+        return False
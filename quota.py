@@ -0,0 +1,104 @@
+import threading
+import traceback
+from time import sleep
+
+import db
+
+# How often (in seconds) the counters are recomputed from the tables
+RECONCILE_INTERVAL = 60 * 60
+
+# Bytes a user stores: every file once, even when several of the user's videos use it
+STORED_SQL = '''
+    SELECT COALESCE(SUM(v.file_size), 0)
+    FROM videos v
+    WHERE v.user_id = users.id
+      AND v.id = (SELECT MIN(w.id) FROM videos w WHERE w.user_id = v.user_id AND w.blob_digest IS v.blob_digest)
+'''
+# Bytes held for uploads in progress and for their conversion jobs
+RESERVED_SQL = '''
+    SELECT (SELECT COALESCE(SUM(file_size), 0) FROM upload_sessions WHERE user_id = users.id)
+         + (SELECT COALESCE(SUM(json_extract(payload, '$.reserved')), 0) FROM jobs
+            WHERE user_id = users.id AND state IN ('queued', 'running'))
+'''
+
+
+def limit_message(size_allowed, used):
+    return f"Space limit has been reached {size_allowed / 1024 / 1024 / 1024} GB. <br>You have {size_allowed / 1024 / 1024 / 1024 - used / 1024 / 1024 / 1024} <br>Upgrade your plan or delete some videos"
+
+
+def reserve(cur, user_id, amount, size_allowed):
+    """
+    Hold amount bytes of the user's space for an upload.
+
+    users.size (stored, kept by triggers) and users.reserved are checked and
+    raised in one statement, so concurrent uploads can't both take the last
+    free space. The caller commits.
+
+    Returns:
+        bool: False if the user doesn't have that much space left
+    """
+    cur.execute("""
+        UPDATE users SET reserved = reserved + :amount
+        WHERE id = :user_id AND COALESCE(size, 0) + reserved + :amount <= :size_allowed
+    """, {"amount": amount, "user_id": user_id, "size_allowed": size_allowed})
+    return cur.rowcount == 1
+
+
+def release(cur, user_id, amount):
+    """Give back a reservation (upload stored, aborted or failed). The caller commits."""
+    cur.execute("UPDATE users SET reserved = MAX(reserved - ?, 0) WHERE id = ?", (amount, user_id))
+
+
+def used(cur, user_id):
+    """Stored plus reserved bytes of a user"""
+    cur.execute("SELECT COALESCE(size, 0) + reserved FROM users WHERE id = ?", (user_id,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def reconcile(con):
+    """
+    Recompute the counters of all users from videos, upload_sessions and jobs.
+
+    They are kept up to date as things change, this fixes whatever drift
+    crashed processes or bugs left behind.
+
+    Returns:
+        int: number of users whose counters were wrong
+    """
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute(f"""
+            SELECT id, size, reserved, stored, held FROM (
+                SELECT id, size, reserved, ({STORED_SQL}) AS stored, ({RESERVED_SQL}) AS held FROM users
+            )
+            WHERE size IS NOT stored OR reserved != held
+        """)
+        drift = cur.fetchall()
+        for user_id, size, reserved, stored, held in drift:
+            print(f"Quota of user {user_id} was {size} stored and {reserved} reserved, is {stored} and {held}")
+            cur.execute("UPDATE users SET size = ?, reserved = ? WHERE id = ?", (stored, held, user_id))
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    return len(drift)
+
+
+def start_reconciler(database, interval=RECONCILE_INTERVAL):
+    """Reconcile the counters now and then every interval seconds, in a thread"""
+    def run():
+        while True:
+            con = db.connect(database)
+            try:
+                reconcile(con)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                con.close()
+            sleep(interval)
+
+    thread = threading.Thread(target=run, name='quota-reconciler', daemon=True)
+    thread.start()
+    return thread
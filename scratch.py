@@ -0,0 +1,177 @@
+import os
+import shutil
+import tempfile
+import threading
+import traceback
+from time import sleep, time as nowtime
+
+import db
+import uploads
+
+# Bytes the temp folder may use for uploads in progress and their conversions
+TEMP_BUDGET = 20 * 1024 * 1024 * 1024
+# Free disk space that is always left alone
+TEMP_MIN_FREE = 1024 * 1024 * 1024
+# An upload takes its size in the temp folder, its conversion about as much again
+# (mp4, HLS renditions), so it is admitted for this many times its size
+SCRATCH_FACTOR = 2
+# Upload sessions without a new chunk for this long (in seconds) are aborted
+SESSION_MAX_AGE = 24 * 60 * 60
+# Folders in the temp folder that belong to nothing are deleted once they are this old (in seconds)
+STALE_AGE = 60 * 60
+# How often (in seconds) the janitor runs
+JANITOR_INTERVAL = 10 * 60
+
+# Space held by upload sessions and by the jobs converting them (the upload
+# is moved into the job folder when it is finalized)
+HELD_SQL = '''
+    SELECT (SELECT COALESCE(SUM(file_size), 0) FROM upload_sessions)
+         + (SELECT COALESCE(SUM(json_extract(payload, '$.reserved')), 0) FROM jobs WHERE state IN ('queued', 'running'))
+'''
+
+
+class TempFull(Exception):
+    """No room in the temp folder for another upload right now"""
+
+
+def held(cur):
+    """Bytes of the temp folder held by uploads in progress and queued or running conversions"""
+    cur.execute(HELD_SQL)
+    return cur.fetchone()[0] * SCRATCH_FACTOR
+
+
+def admit(cur, temp_folder, file_size, budget=TEMP_BUDGET, min_free=TEMP_MIN_FREE):
+    """
+    Check that a new upload of file_size bytes fits into the temp folder.
+
+    Call in the transaction that creates the upload session (after a write
+    in it, so the check and the insert can't interleave with another upload).
+
+    Raises:
+        TempFull: the budget is used up or the disk is almost full
+    """
+    needed = file_size * SCRATCH_FACTOR
+    if held(cur) + needed > budget:
+        raise TempFull("Too many uploads in progress, try again later.")
+    os.makedirs(temp_folder, exist_ok=True)
+    if shutil.disk_usage(temp_folder).free - needed < min_free:
+        raise TempFull("The server is running out of space, try again later.")
+
+
+def disk_usage(folder):
+    """Bytes the files in folder take on disk (preallocated uploads count in full)"""
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                # deleted while walking
+                pass
+    return total
+
+
+def usage(con, temp_folder, budget=TEMP_BUDGET):
+    """Temp folder numbers for /stats"""
+    cur = con.cursor()
+    cur.execute("SELECT COUNT(*) FROM upload_sessions")
+    sessions = cur.fetchone()[0]
+    return {
+        'budget': budget,
+        'held': held(cur),
+        'on_disk': disk_usage(temp_folder),
+        'sessions': sessions,
+    }
+
+
+def expire_sessions(con, max_age=SESSION_MAX_AGE):
+    """
+    Abort uploads that got no chunk for max_age seconds, with their space and files.
+
+    Returns:
+        int: number of aborted uploads
+    """
+    cur = con.cursor()
+    cur.execute(f"SELECT {', '.join(uploads.SESSION_COLUMNS)} FROM upload_sessions WHERE updated_at < ?", (nowtime() - max_age,))
+    expired = [dict(zip(uploads.SESSION_COLUMNS, row)) for row in cur.fetchall()]
+    for session in expired:
+        print(f"Upload {session['id']} of user {session['user_id']} was abandoned, deleting it")
+        uploads.delete_session(con, session)
+    return len(expired)
+
+
+def remove_stale(con, temp_folder, min_age=STALE_AGE):
+    """
+    Delete folders in temp_folder that no upload session or job uses.
+
+    Those are left behind when a process dies (upload_, job_ and pipe_
+    folders) and by the old upload code. Runs under the write lock, uploads
+    are created and finalized in a transaction, so a folder in use always
+    has its row. Under the lock stale folders are only moved into a trash
+    folder, it is deleted after the commit.
+
+    Returns:
+        int: number of deleted folders
+    """
+    if not os.path.isdir(temp_folder):
+        return 0
+    cur = con.cursor()
+    trash = None
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("SELECT path, pipeline_dir FROM upload_sessions")
+        in_use = set()
+        for path, pipeline_dir in cur.fetchall():
+            in_use.add(os.path.normpath(os.path.dirname(path)))
+            if pipeline_dir:
+                in_use.add(os.path.normpath(pipeline_dir))
+        cur.execute("""
+            SELECT json_extract(payload, '$.work_dir'), json_extract(payload, '$.pipeline_dir')
+            FROM jobs WHERE state IN ('queued', 'running')
+        """)
+        for row in cur.fetchall():
+            in_use.update(os.path.normpath(folder) for folder in row if folder)
+
+        removed = 0
+        for name in os.listdir(temp_folder):
+            path = os.path.join(temp_folder, name)
+            if os.path.normpath(path) in in_use:
+                continue
+            try:
+                if nowtime() - os.lstat(path).st_mtime < min_age:
+                    continue
+            except OSError:
+                continue
+            print(f"Deleting stale temp folder: {path}")
+            if trash is None:
+                # made after the listing, it is not stale itself
+                trash = tempfile.mkdtemp(prefix='.trash-', dir=temp_folder)
+            os.rename(path, os.path.join(trash, name))
+            removed += 1
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        if trash is not None:
+            shutil.rmtree(trash, ignore_errors=True)
+    return removed
+
+
+def start_janitor(database, temp_folder, interval=JANITOR_INTERVAL):
+    """Expire abandoned uploads and delete stale temp folders every interval seconds, in a thread"""
+    def run():
+        while True:
+            con = db.connect(database)
+            try:
+                expire_sessions(con)
+                remove_stale(con, temp_folder)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                con.close()
+            sleep(interval)
+
+    thread = threading.Thread(target=run, name='temp-janitor', daemon=True)
+    thread.start()
+    return thread
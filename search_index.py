@@ -0,0 +1,54 @@
+import re
+
+# Weight of a match in the name compared to one in the description
+NAME_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+# Queries shorter than this can't use the trigram index
+TRIGRAM_LENGTH = 3
+# Most trigrams used for a fuzzy query
+MAX_FUZZY_TRIGRAMS = 24
+
+
+def quote(text):
+    """Quote text as an FTS5 string, so user input is never read as query syntax"""
+    return '"' + text.replace('"', '""') + '"'
+
+
+def match_queries(q, table):
+    """
+    Turn a search box value into FTS5 queries for videos or groups.
+
+    Returns a list of (fts_table, match_expression), to be tried in order
+    until one finds something, or [] if q is empty (no filtering):
+
+    - shorter than 3 characters: words starting with q (table_fts)
+    - otherwise: names / descriptions containing q (table_trgm), like
+      LIKE '%q%' but from the index
+    - then, fuzzy: anything sharing trigrams with q, best matches first
+      (typos, missing letters)
+    """
+    q = ' '.join((q or '').split())
+    if not q:
+        return []
+
+    if len(q) < TRIGRAM_LENGTH:
+        words = re.findall(r'\w+', q)
+        if not words:
+            return []
+        return [(f"{table}_fts", ' '.join(quote(word) + '*' for word in words))]
+
+    trigrams = []
+    lowered = q.lower()
+    for i in range(len(lowered) - TRIGRAM_LENGTH + 1):
+        trigram = lowered[i:i + TRIGRAM_LENGTH]
+        if trigram not in trigrams:
+            trigrams.append(trigram)
+    queries = [(f"{table}_trgm", quote(q))]
+    if len(trigrams) > 1:
+        queries.append((f"{table}_trgm", ' OR '.join(quote(t) for t in trigrams[:MAX_FUZZY_TRIGRAMS])))
+    return queries
+
+
+def rank(fts_table):
+    """bm25 rank of a row (smaller is better), name matches count more than description"""
+    return f"bm25({fts_table}, {NAME_WEIGHT}, {DESCRIPTION_WEIGHT})"
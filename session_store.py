@@ -0,0 +1,216 @@
+import heapq
+import secrets
+import sqlite3
+import threading
+import traceback
+from time import sleep, time as nowtime
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+
+import db
+
+# Expired sessions deleted per statement by cleanup()
+CLEANUP_BATCH = 500
+# How often (in seconds) expired sessions are deleted
+CLEANUP_INTERVAL = 10 * 60
+# The expiry of an unchanged session is only pushed back (written) once less
+# than this part of its lifetime is left
+REFRESH_FRACTION = 0.5
+
+# Same format as Flask's cookie sessions (JSON with tags for tuples, bytes, ...)
+serializer = TaggedJSONSerializer()
+
+
+class ServerSession(SecureCookieSession):
+    """Session data kept on the server, the cookie only has the random id"""
+
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.expires_at = expires_at
+        # user the session belonged to when the request came in
+        self.opened_user_id = self.get('user_id')
+
+
+class SqliteSessionStore:
+    """
+    Sessions in the sessions table of the app database (see migrations.py).
+
+    Args:
+        database: path of the sqlite database (for cleanup())
+        connection: function returning the connection of the request (db.get_db)
+    """
+
+    def __init__(self, database, connection):
+        self.database = database
+        self.connection = connection
+
+    def load(self, sid):
+        """(data, expires_at) of a session, None if it doesn't exist or expired"""
+        cur = self.connection().cursor()
+        cur.execute("SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?", (sid, nowtime()))
+        return cur.fetchone()
+
+    def _write(self, sql, parameters):
+        con = self.connection()
+        # whatever the view didn't commit would be rolled back after the request anyway
+        if con.in_transaction:
+            con.rollback()
+        con.execute(sql, parameters)
+        con.commit()
+
+    def save(self, sid, data, expires_at):
+        self._write("INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)", (sid, data, expires_at))
+
+    def touch(self, sid, expires_at):
+        self._write("UPDATE sessions SET expires_at = ? WHERE id = ?", (expires_at, sid))
+
+    def delete(self, sid):
+        self._write("DELETE FROM sessions WHERE id = ?", (sid,))
+
+    def cleanup(self, batch_size=CLEANUP_BATCH):
+        """
+        Delete expired sessions, batch_size per transaction so requests are not blocked for long.
+
+        Returns:
+            int: number of deleted sessions
+        """
+        con = db.connect(self.database)
+        deleted = 0
+        try:
+            while True:
+                cur = con.execute("""
+                    DELETE FROM sessions WHERE id IN (
+                        SELECT id FROM sessions WHERE expires_at <= ? ORDER BY expires_at LIMIT ?
+                    )
+                """, (nowtime(), batch_size))
+                con.commit()
+                deleted += cur.rowcount
+                if cur.rowcount < batch_size:
+                    return deleted
+        finally:
+            con.close()
+
+
+class MemorySessionStore:
+    """
+    Sessions in a dict of this process.
+
+    Only for a single process (development, benchmarks): sessions are lost
+    on restart and not seen by other workers.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        # (expires_at, sid), the soonest expiry first
+        self.expiry = []
+        self.lock = threading.Lock()
+
+    def load(self, sid):
+        row = self.sessions.get(sid)
+        if row is None or row[1] <= nowtime():
+            return None
+        return row
+
+    def save(self, sid, data, expires_at):
+        with self.lock:
+            self.sessions[sid] = (data, expires_at)
+            heapq.heappush(self.expiry, (expires_at, sid))
+
+    def touch(self, sid, expires_at):
+        with self.lock:
+            row = self.sessions.get(sid)
+            if row is not None:
+                self.sessions[sid] = (row[0], expires_at)
+                heapq.heappush(self.expiry, (expires_at, sid))
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def cleanup(self, batch_size=CLEANUP_BATCH):
+        deleted = 0
+        now = nowtime()
+        with self.lock:
+            while self.expiry and self.expiry[0][0] <= now:
+                expires_at, sid = heapq.heappop(self.expiry)
+                row = self.sessions.get(sid)
+                # older entries of sessions that were saved or touched again are skipped
+                if row is not None and row[1] == expires_at:
+                    del self.sessions[sid]
+                    deleted += 1
+        return deleted
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Flask sessions stored with a SqliteSessionStore or MemorySessionStore.
+
+    A session is only written when it changed (login, logout) or when its
+    expiry has to be pushed back, so ordinary requests (like every upload
+    chunk) only read it. Empty sessions are never stored. A session gets a
+    new id when its user changes, a cleared one is deleted.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            try:
+                row = self.store.load(sid)
+            except sqlite3.Error:
+                traceback.print_exc()
+                row = None
+            if row is not None:
+                return ServerSession(serializer.loads(row[0]), sid=sid, expires_at=row[1])
+        # unknown ids are never taken over
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and session.sid:
+                # cleared (logout)
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        expires_at = nowtime() + lifetime
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        elif session.modified and session.get('user_id') != session.opened_user_id:
+            # logged in as someone else: new id, so an id known before the login (session fixation) is worthless
+            self.store.delete(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+        elif not session.modified:
+            # unchanged, only write when it would expire soon
+            if session.expires_at - nowtime() < lifetime * REFRESH_FRACTION:
+                self.store.touch(session.sid, expires_at)
+            return
+        self.store.save(session.sid, serializer.dumps(dict(session)), expires_at)
+
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+
+def start_cleanup(store, interval=CLEANUP_INTERVAL):
+    """Delete expired sessions every interval seconds, in a thread"""
+    def run():
+        while True:
+            sleep(interval)
+            try:
+                store.cleanup()
+            except Exception:
+                traceback.print_exc()
+
+    thread = threading.Thread(target=run, name='session-cleanup', daemon=True)
+    thread.start()
+    return thread
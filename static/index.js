@@ -1,22 +1,78 @@
 let q = document.getElementById("q");
 let group = document.getElementById("group");
+// bumped on every new search, so pages of an older search are dropped
+let generation = 0;
+
+const observer = new IntersectionObserver(entries => {
+    entries.forEach(entry => {
+        if (entry.isIntersecting) {
+            observer.unobserve(entry.target);
+            loadMore(entry.target);
+        }
+    });
+}, { rootMargin: "600px" });
+
+function searchUrl(cursor) {
+    let url = "/search?q=" + encodeURIComponent(q.value) + "&group=" + encodeURIComponent(group.value);
+    if (cursor) {
+        url += "&cursor=" + encodeURIComponent(cursor);
+    }
+    return url;
+}
+
+// players, links and the "load more" marker of newly added results
+function setupResults(root) {
+    attachPosters(root);
+
+    // add event listener to all name-boxes
+    root.querySelectorAll(".name-box").forEach(el => {
+        el.addEventListener("click", ev => {
+            const videoId = el.getAttribute("video-id");
+            window.location.href = `/video/${videoId}/edit`;
+        });
+    });
+
+    root.querySelectorAll(".load-more").forEach(el => observer.observe(el));
+}
 
 async function loadVideos(first_time) {
     if (first_time) {
         q.value = "";
         group.value = "All";
     }
-    let responce = await fetch("/search?q=" + encodeURIComponent(q.value) + "&group=" + encodeURIComponent(group.value));
+    const current = ++generation;
+    let responce = await fetch(searchUrl(null));
     let data = await responce.text();
+    if (current !== generation) {
+        return;
+    }
+    observer.disconnect();
     document.getElementById("videos").innerHTML = data;
+    setupResults(document.getElementById("videos"));
+}
 
-    // add event listener to all name-boxes
-    document.querySelectorAll(".name-box").forEach(el => {
-        el.addEventListener("click", ev => {
-            const videoId = el.getAttribute("video-id");
-            window.location.href = `/video/${videoId}/edit`;
-        });
+// appends the next page of results in place of the marker
+async function loadMore(marker) {
+    const current = generation;
+    let responce = await fetch(searchUrl(marker.dataset.cursor));
+    let data = await responce.text();
+    if (current !== generation || !responce.ok) {
+        return;
+    }
+
+    const page = document.createElement("template");
+    page.innerHTML = data;
+    const cards = page.content.querySelectorAll(".card");
+    const next = page.content.querySelector(".load-more");
+    cards.forEach(card => {
+        marker.before(card);
+        setupResults(card);
     });
+    if (next) {
+        marker.before(next);
+        observer.observe(next);
+    }
+    marker.remove();
 }
 
 loadVideos(true);
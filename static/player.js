@@ -0,0 +1,51 @@
+// Plays videos from their HLS ladder (quality adapts to the connection) and falls back to the mp4
+function attachPlayers(root) {
+    root.querySelectorAll('video[data-hls]').forEach(video => {
+        if (video.dataset.attached) {
+            return;
+        }
+        video.dataset.attached = '1';
+
+        // Safari plays HLS natively, the playlist is the first <source>
+        if (video.canPlayType('application/vnd.apple.mpegurl')) {
+            return;
+        }
+        if (!window.Hls || !Hls.isSupported()) {
+            return;
+        }
+
+        const mp4 = video.querySelector('source[type="video/mp4"]').src;
+        const hls = new Hls();
+        hls.on(Hls.Events.ERROR, (event, data) => {
+            // video has no renditions (yet), play the mp4
+            if (data.fatal) {
+                hls.destroy();
+                video.src = mp4;
+            }
+        });
+        hls.loadSource(video.dataset.hls);
+        hls.attachMedia(video);
+    });
+}
+
+// Replaces a poster (search results) with the player when it is clicked
+function attachPosters(root) {
+    root.querySelectorAll('.poster[data-video-id]').forEach(poster => {
+        poster.addEventListener('click', () => {
+            const id = poster.dataset.videoId;
+            const video = document.createElement('video');
+            video.controls = true;
+            video.autoplay = true;
+            video.className = 'video';
+            video.poster = poster.querySelector('img').currentSrc;
+            video.dataset.hls = `/media/${id}/hls/master.m3u8`;
+            video.innerHTML = `<source src="/media/${id}/hls/master.m3u8" type="application/vnd.apple.mpegurl">` +
+                `<source src="/media/${id}/video.mp4" type="video/mp4">`;
+
+            const wrapper = document.createElement('div');
+            wrapper.appendChild(video);
+            poster.replaceWith(wrapper);
+            attachPlayers(wrapper);
+        }, { once: true });
+    });
+}
@@ -1,4 +1,7 @@
-const CHUNK_SIZE = 1.5 * 1024 * 1024; // 1.5MB to account for overhead
+// Chunks sent at the same time
+const PARALLEL_CHUNKS = 4;
+// Attempts per chunk before the upload gives up (it can be resumed later)
+const CHUNK_RETRIES = 5;
 
 document.getElementById('uploadForm').addEventListener('submit', async function(e) {
     e.preventDefault();
@@ -13,48 +16,171 @@ document.getElementById('uploadForm').addEventListener('submit', async function(
         return;
     }
 
-    const totalChunks = Math.ceil(file.size / CHUNK_SIZE);
     document.getElementById('progress').style.display = 'block';
     document.getElementById('status').textContent = 'Starting upload...';
 
     try {
-        for (let chunkNumber = 0; chunkNumber < totalChunks; chunkNumber++) {
-            const start = chunkNumber * CHUNK_SIZE;
-            const end = Math.min(start + CHUNK_SIZE, file.size);
-            const chunk = file.slice(start, end);
-
-            const formData = new FormData();
-            formData.append('file', chunk, 'chunk');
-            formData.append('chunk_number', chunkNumber.toString());
-            formData.append('total_chunks', totalChunks.toString());
-            formData.append('video_name', name);
-            formData.append('description', description);
-            formData.append('file_type', file.type);
-            formData.append('group', group);
-
-            console.log('Sending chunk', chunkNumber, 'of', totalChunks);
-
-            const response = await fetch('/upload', {
-                method: 'POST',
-                body: formData
-            });
-
-            if (!response.ok) {
-                const errorText = await response.text();
-                throw new Error(`Upload failed: ${errorText}`);
-            }
+        const upload = await startOrResume(file, name, description, group);
+        await sendChunks(file, upload);
 
-            const result = await response.json();
-            console.log('Chunk response:', result);
+        const response = await fetch(`/uploads/${upload.upload_id}/finalize`, {method: 'POST'});
+        const result = await response.json();
+        if (!response.ok) {
+            throw new Error(result.error);
+        }
+        localStorage.removeItem(uploadKey(file));
 
-            const progress = ((chunkNumber + 1) / totalChunks) * 100;
-            document.getElementById('progress-bar').style.width = progress + '%';
-            document.getElementById('status').textContent = `Uploading: ${Math.round(progress)}%`;
+        if (result && result.job_id) {
+            await waitForJob(result.job_id);
         }
-        
         document.getElementById('status').textContent = 'Upload complete!';
     } catch (error) {
         console.error('Upload error:', error);
         document.getElementById('status').textContent = 'Upload failed: ' + error.message;
     }
-});
\ No newline at end of file
+});
+
+// Same file selected again continues the unfinished upload
+function uploadKey(file) {
+    return `upload:${file.name}:${file.size}:${file.lastModified}`;
+}
+
+async function startOrResume(file, name, description, group) {
+    const uploadId = localStorage.getItem(uploadKey(file));
+    if (uploadId) {
+        const response = await fetch(`/uploads/${uploadId}`);
+        if (response.ok) {
+            console.log('Resuming upload', uploadId);
+            return await response.json();
+        }
+        localStorage.removeItem(uploadKey(file));
+    }
+
+    const response = await fetch('/uploads', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({
+            file_size: file.size,
+            file_type: file.type,
+            video_name: name,
+            description: description,
+            group: group,
+        })
+    });
+    const upload = await response.json();
+    if (!response.ok) {
+        throw new Error(upload.error);
+    }
+    localStorage.setItem(uploadKey(file), upload.upload_id);
+    return upload;
+}
+
+// Sends the missing chunks, PARALLEL_CHUNKS at a time and in any order
+async function sendChunks(file, upload) {
+    const missing = [];
+    for (let i = 0; i < upload.total_chunks; i++) {
+        if (upload.received[i] !== '1') {
+            missing.push(i);
+        }
+    }
+    let done = upload.total_chunks - missing.length;
+    showProgress(done, upload.total_chunks);
+
+    async function worker() {
+        while (missing.length > 0) {
+            const chunkNumber = missing.shift();
+            await sendChunk(file, upload, chunkNumber);
+            done++;
+            showProgress(done, upload.total_chunks);
+        }
+    }
+    const workers = [];
+    for (let i = 0; i < PARALLEL_CHUNKS; i++) {
+        workers.push(worker());
+    }
+    await Promise.all(workers);
+}
+
+async function sendChunk(file, upload, chunkNumber) {
+    const start = chunkNumber * upload.chunk_size;
+    const end = Math.min(start + upload.chunk_size, file.size);
+    const chunk = await file.slice(start, end).arrayBuffer();
+    const checksum = crc32(new Uint8Array(chunk)).toString(16);
+
+    for (let attempt = 1; ; attempt++) {
+        try {
+            const response = await fetch(`/uploads/${upload.upload_id}/chunks/${chunkNumber}`, {
+                method: 'PUT',
+                headers: {'X-Chunk-CRC32': checksum},
+                body: chunk
+            });
+            if (response.ok) {
+                return;
+            }
+            const error = (await response.json()).error;
+            // only damaged chunks are worth sending again
+            if (response.status !== 422 && response.status < 500) {
+                throw new Error(error);
+            }
+            console.log('Chunk', chunkNumber, 'failed:', error);
+            if (attempt >= CHUNK_RETRIES) {
+                throw new Error(error);
+            }
+        } catch (error) {
+            if (!(error instanceof TypeError) || attempt >= CHUNK_RETRIES) {
+                throw error;
+            }
+            // network error
+            console.log('Chunk', chunkNumber, 'failed:', error.message);
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+    }
+}
+
+function showProgress(done, total) {
+    const progress = (done / total) * 100;
+    document.getElementById('progress-bar').style.width = progress + '%';
+    document.getElementById('status').textContent = `Uploading: ${Math.round(progress)}%`;
+}
+
+let CRC_TABLE = null;
+
+function crc32(bytes) {
+    if (CRC_TABLE === null) {
+        CRC_TABLE = new Uint32Array(256);
+        for (let n = 0; n < 256; n++) {
+            let c = n;
+            for (let k = 0; k < 8; k++) {
+                c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+            }
+            CRC_TABLE[n] = c;
+        }
+    }
+    let crc = 0xFFFFFFFF;
+    for (let i = 0; i < bytes.length; i++) {
+        crc = CRC_TABLE[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+    }
+    return (crc ^ 0xFFFFFFFF) >>> 0;
+}
+
+// Polls the conversion job until the video is ready
+async function waitForJob(jobId) {
+    while (true) {
+        const response = await fetch(`/jobs/${jobId}`);
+        const job = await response.json();
+        if (!response.ok) {
+            throw new Error(job.error);
+        }
+
+        if (job.state === 'done') {
+            return job;
+        } else if (job.state === 'failed') {
+            throw new Error(job.error);
+        } else if (job.state === 'queued') {
+            document.getElementById('status').textContent = `Waiting for conversion (${job.position} before you)...`;
+        } else {
+            document.getElementById('status').textContent = 'Converting video...';
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
@@ -0,0 +1,154 @@
+import os
+import shutil
+import tempfile
+import threading
+import traceback
+from time import sleep, time as nowtime
+
+import db
+import video_helper
+
+# How often (in seconds) the sweeper looks for tombstones
+SWEEP_INTERVAL = 60
+# Paths deleted per transaction, and the pause between batches (rate limit,
+# so a big group deletion doesn't hog the disk or the database lock)
+SWEEP_BATCH = 100
+SWEEP_PAUSE = 1.0
+# How often (in seconds) the upload folder is searched for files without a blob
+ORPHAN_INTERVAL = 24 * 60 * 60
+# Orphans are kept this long (in seconds) before they are deleted, time to
+# notice when the database is not the one that goes with the folder
+ORPHAN_GRACE = 24 * 60 * 60
+# Prefix of the folders swept files are moved into before they are deleted
+# (left behind by a crash they are orphans and swept again)
+TRASH_PREFIX = '.trash-'
+
+
+def stored_paths(cur):
+    """Normalized paths of all files the blobs use (videos, pictures, thumbnails, HLS folders)"""
+    cur.execute("SELECT filepath, image_path FROM blobs")
+    paths = set()
+    for filepath, image_path in cur.fetchall():
+        paths.add(os.path.normpath(filepath))
+        paths.add(os.path.normpath(video_helper.hls_dir(filepath)))
+        if image_path:
+            paths.add(os.path.normpath(image_path))
+            paths.update(os.path.normpath(path) for path in video_helper.thumbnail_paths(image_path))
+    return paths
+
+
+def discard(path, kind, trash):
+    """
+    Move the files of a tombstoned path into a trash folder next to them, missing files are fine.
+
+    Args:
+        trash: trash folders by the folder they are made in, new ones are added
+    """
+    paths = [path]
+    if kind == 'video':
+        paths.append(video_helper.hls_dir(path))
+    elif kind == 'picture':
+        paths += video_helper.thumbnail_paths(path)
+    for path in paths:
+        if not os.path.lexists(path):
+            continue
+        folder = os.path.dirname(path) or '.'
+        if folder not in trash:
+            trash[folder] = tempfile.mkdtemp(prefix=TRASH_PREFIX, dir=folder)
+        os.rename(path, os.path.join(trash[folder], os.path.basename(path)))
+    print(f"Deleted {kind}: {paths[0]}")
+
+
+def sweep(con, batch_size=SWEEP_BATCH, pause=SWEEP_PAUSE, grace=ORPHAN_GRACE):
+    """
+    Delete the files of the tombstones, batch_size at a time.
+
+    Each batch holds the write lock while its files are moved into trash
+    folders, so an upload of the same content can't store its files in
+    between (a path that is in use again only loses its tombstone). The
+    trash is deleted after the commit, that takes long for big HLS folders.
+
+    Returns:
+        int: number of deleted paths
+    """
+    cur = con.cursor()
+    deleted = 0
+    while True:
+        trash = {}
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.execute("""
+                SELECT path, kind FROM file_tombstones
+                WHERE kind != 'file' OR deleted_at <= ?
+                LIMIT ?
+            """, (int(nowtime() - grace), batch_size))
+            batch = cur.fetchall()
+            in_use = stored_paths(cur) if batch else set()
+            for path, kind in batch:
+                if os.path.normpath(path) not in in_use:
+                    discard(path, kind, trash)
+                    deleted += 1
+            cur.executemany("DELETE FROM file_tombstones WHERE path = ?", [(path,) for path, _ in batch])
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            for folder in trash.values():
+                shutil.rmtree(folder, ignore_errors=True)
+        if len(batch) < batch_size:
+            return deleted
+        sleep(pause)
+
+
+def find_orphans(con, upload_folder):
+    """
+    Tombstone files in upload_folder that no blob uses (left behind by bugs or crashes).
+
+    Runs under the write lock: a conversion moves its files into the folder
+    in the transaction that adds its blob, so they are never seen without it.
+
+    Returns:
+        int: number of new tombstones
+    """
+    if not os.path.isdir(upload_folder):
+        return 0
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        in_use = stored_paths(cur)
+        orphans = [(path,) for path in (os.path.join(upload_folder, name) for name in os.listdir(upload_folder))
+                   if os.path.normpath(path) not in in_use]
+        cur.executemany("INSERT OR IGNORE INTO file_tombstones (path, kind) VALUES (?, 'file')", orphans)
+        found = cur.rowcount
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    if found > 0:
+        print(f"Found {found} orphaned files in {upload_folder}")
+    return max(found, 0)
+
+
+def start_sweeper(database, upload_folder, interval=SWEEP_INTERVAL, orphan_interval=ORPHAN_INTERVAL):
+    """Delete tombstoned files every interval seconds and look for orphans every orphan_interval, in a thread"""
+    def run():
+        last_orphan_scan = 0
+        while True:
+            con = db.connect(database)
+            try:
+                if nowtime() - last_orphan_scan >= orphan_interval:
+                    find_orphans(con, upload_folder)
+                    last_orphan_scan = nowtime()
+                deleted = sweep(con)
+                if deleted:
+                    print(f"Swept {deleted} deleted files")
+            except Exception:
+                traceback.print_exc()
+            finally:
+                con.close()
+            sleep(interval)
+
+    thread = threading.Thread(target=run, name='file-sweeper', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+# the modules are in the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty folder, the app uses paths relative to the working directory"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
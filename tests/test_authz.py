@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import authz
+import db
+import migrations
+
+DATABASE = 'data/danceshare.db'
+
+
+@pytest.fixture
+def con(workdir):
+    os.makedirs('data')
+    migrations.migrate(DATABASE)
+    con = db.connect(DATABASE)
+    con.execute("INSERT INTO users (username, hash, size) VALUES ('dancer', 'x', 0), ('teacher', 'x', 0)")
+    con.execute("INSERT INTO groups (name, creator_id) VALUES ('crew', 2)")
+    con.commit()
+    yield con
+    con.close()
+
+
+def test_changes_on_one_worker_are_seen_by_the_others(con):
+    # the cache of another web worker, with its own connection
+    other = db.connect(DATABASE)
+    cache = authz.AuthzCache(ttl=60)
+    assert not cache.get(other, 1).is_member(1)
+    assert cache.get(other, 1).group_list() == []
+
+    # joined on this worker
+    con.execute("INSERT INTO group_members (group_id, user_id) VALUES (1, 1)")
+    con.commit()
+    assert cache.get(other, 1).is_member(1)
+    assert cache.get(other, 1).group_list() == [(1, 'crew')]
+
+    con.execute("UPDATE groups SET name = 'company' WHERE id = 1")
+    con.commit()
+    assert cache.get(other, 1).group_list() == [(1, 'company')]
+
+    con.execute("INSERT INTO groups (name, creator_id) VALUES ('solo', 1)")
+    con.commit()
+    assert cache.get(other, 1).is_creator(2)
+
+    con.execute("DELETE FROM groups WHERE id = 1")
+    con.commit()
+    assert not cache.get(other, 1).is_member(1)
+    other.close()
+
+
+def test_unchanged_permissions_come_from_the_cache(con):
+    cache = authz.AuthzCache(ttl=60)
+    first = cache.get(con, 1)
+    assert cache.get(con, 1) is first
+    assert cache.stats()['hits'] == 1
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+import cache
+import db
+import migrations
+
+DATABASE = 'data/danceshare.db'
+
+
+@pytest.fixture
+def con(workdir):
+    os.makedirs('data')
+    migrations.migrate(DATABASE)
+    con = db.connect(DATABASE)
+    con.execute("INSERT INTO users (username, hash, size) VALUES ('dancer', 'x', 0)")
+    con.execute("INSERT INTO groups (name, creator_id) VALUES ('crew', 1), ('solo', 1)")
+    con.commit()
+    yield con
+    con.close()
+
+
+def add_video(con, group_id):
+    con.execute("INSERT INTO videos (name, filepath, user_id, filetype, group_id) VALUES ('salsa', 'x.mp4', 1, 'mp4', ?)",
+                (group_id,))
+    con.commit()
+
+
+def test_writes_change_the_versions_results_depend_on(con):
+    keys = [("user", 1), ("group", 1), ("group", 2), ("groups", 0)]
+    before = cache.versions(con.cursor(), keys)
+
+    # a video converted by the transcoder changes its group only
+    add_video(con, 1)
+    after = cache.versions(con.cursor(), keys)
+    assert [a != b for a, b in zip(before, after)] == [False, True, False, False]
+
+    con.execute("UPDATE videos SET group_id = 2")
+    con.commit()
+    moved = cache.versions(con.cursor(), keys)
+    assert [a != b for a, b in zip(after, moved)] == [False, True, True, False]
+
+    con.execute("INSERT INTO group_members (group_id, user_id) VALUES (1, 1)")
+    con.commit()
+    joined = cache.versions(con.cursor(), keys)
+    assert [a != b for a, b in zip(moved, joined)] == [True, False, False, False]
+
+    con.execute("UPDATE groups SET name = 'company' WHERE id = 1")
+    con.commit()
+    renamed = cache.versions(con.cursor(), keys)
+    assert [a != b for a, b in zip(joined, renamed)] == [True, True, False, True]
+
+
+def test_versions_of_unchanged_keys_are_zero(con):
+    assert cache.versions(con.cursor(), [("group", 99)]) == (0,)
+    assert cache.versions(con.cursor(), []) == ()
@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+import db
+import ingest
+import migrations
+import sweeper
+import video_helper
+
+DATABASE = 'data/danceshare.db'
+UPLOAD_FOLDER = 'static/uploads/vid/'
+DIGEST = 'ab' * 32
+
+
+@pytest.fixture
+def con(workdir):
+    os.makedirs('data')
+    migrations.migrate(DATABASE)
+    con = db.connect(DATABASE)
+    con.execute("INSERT INTO users (username, hash, size) VALUES ('dancer', 'x', 0)")
+    con.execute("INSERT INTO groups (name, creator_id) VALUES ('crew', 1)")
+    con.commit()
+    yield con
+    con.close()
+
+
+def converted(work_dir, content):
+    """Files of a finished conversion in work_dir, like ingest._convert() returns them"""
+    os.makedirs(os.path.join(work_dir, 'hls'))
+    for name in ('video.mp4', 'video.jpg', os.path.join('hls', 'index.m3u8')):
+        with open(os.path.join(work_dir, name), 'w') as f:
+            f.write(content)
+    file_path = os.path.join(UPLOAD_FOLDER, f"{DIGEST}.mp4")
+    image_path = f"{UPLOAD_FOLDER}{DIGEST}.jpg"
+    blob = {'digest': DIGEST, 'filepath': file_path, 'image_path': image_path, 'filetype': 'mp4', 'time': 10.0,
+            'file_size': 100, 'width': 640, 'height': 360, 'codec': 'h264', 'bitrate': 1000, 'fps': 25.0, 'rotation': 0}
+    files = [(os.path.join(work_dir, 'video.mp4'), file_path), (os.path.join(work_dir, 'video.jpg'), image_path),
+             (os.path.join(work_dir, 'hls'), video_helper.hls_dir(file_path))]
+    return blob, files
+
+
+def job(work_dir):
+    return {'work_dir': work_dir, 'video_name': 'solo', 'description': '', 'group': 1, 'user_id': 1, 'reserved': 0}
+
+
+def test_delete_and_upload_again(con):
+    blob, files = converted('job_1', 'first')
+    video_id = ingest._store(DATABASE, UPLOAD_FOLDER, 10 ** 9, job('job_1'), DIGEST, blob, files)
+
+    # deleted, the sweeper didn't run yet
+    con.execute("DELETE FROM videos WHERE id = ?", (video_id,))
+    con.commit()
+    assert con.execute("SELECT COUNT(*) FROM file_tombstones").fetchone()[0] == 2
+
+    # the same file uploaded again, its HLS folder is still there
+    blob, files = converted('job_2', 'second')
+    video_id = ingest._store(DATABASE, UPLOAD_FOLDER, 10 ** 9, job('job_2'), DIGEST, blob, files)
+
+    hls = video_helper.hls_dir(blob['filepath'])
+    with open(os.path.join(hls, 'index.m3u8')) as f:
+        assert f.read() == 'second'
+    with open(blob['filepath']) as f:
+        assert f.read() == 'second'
+    assert con.execute("SELECT blob_digest FROM videos WHERE id = ?", (video_id,)).fetchone()[0] == DIGEST
+    assert con.execute("SELECT COUNT(*) FROM file_tombstones").fetchone()[0] == 0
+
+    # nothing left for the sweeper to delete
+    assert sweeper.sweep(con, pause=0) == 0
+    assert os.path.exists(blob['filepath']) and os.path.isdir(hls)
+
+
+def test_failed_store_leaves_files_to_the_sweeper(con):
+    blob, files = converted('job_1', 'first')
+    video_id = ingest._store(DATABASE, UPLOAD_FOLDER, 10 ** 9, job('job_1'), DIGEST, blob, files)
+    con.execute("DELETE FROM videos WHERE id = ?", (video_id,))
+    con.commit()
+
+    # over the space limit, nothing is stored
+    blob, files = converted('job_2', 'second')
+    with pytest.raises(ingest.IngestError):
+        ingest._store(DATABASE, UPLOAD_FOLDER, 10, job('job_2'), DIGEST, blob, files)
+    assert con.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 0
+    assert con.execute("SELECT COUNT(*) FROM file_tombstones").fetchone()[0] == 2
+
+    sweeper.sweep(con, pause=0)
+    assert not os.path.exists(blob['filepath'])
+    assert not os.path.exists(video_helper.hls_dir(blob['filepath']))
+    # the trash is emptied after the transaction
+    assert not [name for name in os.listdir(UPLOAD_FOLDER) if name.startswith(sweeper.TRASH_PREFIX)]
+
+
+def test_duplicate_is_added_to_the_stored_blob(con):
+    # nothing stored yet, the upload has to be converted
+    assert ingest._store(DATABASE, UPLOAD_FOLDER, 10 ** 9, job('job_1'), DIGEST) is None
+    blob, files = converted('job_1', 'first')
+    first = ingest._store(DATABASE, UPLOAD_FOLDER, 10 ** 9, job('job_1'), DIGEST, blob, files)
+
+    second = ingest._store(DATABASE, UPLOAD_FOLDER, 10 ** 9, job('job_2'), DIGEST)
+    assert second != first
+    assert con.execute("SELECT COUNT(*) FROM videos WHERE blob_digest = ?", (DIGEST,)).fetchone()[0] == 2
+    assert con.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 1
@@ -0,0 +1,55 @@
+import os
+from time import sleep
+
+import pytest
+
+import db
+import jobs
+import migrations
+
+DATABASE = 'data/danceshare.db'
+
+
+@pytest.fixture
+def con(workdir):
+    os.makedirs('data')
+    migrations.migrate(DATABASE)
+    con = db.connect(DATABASE)
+    con.execute("INSERT INTO users (username, hash, size) VALUES ('dancer', 'x', 0)")
+    con.commit()
+    yield con
+    con.close()
+
+
+def convert(payload):
+    """Worker that dies like a process killed by the OOM killer"""
+    if payload.get('crash'):
+        os._exit(1)
+    return payload['video_id']
+
+
+def wait_for(con, states, timeout=30):
+    for _ in range(timeout * 10):
+        if [row[0] for row in con.execute("SELECT state FROM jobs ORDER BY id")] == states:
+            return True
+        sleep(0.1)
+    return False
+
+
+def test_dead_worker_process_does_not_stop_the_queue(con):
+    queue = jobs.JobQueue(DATABASE, convert, max_workers=1, poll_interval=0.1)
+    queue.start()
+    try:
+        queue.enqueue(con, 1, {'crash': True})
+        queue.enqueue(con, 1, {'video_id': 7})
+        assert wait_for(con, [jobs.FAILED, jobs.DONE])
+
+        # the crashing job got a second try, the other one ran in a new pool
+        assert con.execute("SELECT video_id FROM jobs WHERE id = 2").fetchone()[0] == 7
+        assert queue.thread.is_alive()
+        assert queue.running == 0
+
+        queue.enqueue(con, 1, {'video_id': 8})
+        assert wait_for(con, [jobs.FAILED, jobs.DONE, jobs.DONE])
+    finally:
+        assert queue.stop(10)
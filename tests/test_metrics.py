@@ -0,0 +1,60 @@
+import json
+import os
+import subprocess
+import sys
+
+import metrics
+
+
+def exited_pid():
+    """Pid of a process that is gone"""
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write(folder, name, requests):
+    with open(os.path.join(folder, name), 'w') as f:
+        json.dump({metrics.REQUESTS.name: [[['main.index', 'GET', '200'], requests]]}, f)
+
+
+def requests(totals):
+    return totals[metrics.REQUESTS.name][('main.index', 'GET', '200')]
+
+
+def test_recycled_worker_is_merged_once(tmp_path):
+    folder = str(tmp_path)
+    write(folder, f"{os.getpid()}-live.json", 5)
+    write(folder, f"{exited_pid()}-recycled.json", 7)
+
+    assert requests(metrics.collect(folder)) == 12
+    # the recycled worker's file was merged into the dead file and deleted
+    assert sorted(name for name in os.listdir(folder) if name.endswith('.json')) == [f"{os.getpid()}-live.json", metrics.DEAD_FILE]
+    # scraped again, nothing is counted twice
+    assert requests(metrics.collect(folder)) == 12
+
+    write(folder, f"{exited_pid()}-recycled.json", 3)
+    assert requests(metrics.collect(folder)) == 15
+
+
+def test_reused_pid_keeps_old_counts(tmp_path):
+    folder = str(tmp_path)
+    old = os.path.join(folder, f"{os.getpid()}-old.json")
+    write(folder, os.path.basename(old), 10)
+    os.utime(old, (0, 0))
+    # a new process with the same pid writes a file of its own
+    write(folder, f"{os.getpid()}-new.json", 1)
+
+    assert requests(metrics.collect(folder)) == 11
+    assert not os.path.exists(old)
+
+
+def test_forked_process_gets_new_file(tmp_path):
+    metrics.flush(str(tmp_path))
+    before = set(os.listdir(tmp_path))
+    pid = os.fork()
+    if pid == 0:
+        metrics.flush(str(tmp_path))
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert len(set(os.listdir(tmp_path)) - before) == 1
@@ -0,0 +1,58 @@
+import os
+import sqlite3
+
+import app
+import db
+import migrations
+import quota
+
+DATABASE = 'data/danceshare.db'
+
+
+def test_baseline_database_is_upgraded_in_place(workdir):
+    # a database of the app before migrations, with data in it
+    os.makedirs('data')
+    migrations.migrate(DATABASE, migrations.MIGRATIONS[:1])
+    con = sqlite3.connect(DATABASE)
+    con.executescript("""
+        PRAGMA user_version = 0;
+        INSERT INTO users (username, hash, size) VALUES ('dancer', 'x', 0), ('teacher', 'x', 0);
+        INSERT INTO groups (name, description, creator_id) VALUES ('crew', 'Salsa on Thursdays', 1);
+        INSERT INTO group_members (group_id, user_id) VALUES (1, 1), (1, 2);
+        INSERT INTO videos (name, filepath, user_id, image_path, filetype, description, group_id, time, file_size)
+        VALUES ('Salsa basics', 'static/uploads/vid/1.mp4', 1, 'static/uploads/vid/1.jpg', 'mp4', 'first steps', 1, 60, 100),
+               ('Salsa turns', 'static/uploads/vid/2.mp4', 2, NULL, 'mp4', NULL, 1, 90, 30);
+        INSERT INTO jobs (user_id, state, payload, created_at) VALUES (1, 'done', '{}', 0);
+    """)
+    con.close()
+
+    migrations.migrate(DATABASE)
+    # and once more, nothing left to do
+    migrations.migrate(DATABASE)
+
+    con = db.connect(DATABASE)
+    try:
+        assert migrations.schema_version(con) == migrations.MIGRATIONS[-1][0]
+        assert con.execute("PRAGMA foreign_key_check").fetchall() == []
+        assert con.execute("PRAGMA integrity_check").fetchone()[0] == 'ok'
+
+        # every video got a blob of its own and counts against its uploader
+        assert con.execute("SELECT digest, refcount FROM blobs ORDER BY digest").fetchall() == [('video:1', 1), ('video:2', 1)]
+        assert con.execute("SELECT size, reserved FROM users ORDER BY id").fetchall() == [(100, 0), (30, 0)]
+        assert quota.reconcile(con) == 0
+
+        # the old rows are in the search indexes
+        videos, _ = app.find_videos(con.cursor(), 2, 'salsa')
+        assert sorted(video[2] for video in videos) == [1, 2]
+        assert con.execute("SELECT rowid FROM groups_fts WHERE groups_fts MATCH 'thursdays'").fetchall() == [(1,)]
+
+        # the cascades added by the migrations work on the old rows
+        con.execute("DELETE FROM groups WHERE id = 1")
+        con.commit()
+        assert con.execute("SELECT COUNT(*) FROM videos").fetchone()[0] == 0
+        assert con.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 0
+        assert sorted(row[0] for row in con.execute("SELECT path FROM file_tombstones")) == [
+            'static/uploads/vid/1.jpg', 'static/uploads/vid/1.mp4', 'static/uploads/vid/2.mp4']
+        assert con.execute("SELECT size FROM users ORDER BY id").fetchall() == [(0,), (0,)]
+    finally:
+        con.close()
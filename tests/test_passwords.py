@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+import db
+import migrations
+import passwords
+
+DATABASE = 'data/danceshare.db'
+
+
+@pytest.fixture
+def connections(workdir):
+    """Two connections, like two web workers"""
+    os.makedirs('data')
+    migrations.migrate(DATABASE)
+    first, second = db.connect(DATABASE), db.connect(DATABASE)
+    yield first, second
+    first.close()
+    second.close()
+
+
+def test_failures_are_shared_by_workers(connections):
+    first, second = connections
+    throttle = passwords.Throttle('account', limit=3, window=60)
+
+    for con in (first, second, first):
+        assert throttle.retry_after(con, 'user:dancer') == 0
+        throttle.hit(con, 'user:dancer')
+    assert 0 < throttle.retry_after(second, 'user:dancer') <= 61
+    assert throttle.retry_after(second, 'user:other') == 0
+
+    throttle.reset(second, 'user:dancer')
+    assert throttle.retry_after(first, 'user:dancer') == 0
+
+
+def test_old_failures_leave_the_window(connections):
+    con, _ = connections
+    throttle = passwords.Throttle('ip', limit=2, window=60)
+    con.execute("INSERT INTO password_failures (scope, key, at) VALUES ('ip', '10.0.0.1', 1.0)")
+    throttle.hit(con, '10.0.0.1')
+    assert throttle.retry_after(con, '10.0.0.1') == 0
+    # and are deleted
+    assert con.execute("SELECT COUNT(*) FROM password_failures").fetchone()[0] == 1
@@ -0,0 +1,19 @@
+import os
+
+import pipeline
+
+
+def test_job_stops_waiting_for_a_dead_owner(workdir):
+    os.makedirs('pipe_1')
+    # no process has this pid
+    with open(os.path.join('pipe_1', pipeline.OWNER), 'w') as f:
+        f.write('999999999')
+
+    assert not pipeline.wait('pipe_1', 'video.mp4', 60)
+    # removing the folder stops the FFmpeg of the pipeline
+    assert not os.path.exists('pipe_1')
+
+
+def test_complete_after_the_pipeline_gave_up(workdir):
+    pipeline.complete('pipe_1')
+    assert not os.path.exists('pipe_1')
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+import db
+import migrations
+import quota
+
+DATABASE = 'data/danceshare.db'
+
+
+@pytest.fixture
+def con(workdir):
+    os.makedirs('data')
+    migrations.migrate(DATABASE)
+    con = db.connect(DATABASE)
+    con.execute("INSERT INTO users (username, hash, size) VALUES ('dancer', 'x', 0), ('teacher', 'x', 0)")
+    con.execute("INSERT INTO groups (name, creator_id) VALUES ('crew', 1), ('class', 2)")
+    con.execute("INSERT INTO blobs (digest, filepath, filetype, file_size) VALUES ('a', 'a.mp4', 'mp4', 100), ('b', 'b.mp4', 'mp4', 30)")
+    con.commit()
+    yield con
+    con.close()
+
+
+def add_video(con, user_id, group_id, digest, file_size):
+    cur = con.cursor()
+    cur.execute("INSERT INTO videos (name, filepath, user_id, filetype, group_id, blob_digest, file_size) VALUES ('salsa', ?, ?, 'mp4', ?, ?, ?)",
+                (f"{digest}.mp4", user_id, group_id, digest, file_size))
+    con.commit()
+    return cur.lastrowid
+
+
+def sizes(con):
+    return [row[0] for row in con.execute("SELECT size FROM users ORDER BY id")]
+
+
+def test_each_file_counts_once_per_user(con):
+    first = add_video(con, 1, 1, 'a', 100)
+    # the same file again, in another group and by another user
+    second = add_video(con, 1, 2, 'a', 100)
+    add_video(con, 2, 2, 'a', 100)
+    add_video(con, 1, 1, 'b', 30)
+    assert sizes(con) == [130, 100]
+
+    con.execute("DELETE FROM videos WHERE id = ?", (first,))
+    con.commit()
+    assert sizes(con) == [130, 100]
+    con.execute("DELETE FROM videos WHERE id = ?", (second,))
+    con.commit()
+    assert sizes(con) == [30, 100]
+    assert quota.reconcile(con) == 0
+
+
+def test_videos_deleted_with_their_group_give_back_space(con):
+    add_video(con, 1, 1, 'a', 100)
+    add_video(con, 1, 2, 'b', 30)
+    add_video(con, 2, 2, 'b', 30)
+
+    con.execute("DELETE FROM groups WHERE id = 2")
+    con.commit()
+    assert sizes(con) == [100, 0]
+    assert quota.reconcile(con) == 0
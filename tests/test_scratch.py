@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+import db
+import migrations
+import scratch
+
+DATABASE = 'data/danceshare.db'
+TEMP_FOLDER = 'tmp'
+
+
+@pytest.fixture
+def con(workdir):
+    os.makedirs('data')
+    os.makedirs(TEMP_FOLDER)
+    migrations.migrate(DATABASE)
+    con = db.connect(DATABASE)
+    con.execute("INSERT INTO users (username, hash, size) VALUES ('dancer', 'x', 0)")
+    con.commit()
+    yield con
+    con.close()
+
+
+def test_stale_folders_are_deleted(con):
+    for name in ('job_1', 'job_2'):
+        os.makedirs(os.path.join(TEMP_FOLDER, name, 'hls'))
+    con.execute("INSERT INTO jobs (user_id, state, payload, created_at) VALUES (1, 'running', ?, 0)",
+                ('{"work_dir": "tmp/job_2", "pipeline_dir": ""}',))
+    con.commit()
+
+    assert scratch.remove_stale(con, TEMP_FOLDER, min_age=0) == 1
+    # the running job keeps its folder, the trash is gone after the transaction
+    assert os.listdir(TEMP_FOLDER) == ['job_2']
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+import app
+import db
+import migrations
+
+DATABASE = 'data/danceshare.db'
+
+
+@pytest.fixture
+def con(workdir):
+    os.makedirs('data')
+    migrations.migrate(DATABASE)
+    con = db.connect(DATABASE)
+    con.execute("INSERT INTO users (username, hash, size) VALUES ('dancer', 'x', 0)")
+    con.execute("INSERT INTO groups (name, creator_id) VALUES ('crew', 1), ('strangers', 1)")
+    con.execute("INSERT INTO group_members (group_id, user_id) VALUES (1, 1)")
+    con.commit()
+    yield con
+    con.close()
+
+
+def add_video(con, name, description='', group_id=1):
+    cur = con.cursor()
+    cur.execute("INSERT INTO videos (name, description, filepath, user_id, filetype, group_id) VALUES (?, ?, 'x.mp4', 1, 'mp4', ?)",
+                (name, description, group_id))
+    con.commit()
+    return cur.lastrowid
+
+
+def pages(con, q, limit=2):
+    """Ids of all results of a search, page by page, and the cursors on the way"""
+    ids = []
+    cursors = []
+    cursor = None
+    while True:
+        videos, cursor = app.find_videos(con.cursor(), 1, q, cursor=cursor, limit=limit)
+        assert len(videos) <= limit
+        ids += [video[2] for video in videos]
+        if cursor is None:
+            return ids, cursors
+        cursors.append(cursor)
+
+
+def test_newest_videos_page_by_page(con):
+    ids = [add_video(con, f"salsa {i}") for i in range(5)]
+    add_video(con, "salsa elsewhere", group_id=2)
+
+    found, cursors = pages(con, None)
+    assert found == ids[::-1]
+    assert cursors == [str(ids[3]), str(ids[1])]
+
+
+@pytest.mark.parametrize('q, mode', [('sa', '0'), ('salsa', '0'), ('salsx', '1')])
+def test_search_pages_keep_the_order_of_one_query(con, q, mode):
+    # different ranks (more matches in the description) and ties
+    ids = [add_video(con, f"salsa {i}", "salsa " * (i % 3)) for i in range(7)]
+    add_video(con, "salsa elsewhere", group_id=2)
+    add_video(con, "tango")
+
+    everything, cursor = app.find_videos(con.cursor(), 1, q, limit=100)
+    assert cursor is None
+    assert sorted(video[2] for video in everything) == ids
+
+    found, cursors = pages(con, q, limit=3)
+    assert found == [video[2] for video in everything]
+    # the exact query found something, or the fuzzy one is paged
+    assert all(cursor.startswith(mode + ':') for cursor in cursors)
+
+
+def test_index_follows_the_videos_and_groups(con):
+    def matches(index, match):
+        return [row[0] for row in con.execute(f"SELECT rowid FROM {index} WHERE {index} MATCH ?", (match,))]
+
+    video_id = add_video(con, "Bachata basics", "first steps")
+    assert matches('videos_fts', 'bach*') == [video_id]
+    assert matches('videos_trgm', '"asic"') == [video_id]
+
+    con.execute("UPDATE videos SET name = 'Kizomba', description = 'turns' WHERE id = ?", (video_id,))
+    con.execute("UPDATE groups SET description = 'Thursday practice' WHERE id = 1")
+    con.commit()
+    assert matches('videos_fts', 'bach*') == []
+    assert matches('videos_trgm', '"asic"') == []
+    assert matches('videos_fts', 'kizomba') == [video_id]
+    assert matches('videos_trgm', '"urns"') == [video_id]
+    assert matches('groups_fts', 'thurs*') == [1]
+    assert matches('groups_trgm', '"practice"') == [1]
+
+    # the videos go with their group
+    con.execute("DELETE FROM groups WHERE id = 1")
+    con.commit()
+    assert matches('videos_fts', 'kizomba') == []
+    assert matches('videos_trgm', '"urns"') == []
+    assert matches('groups_fts', 'crew') == []
+    for index in ('videos_fts', 'videos_trgm', 'groups_fts', 'groups_trgm'):
+        con.execute(f"INSERT INTO {index} ({index}) VALUES ('integrity-check')")
@@ -0,0 +1,56 @@
+from flask import Flask, session
+
+import session_store
+
+
+def make_app(store):
+    app = Flask(__name__)
+    app.session_interface = session_store.ServerSessionInterface(store)
+
+    @app.route('/visit')
+    def visit():
+        session['theme'] = 'dark'
+        return ''
+
+    @app.route('/login/<int:user_id>')
+    def login(user_id):
+        session.clear()
+        session['user_id'] = user_id
+        return ''
+
+    @app.route('/logout')
+    def logout():
+        session.clear()
+        return ''
+
+    return app
+
+
+def sid(client):
+    cookie = client.get_cookie('session')
+    return cookie.value if cookie else None
+
+
+def test_login_gets_a_new_session_id():
+    store = session_store.MemorySessionStore()
+    client = make_app(store).test_client()
+
+    client.get('/visit')
+    # an id an attacker could have planted before the login
+    planted = sid(client)
+    assert store.load(planted) is not None
+
+    client.get('/login/1')
+    assert sid(client) != planted
+    assert store.load(planted) is None
+    assert store.load(sid(client)) is not None
+
+    # logging in as another user changes it again
+    first = sid(client)
+    client.get('/login/2')
+    assert sid(client) != first
+    assert store.load(first) is None
+
+    client.get('/logout')
+    assert sid(client) is None
+    assert store.sessions == {}
@@ -0,0 +1,44 @@
+import tomp4
+
+
+def probe(width, height, codec='h264', bitrate=1500000, rotation=0):
+    return {'width': width, 'height': height, 'codec': codec, 'pix_fmt': 'yuv420p', 'bitrate': bitrate,
+            'rotation': rotation, 'has_audio': True, 'audio_codec': 'aac'}
+
+
+def names(command):
+    return command[command.index('-var_stream_map') + 1]
+
+
+def test_ladder_uses_the_transcode_profile():
+    command = tomp4.hls_command('in.mp4', 'hls', probe(1920, 1080, codec='hevc'), profile='fast')
+    assert command[command.index('-preset') + 1] == 'veryfast'
+    assert 'copy' not in command
+    assert names(command) == "v:0,a:0,name:360p v:1,a:1,name:720p v:2,a:2,name:1080p"
+
+
+def test_browser_playable_input_is_copied():
+    # as big as a rung: copied instead of encoded
+    command = tomp4.hls_command('in.mp4', 'hls', probe(1280, 720))
+    assert command[command.index('-c:v:1') + 1] == 'copy'
+    assert command[command.index('-filter_complex') + 1].startswith('[0:v]split=1[v0]')
+    assert names(command) == "v:0,a:0,name:360p v:1,a:1,name:720p"
+
+    # between two rungs: added on top
+    assert names(tomp4.hls_command('in.mp4', 'hls', probe(960, 540))) == "v:0,a:0,name:360p v:1,a:1,name:540p"
+
+    # smaller than the smallest rung: only the copy, nothing to encode
+    command = tomp4.hls_command('in.mp4', 'hls', probe(426, 240, bitrate=600000))
+    assert '-filter_complex' not in command
+    assert names(command) == "v:0,a:0,name:240p"
+
+
+def test_input_is_not_copied_above_the_rung_bitrate_or_rotated():
+    assert 'copy' not in tomp4.hls_command('in.mp4', 'hls', probe(1280, 720, bitrate=8000000))
+    assert 'copy' not in tomp4.hls_command('in.mp4', 'hls', probe(720, 1280, rotation=90))
+
+
+def test_timeout_grows_with_the_video():
+    assert tomp4.ffmpeg_timeout(None, 300) == 300
+    assert tomp4.ffmpeg_timeout(30, 300) == 300
+    assert tomp4.ffmpeg_timeout(3600, 300) == 3600 * tomp4.FFMPEG_TIMEOUT_FACTOR
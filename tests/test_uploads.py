@@ -0,0 +1,73 @@
+import io
+import os
+import zlib
+
+import pytest
+
+import db
+import migrations
+import quota
+import uploads
+
+DATABASE = 'data/danceshare.db'
+
+
+@pytest.fixture
+def con(workdir):
+    os.makedirs('data')
+    os.makedirs('tmp')
+    migrations.migrate(DATABASE)
+    con = db.connect(DATABASE)
+    con.execute("INSERT INTO users (username, hash, size) VALUES ('dancer', 'x', 0)")
+    con.execute("INSERT INTO groups (name, creator_id) VALUES ('crew', 1)")
+    con.commit()
+    yield con
+    con.close()
+
+
+def put(con, session, chunk_number, data, crc32=None):
+    crc32 = zlib.crc32(data) if crc32 is None else crc32
+    return uploads.put_chunk(con, session, chunk_number, io.BytesIO(data), len(data), crc32)
+
+
+def test_chunk_being_written_is_not_written_again(con):
+    session = uploads.create_session(con, 'tmp', 1, 'dance.mkv', 'Dance', '', 1, 8, chunk_size=4)
+    # another request claimed chunk 0 and is writing it
+    con.execute("INSERT INTO upload_chunks (upload_id, chunk_number, crc32, writing_since) VALUES (?, 0, ?, ?)",
+                (session['id'], zlib.crc32(b'abcd'), uploads.nowtime()))
+    con.commit()
+
+    with pytest.raises(uploads.UploadError) as error:
+        put(con, session, 0, b'abcd')
+    assert error.value.status == 503
+    assert uploads.status(con, session)['received'] == '00'
+
+
+def test_bad_checksum_gives_the_claim_back(con):
+    session = uploads.create_session(con, 'tmp', 1, 'dance.mkv', 'Dance', '', 1, 8, chunk_size=4)
+
+    with pytest.raises(uploads.UploadError) as error:
+        put(con, session, 0, b'abxx', zlib.crc32(b'abcd'))
+    assert error.value.status == 422
+    assert put(con, session, 0, b'abcd') == 4
+    # received chunks are never written again
+    assert put(con, session, 0, b'abcd') is None
+    with pytest.raises(uploads.UploadError) as error:
+        put(con, session, 0, b'zzzz')
+    assert error.value.status == 409
+    with open(session['path'], 'rb') as f:
+        assert f.read(4) == b'abcd'
+
+
+def test_deleting_the_group_aborts_its_uploads(con):
+    cur = con.cursor()
+    assert quota.reserve(cur, 1, 8, 100)
+    session = uploads.create_session(con, 'tmp', 1, 'dance.mkv', 'Dance', '', 1, 8, chunk_size=4)
+
+    folders = uploads.delete_group_sessions(cur, 1)
+    cur.execute("DELETE FROM groups WHERE id = 1")
+    con.commit()
+
+    assert folders == [os.path.dirname(session['path'])]
+    assert quota.used(cur, 1) == 0
+    assert con.execute("SELECT COUNT(*) FROM upload_sessions").fetchone()[0] == 0
@@ -1,68 +1,109 @@
-from werkzeug.utils import secure_filename
-from werkzeug.datastructures import FileStorage
+import io
+import json
 import os
 import subprocess
-import uuid
-from io import BytesIO
 import magic
 import shutil
+import struct
 
-def convert_to_mp4(video_file):
+import metrics
+
+# x264 settings for videos that have to be encoded, pick one with the
+# TRANSCODE_PROFILE environment variable (measure with benchmarks/transcode.py)
+TRANSCODE_PROFILES = {
+    'fast': {'preset': 'veryfast', 'crf': 23},
+    'balanced': {'preset': 'medium', 'crf': 23},
+    'small': {'preset': 'slow', 'crf': 26},
+}
+TRANSCODE_PROFILE = os.environ.get('TRANSCODE_PROFILE', 'balanced')
+# Seconds FFmpeg may run per second of video before it is stopped, long
+# videos get more time (short ones at least the minimum of the conversion)
+FFMPEG_TIMEOUT_FACTOR = float(os.environ.get('FFMPEG_TIMEOUT_FACTOR', 5))
+
+def ffmpeg_timeout(duration, minimum):
+    """Seconds FFmpeg may take for a video of duration seconds (None if unknown)"""
+    return max(minimum, (duration or 0) * FFMPEG_TIMEOUT_FACTOR)
+
+def video_encode_args(profile=None):
+    """
+    FFmpeg arguments for encoding the video stream with a profile.
+
+    Args:
+        profile: name from TRANSCODE_PROFILES or a dict with preset, crf and
+                 optionally threads, TRANSCODE_PROFILE if None
     """
-    Convert uploaded video file to MP4 format using FFmpeg and return as FileStorage.
+    if not isinstance(profile, dict):
+        profile = TRANSCODE_PROFILES[profile or TRANSCODE_PROFILE]
+    args = [
+        '-c:v', 'libx264',                  # Video codec
+        '-preset', profile['preset'],       # Compression preset
+        '-crf', str(profile['crf']),        # Constant Rate Factor (quality)
+        '-pix_fmt', 'yuv420p',              # 8 bit 4:2:0, the only one every browser plays
+    ]
+    if profile.get('threads'):
+        args += ['-threads', str(profile['threads'])]
+    return args
+
+def mp4_command(input_path, output_path, copy_video=False, copy_audio=False, profile=None):
+    """FFmpeg command of convert_to_mp4()"""
+    command = [
+        'ffmpeg',
+        '-i', input_path,
+        # first video and audio stream only (MOV data and timecode tracks don't fit in MP4)
+        '-map', '0:v:0', '-map', '0:a:0?',
+    ]
+    if copy_video:
+        command += ['-c:v', 'copy']
+    else:
+        command += video_encode_args(profile)
+    if copy_audio:
+        command += ['-c:a', 'copy']
+    else:
+        command += [
+            '-c:a', 'aac',         # Audio codec
+            '-b:a', '128k',        # Audio bitrate
+        ]
+    command += [
+        '-movflags', '+faststart',  # Enable streaming
+        '-y',                  # Overwrite output file if exists
+        output_path
+    ]
+    return command
+
+@metrics.timed(metrics.CONVERT_SECONDS)
+def convert_to_mp4(input_path, output_path, copy_video=False, copy_audio=False, profile=None, duration=None):
+    """
+    Convert a video file on disk to MP4 format using FFmpeg.
     Supports various input formats including: MOV, AVI, WMV, FLV, MKV, WEBM, etc.
     
     Args:
-        video_file: FileStorage object from request.files
+        input_path: path of the uploaded video file
+        output_path: path the MP4 file is written to
+        copy_video: keep the video stream as it is instead of encoding it
+        copy_audio: keep the audio stream as it is instead of encoding it
+        profile: x264 settings, see video_encode_args()
+        duration: length of the video in seconds, for the timeout
         
     Returns:
-        tuple: (FileStorage, size) of converted MP4 file if successful, None if failed
+        int: size of the converted MP4 file if successful, None if failed
     """
-    temp_path = None
-    output_path = None
-    
     try:
-        # Create temporary directory if it doesn't exist
-        temp_dir = 'temp_uploads'
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # Generate secure filenames
-        temp_filename = str(uuid.uuid4()) + '_' + secure_filename(video_file.filename)
-        output_filename = os.path.splitext(temp_filename)[0] + '.mp4'
-        
-        temp_path = os.path.join(temp_dir, temp_filename)
-        output_path = os.path.join(temp_dir, output_filename)
-        
-        # Save uploaded file temporarily
-        video_file.save(temp_path)
-        
         # Check if the file is actually a video
         mime = magic.Magic(mime=True)
-        file_mime = mime.from_file(temp_path)
+        file_mime = mime.from_file(input_path)
         
         if not file_mime.startswith('video/'):
             raise Exception(f"Uploaded file is not a video. Detected MIME type: {file_mime}")
         
         # Convert video to MP4 using FFmpeg with more robust settings
-        command = [
-            'ffmpeg',
-            '-i', temp_path,
-            '-c:v', 'libx264',     # Video codec
-            '-preset', 'medium',   # Compression preset
-            '-crf', '23',          # Constant Rate Factor (quality)
-            '-c:a', 'aac',         # Audio codec
-            '-b:a', '128k',        # Audio bitrate
-            '-movflags', '+faststart',  # Enable streaming
-            '-y',                  # Overwrite output file if exists
-            output_path
-        ]
+        command = mp4_command(input_path, output_path, copy_video, copy_audio, profile)
         
-        # Run FFmpeg command with timeout
+        # Run FFmpeg command with timeout (at least 5 minutes)
         result = subprocess.run(
             command,
-            stdout=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
-            timeout=300  # 5 minute timeout
+            timeout=ffmpeg_timeout(duration, 300)
         )
         
         # Check if conversion was successful
@@ -73,200 +114,409 @@ def convert_to_mp4(video_file):
         if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
             raise Exception("Conversion failed: Output file is empty or missing")
         
-        # Create FileStorage object from the converted file
-        with open(output_path, 'rb') as f:
-            file_data = BytesIO(f.read())
-            
-        converted_file = FileStorage(
-            stream=file_data,
-            filename=output_filename,
-            content_type='video/mp4'
-        )
-
-        # get the size of the converted file
-        try:
-            converted_file_size = os.path.getsize(output_path)
-        except:
-            converted_file_size = None
-        
-        return converted_file, converted_file_size
+        return os.path.getsize(output_path)
         
     except subprocess.TimeoutExpired:
-        print("Conversion timed out after 5 minutes")
-        return None
+        print(f"Conversion timed out after {ffmpeg_timeout(duration, 300):.0f} s")
     except Exception as e:
         print(f"Error during conversion: {str(e)}")
+
+    # Don't leave a half written output behind
+    if os.path.exists(output_path):
+        try:
+            os.remove(output_path)
+        except:
+            pass
+    return None
+
+# Streams every browser plays from an MP4 as they are
+BROWSER_VIDEO_CODECS = {'h264'}
+BROWSER_PIXEL_FORMATS = {'yuv420p', 'yuvj420p'}
+BROWSER_AUDIO_CODECS = {'aac', 'mp3'}
+
+def _first_box(f):
+    """
+    Walk the top level boxes of an MP4/MOV until moov or mdat.
+
+    Returns:
+        tuple: (major brand of the ftyp box, True if moov comes first,
+                False if mdat does, None if the data ended before either)
+    """
+    brand = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return brand, None
+        size, kind = struct.unpack('>I4s', header)
+        if kind == b'ftyp':
+            brand = f.read(4).decode('latin-1')
+            size -= 4
+        elif kind == b'moov':
+            return brand, True
+        elif kind == b'mdat':
+            return brand, False
+        if size == 1:
+            # 64 bit size follows the header
+            size = struct.unpack('>Q', f.read(8))[0] - 8
+        elif size < 8:
+            # box runs to the end of the file (or is broken)
+            return brand, False
+        f.seek(size - 8, os.SEEK_CUR)
+
+def mp4_layout(path):
+    """
+    Read the top level boxes of an MP4/MOV file.
+
+    Returns:
+        tuple: (major brand of the ftyp box, True if moov comes before mdat),
+               (None, False) if the file is no MP4/MOV
+    """
+    try:
+        with open(path, 'rb') as f:
+            brand, moov_first = _first_box(f)
+            return brand, bool(moov_first)
+    except (OSError, struct.error) as e:
+        print(f"Error reading MP4 boxes: {str(e)}")
+        return None, False
+
+def streamable(head):
+    """
+    Whether FFmpeg can read a file front to back from a pipe, judged by its start.
+
+    Matroska/WebM and MPEG-TS always can, MP4/MOV only with the moov box
+    before the media data.
+
+    Returns:
+        bool: True or False, None if head is too short to tell
+    """
+    if head[:4] == b'\x1a\x45\xdf\xa3':
+        return True
+    if len(head) > 376 and head[0] == head[188] == head[376] == 0x47:
+        return True
+    if head[4:8] == b'ftyp':
+        try:
+            return _first_box(io.BytesIO(head))[1]
+        except struct.error:
+            return None
+    return False
+
+def codec_route(probe):
+    """What has to be encoded: 'transcode' (video), 'transcode_audio' or None (nothing)"""
+    if probe['codec'] not in BROWSER_VIDEO_CODECS or probe['pix_fmt'] not in BROWSER_PIXEL_FORMATS:
+        return 'transcode'
+    if probe['audio_codec'] is not None and probe['audio_codec'] not in BROWSER_AUDIO_CODECS:
+        return 'transcode_audio'
+    return None
+
+def choose_route(input_path, probe):
+    """
+    Cheapest way to a browser playable MP4.
+
+    Returns:
+        str: 'keep' (already a streamable MP4), 'remux' (copy the streams
+             into a new MP4 with the moov box first), 'transcode_audio' or
+             'transcode'
+    """
+    route = codec_route(probe)
+    if route is not None:
+        return route
+
+    brand, faststart = mp4_layout(input_path)
+    # 'qt  ' is a QuickTime .mov, the rest of the family (isom, mp42, ...) are MP4s
+    if brand is not None and brand != 'qt  ' and faststart and probe['streams'] <= 2:
+        return 'keep'
+    return 'remux'
+
+def to_browser_mp4(input_path, output_path, probe):
+    """
+    Turn an upload into a streamable MP4, re-encoding only what browsers can't play.
+
+    Most phone videos are H.264/AAC already, they are only remuxed (or kept
+    as they are), which is a lot cheaper than encoding them again.
+
+    Args:
+        input_path: path of the uploaded video file
+        output_path: path the MP4 file is written to
+        probe: probe_video() of the input
+
+    Returns:
+        str: the route taken (see choose_route()), None if failed
+    """
+    route = choose_route(input_path, probe)
+    print(f"Preparing mp4: {route} ({probe['codec']}/{probe['pix_fmt']}, audio {probe['audio_codec']})")
+
+    if route == 'keep':
+        os.replace(input_path, output_path)
+        return route
+
+    if route in ('remux', 'transcode_audio'):
+        if convert_to_mp4(input_path, output_path, copy_video=True, copy_audio=route == 'remux',
+                          duration=probe['duration']) is not None:
+            return route
+        print("Stream copy failed, encoding the video instead")
+
+    if convert_to_mp4(input_path, output_path, copy_audio=probe['audio_codec'] == 'aac', duration=probe['duration']) is None:
         return None
-        
-    finally:
-        # Clean up temporary files
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
-        if output_path and os.path.exists(output_path):
+    return 'transcode'
+
+# Quality presets (360p, 720p, 1080p) of the HLS ladder
+QUALITY_PRESETS = {
+    'low': {
+        'height': 360,
+        'bitrate': '800k',
+        'audio_bitrate': '96k',
+        'crf': '28'
+    },
+    'medium': {
+        'height': 720,
+        'bitrate': '2000k',
+        'audio_bitrate': '128k',
+        'crf': '23'
+    },
+    'high': {
+        'height': 1080,
+        'bitrate': '4000k',
+        'audio_bitrate': '192k',
+        'crf': '20'
+    }
+}
+
+# Length of one HLS segment in seconds (key frames are forced on segment boundaries)
+HLS_SEGMENT_TIME = 4
+
+def _rate(value):
+    """ffprobe frame rate like '30000/1001' as a float, None if unknown"""
+    try:
+        num, _, den = (value or '').partition('/')
+        num, den = float(num), float(den or 1)
+    except ValueError:
+        return None
+    if num <= 0 or den <= 0:
+        return None
+    return num / den
+
+def _number(value, type=float):
+    try:
+        return type(value)
+    except (TypeError, ValueError):
+        return None
+
+def probe_video(video_path, data=None):
+    """
+    Read everything we store about a video with a single ffprobe run.
+
+    Args:
+        video_path: file to probe
+        data: probe these bytes (the start of a file) instead of video_path
+
+    Returns:
+        dict: duration (s), width, height, codec, bitrate (bit/s), fps,
+              rotation (degrees), has_audio, and for picking the conversion
+              pix_fmt, audio_codec and streams (count), None if probing
+              failed or the file has no video stream
+    """
+    command = [
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'format=duration,bit_rate:stream=codec_type,codec_name,pix_fmt,width,height,avg_frame_rate,r_frame_rate,duration,bit_rate:stream_tags=rotate:stream_side_data=rotation',
+        '-of', 'json',
+        video_path if data is None else 'pipe:0'
+    ]
+    try:
+        result = subprocess.run(command, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30)
+        info = json.loads(result.stdout or b'{}')
+    except (subprocess.TimeoutExpired, ValueError, OSError) as e:
+        print(f"Error probing video: {str(e)}")
+        return None
+
+    streams = info.get('streams', [])
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+    if video is None:
+        print(f"Error probing video: no video stream in '{video_path}'")
+        return None
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), None)
+    container = info.get('format', {})
+
+    # rotation is a tag in older files and display matrix side data in newer ones
+    rotation = _number(video.get('tags', {}).get('rotate'), int)
+    for side_data in video.get('side_data_list', []):
+        if 'rotation' in side_data:
+            rotation = _number(side_data['rotation'], int)
+
+    return {
+        'duration': _number(container.get('duration')) or _number(video.get('duration')),
+        'width': _number(video.get('width'), int),
+        'height': _number(video.get('height'), int),
+        'codec': video.get('codec_name'),
+        'bitrate': _number(container.get('bit_rate'), int) or _number(video.get('bit_rate'), int),
+        'fps': _rate(video.get('avg_frame_rate')) or _rate(video.get('r_frame_rate')),
+        'rotation': (rotation or 0) % 360,
+        'has_audio': audio is not None,
+        'pix_fmt': video.get('pix_fmt'),
+        'audio_codec': audio.get('codec_name') if audio is not None else None,
+        'streams': len(streams),
+    }
+
+def keyframe_times(video_path):
+    """
+    Timestamps (in seconds) of the key frames of a video.
+
+    Only the container is read (packet flags), nothing is decoded.
+
+    Returns:
+        list: sorted timestamps, empty if probing failed
+    """
+    command = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0',
+        video_path
+    ]
+    try:
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+    except (subprocess.TimeoutExpired, OSError) as e:
+        print(f"Error reading key frames: {str(e)}")
+        return []
+
+    times = []
+    for line in result.stdout.decode(errors='replace').splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags:
             try:
-                os.remove(output_path)
-            except:
+                times.append(float(pts_time))
+            except ValueError:
                 pass
+    return sorted(times)
 
-# NOT used!!!
-def downscale_video(video_file, quality='high'):
+def hls_renditions(probe, presets=('low', 'medium', 'high')):
     """
-    Downscale MP4 video file with different quality presets.
-    
+    Renditions of the HLS ladder for a video.
+
+    Renditions bigger than the input are skipped, the smallest one is always
+    made. A browser playable input (H.264, not rotated) at or below the next
+    rung and not above its bitrate is copied as it is instead of being
+    encoded again: it takes the place of that rung, or is added on top when
+    the rung would be bigger than the input.
+
+    Returns:
+        list: (height, settings from QUALITY_PRESETS, copy) from smallest to largest
+    """
+    short_side = min(probe['width'], probe['height'])
+    renditions = [(QUALITY_PRESETS[p]['height'], QUALITY_PRESETS[p], False) for p in presets
+                  if QUALITY_PRESETS[p]['height'] <= short_side] or [(QUALITY_PRESETS[presets[0]]['height'], QUALITY_PRESETS[presets[0]], False)]
+
+    # first rung at or above the input
+    rung = next((QUALITY_PRESETS[p] for p in presets if QUALITY_PRESETS[p]['height'] >= short_side), None)
+    copy = (rung is not None and codec_route(probe) is None and not probe.get('rotation')
+            and probe.get('bitrate') and probe['bitrate'] <= int(rung['bitrate'].replace('k', '')) * 1000)
+    if not copy:
+        return renditions
+    if renditions[-1][0] >= short_side:
+        # the input is as big as the largest rung (or smaller than the smallest)
+        renditions.pop()
+    return renditions + [(short_side, rung, True)]
+
+def hls_command(input_path, output_dir, probe, presets=('low', 'medium', 'high'), profile=None):
+    """FFmpeg command of build_hls_ladder()"""
+    if not isinstance(profile, dict):
+        profile = TRANSCODE_PROFILES[profile or TRANSCODE_PROFILE]
+    renditions = hls_renditions(probe, presets)
+    encoded = [i for i, (_, _, copy) in enumerate(renditions) if not copy]
+
+    filters = []
+    if encoded:
+        filters.append(f"[0:v]split={len(encoded)}" + ''.join(f"[v{i}]" for i in encoded))
+    outputs = []
+    stream_map = []
+    for i, (h, settings, copy) in enumerate(renditions):
+        if copy:
+            outputs += ['-map', '0:v:0', f'-c:v:{i}', 'copy']
+        else:
+            filters.append(f"[v{i}]scale=w='if(gte(iw,ih),-2,{h})':h='if(gte(iw,ih),{h},-2)'[v{i}out]")
+            outputs += [
+                '-map', f'[v{i}out]',
+                f'-c:v:{i}', 'libx264',
+                f'-crf:v:{i}', settings['crf'],
+                f'-maxrate:v:{i}', settings['bitrate'],
+                f'-bufsize:v:{i}', str(int(settings['bitrate'].replace('k', '')) * 2) + 'k',
+            ]
+        if probe['has_audio']:
+            outputs += ['-map', 'a:0', f'-c:a:{i}', 'aac', f'-b:a:{i}', settings['audio_bitrate']]
+            stream_map.append(f"v:{i},a:{i},name:{h}p")
+        else:
+            stream_map.append(f"v:{i},name:{h}p")
+
+    command = ['ffmpeg', '-i', input_path]
+    if filters:
+        command += ['-filter_complex', ';'.join(filters)]
+    command += outputs + ['-preset', profile['preset']]
+    if profile.get('threads'):
+        command += ['-threads', str(profile['threads'])]
+    command += [
+        # same key frames in every encoded rendition, so players can switch between them
+        '-force_key_frames', f'expr:gte(t,n_forced*{HLS_SEGMENT_TIME})',
+        '-sc_threshold', '0',
+        '-f', 'hls',
+        '-hls_time', str(HLS_SEGMENT_TIME),
+        '-hls_playlist_type', 'vod',
+        '-hls_segment_filename', os.path.join(output_dir, '%v', 'seg_%03d.ts'),
+        '-master_pl_name', 'master.m3u8',
+        '-var_stream_map', ' '.join(stream_map),
+        '-y',
+        os.path.join(output_dir, '%v', 'index.m3u8')
+    ]
+    return command
+
+def build_hls_ladder(input_path, output_dir, presets=('low', 'medium', 'high'), probe=None, profile=None):
+    """
+    Create a segmented HLS rendition ladder with a master playlist.
+
+    All renditions are encoded by one FFmpeg process from a single decode of
+    the input, with the x264 preset of the profile. Portrait videos are
+    scaled by their width, so every rendition keeps the aspect ratio of the
+    input. See hls_renditions() for which renditions are made.
+
     Args:
-        video_file: FileStorage object containing MP4 video
-        quality: String indicating quality preset ('low', 'medium', 'high')
-    
+        input_path: path of the (mp4) video
+        output_dir: folder for master.m3u8 and one sub folder per rendition
+        presets: names from QUALITY_PRESETS, from smallest to largest
+        probe: probe_video() of the input, probed here if not given
+        profile: x264 settings, see video_encode_args()
+
     Returns:
-        FileStorage: Downscaled video file if successful, None if failed
+        str: path of the master playlist if successful, None if failed
     """
-    temp_path = None
-    output_path = None
-    
+    if probe is None:
+        probe = probe_video(input_path)
+    if not probe or not probe['width'] or not probe['height']:
+        print("Error building HLS: could not read video size")
+        return None
+
+    command = hls_command(input_path, output_dir, probe, presets, profile)
+    # every rendition is encoded in the same pass, at least 10 minutes
+    timeout = ffmpeg_timeout(probe['duration'], 600)
+
     try:
-        # Get FFmpeg path
-        ffmpeg_path = shutil.which('ffmpeg')
-        if ffmpeg_path is None:
-            raise Exception("FFmpeg not found. Please install FFmpeg and add it to system PATH")
-            
-        # Create temporary directory if it doesn't exist
-        temp_dir = 'temp_uploads'
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # Generate secure filenames
-        temp_filename = str(uuid.uuid4()) + '_' + secure_filename(video_file.filename)
-        output_filename = f"downscaled_{secure_filename(video_file.filename)}"
-        
-        temp_path = os.path.join(temp_dir, temp_filename)
-        output_path = os.path.join(temp_dir, output_filename)
-        
-        # Save uploaded file temporarily
-        video_file.save(temp_path)
-        
-        # Quality presets
-        quality_settings = {
-            'low': {
-                'scale': '640:360',  # 360p
-                'bitrate': '800k',
-                'audio_bitrate': '96k',
-                'crf': '28'
-            },
-            'medium': {
-                'scale': '1280:720',  # 720p
-                'bitrate': '2000k',
-                'audio_bitrate': '128k',
-                'crf': '23'
-            },
-            'high': {
-                'scale': '1920:1080',  # 1080p
-                'bitrate': '4000k',
-                'audio_bitrate': '192k',
-                'crf': '20'
-            }
-        }
-        
-        # Get settings for selected quality
-        settings = quality_settings.get(quality.lower(), quality_settings['medium'])
-        
-        # Build FFmpeg command for downscaling
-        command = [
-            ffmpeg_path,
-            '-i', temp_path,
-            '-vf', f'scale={settings["scale"]}:force_original_aspect_ratio=decrease,pad={settings["scale"]}:-1:-1:color=black',
-            '-c:v', 'libx264',
-            '-preset', 'medium',
-            '-crf', settings['crf'],
-            '-maxrate', settings['bitrate'],
-            '-bufsize', str(int(settings['bitrate'].replace('k', '')) * 2) + 'k',
-            '-c:a', 'aac',
-            '-b:a', settings['audio_bitrate'],
-            '-movflags', '+faststart',
-            '-y',
-            output_path
-        ]
-        
+        os.makedirs(output_dir, exist_ok=True)
         print(f"Running FFmpeg command: {' '.join(command)}")
-        
-        # Run FFmpeg command
         result = subprocess.run(
             command,
-            stdout=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
-            timeout=300  # 5 minute timeout
+            timeout=timeout
         )
-        
-        # Check if conversion was successful
         if result.returncode != 0:
-            raise Exception(f"FFmpeg conversion failed: {result.stderr.decode()}")
-        
-        # Verify the output file exists and has size
-        if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-            raise Exception("Conversion failed: Output file is empty or missing")
-        
-        # Create FileStorage object from the converted file
-        with open(output_path, 'rb') as f:
-            file_data = BytesIO(f.read())
-            
-        converted_file = FileStorage(
-            stream=file_data,
-            filename=output_filename,
-            content_type='video/mp4'
-        )
-        
-        return converted_file
-        
-    except Exception as e:
-        print(f"Error during downscaling: {str(e)}")
-        return None
-        
-    finally:
-        # Clean up temporary files
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
-        if output_path and os.path.exists(output_path):
-            try:
-                os.remove(output_path)
-            except:
-                pass
+            raise Exception(f"FFmpeg HLS failed: {result.stderr.decode()}")
 
-def video_size_save(video_file):
-    temp_path = None
-    try:
-        # Create temporary directory if it doesn't exist
-        temp_dir = 'temp_uploads'
-        os.makedirs(temp_dir, exist_ok=True)
-
-        temp_filename = str(uuid.uuid4()) + '_' + secure_filename(video_file.filename)
-        temp_path = os.path.join(temp_dir, temp_filename)
-
-        # Save uploaded file temporarily
-        video_file.save(temp_path)
-
-        # Get file size
-        file_size = os.path.getsize(temp_path)
-
-        # Create new FileStorage object
-        with open(temp_path, 'rb') as f:
-            file_data = BytesIO(f.read())
-            
-        new_file = FileStorage(
-            stream=file_data,
-            filename=temp_filename,
-            content_type='video/mp4'
-        )
+        master_path = os.path.join(output_dir, 'master.m3u8')
+        if not os.path.exists(master_path):
+            raise Exception("HLS failed: master playlist is missing")
+        return master_path
 
-        return new_file, file_size
-    
-    finally:
-        # Clean up temporary files
-        if os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
\ No newline at end of file
+    except subprocess.TimeoutExpired:
+        print(f"HLS encoding timed out after {timeout:.0f} s")
+    except Exception as e:
+        print(f"Error building HLS: {str(e)}")
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    return None
@@ -0,0 +1,256 @@
+import errno
+import os
+import shutil
+import uuid
+from time import perf_counter, time as nowtime
+
+import metrics
+import quota
+from helpers import write_chunk
+
+# Size of the chunks clients send, the last one may be shorter
+CHUNK_SIZE = 8 * 1024 * 1024
+# A chunk claimed by a request that didn't finish writing it for this long
+# (in seconds) can be sent again (the worker died)
+CLAIM_TIMEOUT = 10 * 60
+
+SESSION_COLUMNS = ('id', 'user_id', 'filename', 'video_name', 'description', 'group_id',
+                   'file_size', 'chunk_size', 'total_chunks', 'path', 'created_at', 'updated_at', 'pipeline_dir')
+
+
+class UploadError(Exception):
+    """Request can't be applied to the upload, status is the HTTP status code"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def preallocate(path, size):
+    """Create the upload file with its final size, so chunks can be written anywhere in it"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        try:
+            # reserves the disk space, a full disk fails now and not halfway through
+            os.posix_fallocate(fd, 0, size)
+        except AttributeError:
+            os.ftruncate(fd, size)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+            os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def create_session(con, temp_folder, user_id, filename, video_name, description, group_id, file_size, chunk_size=CHUNK_SIZE):
+    """
+    Start a new upload and return its session as a dict.
+
+    Every upload gets its own folder named after the upload id, so two
+    uploads with the same name don't share a file.
+    """
+    upload_id = uuid.uuid4().hex
+    folder = os.path.join(temp_folder, f"upload_{upload_id}")
+    os.makedirs(folder)
+    path = os.path.join(folder, 'upload.part')
+    preallocate(path, file_size)
+
+    now = nowtime()
+    session = dict(zip(SESSION_COLUMNS, (upload_id, user_id, filename, video_name, description, group_id,
+                                         file_size, chunk_size, -(-file_size // chunk_size), path, now, now, None)))
+    con.execute(f"INSERT INTO upload_sessions ({', '.join(SESSION_COLUMNS)}) VALUES ({', '.join('?' * len(SESSION_COLUMNS))})",
+                tuple(session.values()))
+    con.commit()
+    return session
+
+
+def get_session(con, upload_id, user_id):
+    """Return the upload as a dict, None if it doesn't exist or belongs to somebody else"""
+    cur = con.cursor()
+    cur.execute(f"SELECT {', '.join(SESSION_COLUMNS)} FROM upload_sessions WHERE id = ? AND user_id = ?", (upload_id, user_id))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return dict(zip(SESSION_COLUMNS, row))
+
+
+def received_chunks(con, upload_id):
+    cur = con.cursor()
+    cur.execute("SELECT chunk_number FROM upload_chunks WHERE upload_id = ? AND writing_since IS NULL", (upload_id,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def bitmap(session, received):
+    """Received chunks as a string with '1' for every received and '0' for every missing chunk"""
+    bits = bytearray(b'0' * session['total_chunks'])
+    for chunk_number in received:
+        bits[chunk_number] = ord('1')
+    return bits.decode()
+
+
+def next_missing_chunk(con, session, start=0):
+    """First chunk from start on that was not received yet (total_chunks if none is missing)"""
+    cur = con.cursor()
+    cur.execute("SELECT chunk_number FROM upload_chunks WHERE upload_id = ? AND chunk_number >= ? AND writing_since IS NULL ORDER BY chunk_number",
+                (session['id'], start))
+    next_chunk = start
+    for (chunk_number,) in cur.fetchall():
+        if chunk_number != next_chunk:
+            break
+        next_chunk += 1
+    return next_chunk
+
+
+def received_bytes(con, session, start=0):
+    """Bytes from the start of the file that are received without a gap"""
+    return min(next_missing_chunk(con, session, start) * session['chunk_size'], session['file_size'])
+
+
+def chunk_length(session, chunk_number):
+    """Expected size of a chunk (the last one holds the rest of the file)"""
+    offset = chunk_number * session['chunk_size']
+    return min(session['chunk_size'], session['file_size'] - offset)
+
+
+def status(con, session):
+    """What the client needs to resume the upload"""
+    received = received_chunks(con, session['id'])
+    return {
+        'upload_id': session['id'],
+        'file_size': session['file_size'],
+        'chunk_size': session['chunk_size'],
+        'total_chunks': session['total_chunks'],
+        'received': bitmap(session, received),
+        'missing': session['total_chunks'] - len(received),
+    }
+
+
+def put_chunk(con, session, chunk_number, stream, length, crc32):
+    """
+    Write one chunk in place and mark it as received.
+
+    The chunk is claimed before it is written and marked as received only
+    after its checksum matched, a received chunk is never written again. A
+    request for a chunk another request is writing gets a 503 and is retried
+    by the client, one whose checksum doesn't match gives its claim back.
+
+    Args:
+        session: upload from get_session()
+        chunk_number: position of the chunk, starting with 0
+        stream: request body
+        length: Content-Length of the request
+        crc32: CRC32 of the chunk computed by the client
+
+    Returns:
+        int: bytes from the start of the file received without a gap, None
+             if the chunk was received before
+    """
+    if not 0 <= chunk_number < session['total_chunks']:
+        raise UploadError("Chunk number out of range.")
+    expected = chunk_length(session, chunk_number)
+    if length != expected:
+        raise UploadError(f"Chunk {chunk_number} must be {expected} bytes, got {length}.")
+
+    # The chunk is claimed before it is written, so two requests for it (a
+    # retry while the first one is still running) never write at the same
+    # time and a received chunk is never written again
+    claimed_at = nowtime()
+    cur = con.cursor()
+    cur.execute("""
+        INSERT INTO upload_chunks (upload_id, chunk_number, crc32, writing_since) VALUES (?, ?, ?, ?)
+        ON CONFLICT (upload_id, chunk_number) DO UPDATE SET crc32 = excluded.crc32, writing_since = excluded.writing_since
+        WHERE writing_since IS NOT NULL AND writing_since < ?
+    """, (session['id'], chunk_number, crc32, claimed_at, claimed_at - CLAIM_TIMEOUT))
+    con.commit()
+    if cur.rowcount != 1:
+        cur.execute("SELECT crc32, writing_since FROM upload_chunks WHERE upload_id = ? AND chunk_number = ?", (session['id'], chunk_number))
+        row = cur.fetchone()
+        if row is not None and row[1] is not None:
+            raise UploadError(f"Chunk {chunk_number} is being received by another request.", 503)
+        if row is not None and row[0] != crc32:
+            raise UploadError(f"Chunk {chunk_number} was already received with other content.", 409)
+        return None
+
+    try:
+        start = perf_counter()
+        written, crc = write_chunk(session['path'], stream, chunk_number * session['chunk_size'], expected)
+        elapsed = perf_counter() - start
+        metrics.UPLOAD_BYTES.inc(value=written)
+        if elapsed > 0:
+            metrics.CHUNK_THROUGHPUT.observe(written / elapsed)
+        if written != expected:
+            raise UploadError(f"Chunk {chunk_number} incomplete: expected {expected} bytes, got {written}.")
+        if crc != crc32:
+            raise UploadError(f"Checksum of chunk {chunk_number} does not match.", 422)
+    except Exception:
+        # give the claim back, the chunk is sent again
+        con.execute("DELETE FROM upload_chunks WHERE upload_id = ? AND chunk_number = ? AND writing_since = ?",
+                    (session['id'], chunk_number, claimed_at))
+        con.commit()
+        raise
+
+    cur.execute("UPDATE upload_chunks SET writing_since = NULL WHERE upload_id = ? AND chunk_number = ? AND writing_since = ?",
+                (session['id'], chunk_number, claimed_at))
+    if cur.rowcount != 1:
+        # took longer than CLAIM_TIMEOUT and another request took over
+        con.rollback()
+        raise UploadError(f"Chunk {chunk_number} took too long, send it again.", 503)
+    con.execute("UPDATE upload_sessions SET updated_at = ? WHERE id = ?", (nowtime(), session['id']))
+    con.commit()
+
+    return received_bytes(con, session)
+
+
+def finish_session(con, session):
+    """
+    Close a complete upload and return the folder holding the file.
+
+    The session row is deleted in the same transaction that checks the
+    chunks, so only one of two concurrent finalize requests gets the file.
+    The caller commits (together with whatever it does with the file).
+    """
+    cur = con.cursor()
+    cur.execute("SELECT COUNT(*) FROM upload_chunks WHERE upload_id = ? AND writing_since IS NULL", (session['id'],))
+    received = cur.fetchone()[0]
+    if received != session['total_chunks']:
+        raise UploadError(f"Upload incomplete: {session['total_chunks'] - received} chunks missing.", 409)
+
+    cur.execute("DELETE FROM upload_sessions WHERE id = ?", (session['id'],))
+    if cur.rowcount != 1:
+        raise UploadError("Upload does not exist.", 404)
+    return os.path.dirname(session['path'])
+
+
+def delete_session(con, session):
+    """Abort an upload, give back its space and remove its file"""
+    if session['pipeline_dir']:
+        # stops the pipelined conversion (see pipeline.py)
+        shutil.rmtree(session['pipeline_dir'], ignore_errors=True)
+    cur = con.cursor()
+    cur.execute("DELETE FROM upload_sessions WHERE id = ?", (session['id'],))
+    if cur.rowcount == 1:
+        quota.release(cur, session['user_id'], session['file_size'])
+    con.commit()
+    shutil.rmtree(os.path.dirname(session['path']), ignore_errors=True)
+
+
+def delete_group_sessions(cur, group_id):
+    """
+    Abort the uploads into a group that is being deleted and give back their space.
+
+    Call in the transaction that deletes the group, the caller commits and
+    then removes the returned upload folders.
+
+    Returns:
+        list: folders of the aborted uploads
+    """
+    cur.execute(f"SELECT {', '.join(SESSION_COLUMNS)} FROM upload_sessions WHERE group_id = ?", (group_id,))
+    sessions = [dict(zip(SESSION_COLUMNS, row)) for row in cur.fetchall()]
+    for session in sessions:
+        if session['pipeline_dir']:
+            # stops the pipelined conversion (see pipeline.py)
+            shutil.rmtree(session['pipeline_dir'], ignore_errors=True)
+        cur.execute("DELETE FROM upload_sessions WHERE id = ?", (session['id'],))
+        quota.release(cur, session['user_id'], session['file_size'])
+    return [os.path.dirname(session['path']) for session in sessions]
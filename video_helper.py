@@ -1,12 +1,18 @@
 import cv2
+import numpy as np
 import os
 
-def extract_frame_at(video_path, time=2):
+import metrics
+from tomp4 import keyframe_times
+
+def extract_frame_at(video_path, time=2, duration=None):
     """
     Extract a frame from a video file after x seconds and save it as an image.
     
     Parameters:
     video_path (str): Path to the input video file
+    duration (float): Length of the video from probe_video(), a shorter video
+                      gives the frame from its middle
     """
     # Check if video file exists
     if not os.path.exists(video_path):
@@ -15,43 +21,29 @@ def extract_frame_at(video_path, time=2):
     
     # Create output filename in the same directory as the video
     output_filename = os.path.splitext(video_path)[0] + ".jpg"
+
+    # Check if video is long enough (the frame count of the container is often wrong, so the probed duration is used)
+    if duration and time >= duration:
+        print(f"Warning: Video is shorter than {time} seconds. Using middle frame instead.")
+        time = duration / 2
     
     # Open the video file
     video = cv2.VideoCapture(video_path)
     
-    # Get video FPS
-    fps = video.get(cv2.CAP_PROP_FPS)
-    if fps <= 0:
-        print("Error: Could not determine video FPS.")
-        video.release()
-        return False
-    
-    # Calculate frame number for {time} seconds
-    frame_number = int(fps * time)
-    
-    # Get total number of frames
-    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-    
-    if total_frames == 0:
-        print("Error: Video appears to be empty or corrupted.")
-        video.release()
-        return False
-    
-    # Check if video is long enough
-    if frame_number >= total_frames:
-        print(f"Warning: Video is shorter than {time} seconds. Using last frame instead.")
-        frame_number = total_frames - 1
-    
-    # Set video to desired frame
-    video.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+    # Set video to desired time
+    video.set(cv2.CAP_PROP_POS_MSEC, time * 1000)
     
     # Read the frame
     success, frame = video.read()
+    if not success and time > 0:
+        # seeking past the end of a video without a known duration
+        video.set(cv2.CAP_PROP_POS_MSEC, 0)
+        success, frame = video.read()
     
     if success:
         # Save the frame
         cv2.imwrite(output_filename, frame)
-        print(f"Successfully extracted frame at {time} seconds (frame {frame_number})")
+        print(f"Successfully extracted frame at {time} seconds")
         print(f"Saved as: {output_filename}")
     else:
         print("Error: Could not extract frame")
@@ -61,49 +53,156 @@ def extract_frame_at(video_path, time=2):
     
     return success
 
-def video_length(video_path):
-    """Get the length of a video in seconds"""
-    if video_path:
-        video = cv2.VideoCapture(video_path)
-        fps = video.get(cv2.CAP_PROP_FPS)
-        frames = video.get(cv2.CAP_PROP_FRAME_COUNT)
-        length = frames / fps
-        video.release()
-        return length
+# Frames looked at when choosing the picture of a video
+THUMBNAIL_SAMPLES = 12
+# Width the sampled frames are scored at
+SCORE_WIDTH = 160
+
+def score_frames(frames):
+    """
+    Score grayscale frames as a picture for the video, all in one pass.
+
+    Sharp frames (variance of the Laplacian), well exposed frames (mean
+    brightness near the middle, few clipped pixels) and frames that differ
+    from their neighbours (not a fade, title or static shot) score high.
+
+    Args:
+        frames: uint8 array (n, height, width)
+
+    Returns:
+        numpy array: score of each frame, higher is better
+    """
+    x = frames.astype(np.float32)
+    n = len(x)
 
-def video_size(video_path):
-    """Get the size of a video in bytes"""
-    if video_path:
-        video = cv2.VideoCapture(video_path)
-        size = os.path.getsize(video_path)
+    laplacian = x[:, :-2, 1:-1] + x[:, 2:, 1:-1] + x[:, 1:-1, :-2] + x[:, 1:-1, 2:] - 4 * x[:, 1:-1, 1:-1]
+    sharpness = np.log1p(laplacian.reshape(n, -1).var(axis=1))
+
+    flat = x.reshape(n, -1)
+    clipped = ((frames < 16) | (frames > 239)).reshape(n, -1).mean(axis=1)
+    exposure = 1 - np.abs(flat.mean(axis=1) - 128) / 128 - clipped
+
+    # mean difference to the previous and next sample
+    change = np.zeros(n, dtype=np.float32)
+    if n > 1:
+        diff = np.abs(np.diff(x, axis=0)).reshape(n - 1, -1).mean(axis=1)
+        change[1:] += diff
+        change[:-1] += diff
+        change[1:-1] /= 2
+
+    def normalize(values):
+        spread = values.max() - values.min()
+        return (values - values.min()) / spread if spread > 0 else np.zeros_like(values)
+
+    return 0.5 * normalize(sharpness) + 0.3 * normalize(exposure) + 0.2 * normalize(change)
+
+def sample_times(video_path, duration, samples=THUMBNAIL_SAMPLES):
+    """
+    Times to look at for the picture: key frames (a seek to them decodes a
+    single frame) spread over the video, skipping the first and last 5%
+    (fade in and out). Evenly spaced times if the key frames are unknown.
+    """
+    times = keyframe_times(video_path)
+    if duration:
+        inner = [t for t in times if 0.05 * duration <= t <= 0.95 * duration]
+        times = inner or times
+        if not times:
+            times = [duration * (i + 0.5) / samples for i in range(samples)]
+    if len(times) > samples:
+        times = [times[round(i * (len(times) - 1) / max(samples - 1, 1))] for i in range(samples)]
+    return times
+
+@metrics.timed(metrics.THUMBNAIL_SECONDS)
+def select_thumbnail(video_path, duration=None, samples=THUMBNAIL_SAMPLES):
+    """
+    Save the best of a few sampled frames as the picture of the video.
+
+    Only key frames are decoded (a small copy of each is scored with
+    score_frames()), then the winner is decoded again in full size.
+
+    Parameters:
+    video_path (str): Path to the input video file
+    duration (float): Length of the video from probe_video()
+
+    Returns:
+        bool: True if the picture was saved
+    """
+    times = sample_times(video_path, duration, samples)
+    if not times:
+        return extract_frame_at(video_path, duration=duration)
+
+    video = cv2.VideoCapture(video_path)
+    small = []
+    small_times = []
+    for t in times:
+        video.set(cv2.CAP_PROP_POS_MSEC, t * 1000)
+        success, frame = video.read()
+        if not success:
+            continue
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        height = max(1, round(gray.shape[0] * SCORE_WIDTH / gray.shape[1]))
+        small.append(cv2.resize(gray, (SCORE_WIDTH, height), interpolation=cv2.INTER_AREA))
+        small_times.append(t)
+
+    if not small:
         video.release()
-        return size
+        return extract_frame_at(video_path, duration=duration)
 
-def deleteVideoAndPicture(video_path, picture_path):
+    scores = score_frames(np.stack(small))
+    best = small_times[int(np.argmax(scores))]
+    video.set(cv2.CAP_PROP_POS_MSEC, best * 1000)
+    success, frame = video.read()
+    video.release()
+    if not success:
+        return extract_frame_at(video_path, best, duration)
+
+    output_filename = os.path.splitext(video_path)[0] + ".jpg"
+    cv2.imwrite(output_filename, frame)
+    print(f"Picked frame at {best:.2f} seconds out of {len(small)} samples")
+    return True
+
+# Widths of the thumbnails made from the picture of a video
+THUMBNAIL_WIDTHS = (320, 640, 1280)
+THUMBNAIL_FORMATS = {
+    'webp': [cv2.IMWRITE_WEBP_QUALITY, 80],
+    'jpg': [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 1],
+}
+
+def thumbnail_path(picture_path, width, extension):
+    """Path of the thumbnail of a picture with the given width and format"""
+    return f"{os.path.splitext(picture_path)[0]}_{width}.{extension}"
+
+def thumbnail_paths(picture_path):
+    """Paths of all thumbnails a picture can have"""
+    return [thumbnail_path(picture_path, width, extension) for width in THUMBNAIL_WIDTHS for extension in THUMBNAIL_FORMATS]
+
+def make_thumbnails(picture_path):
     """
-    Delete the specified video and picture files from the filesystem.
+    Create WebP and JPEG thumbnails of a picture in THUMBNAIL_WIDTHS.
 
-    Args:
-        video_path (str): Path to the video file to be deleted.
-        picture_path (str): Path to the picture file to be deleted.
+    The picture is decoded once and each size is resized from the previous
+    (bigger) one. Widths bigger than the picture are skipped.
 
     Returns:
-        bool: True if both files were successfully deleted, False otherwise.
+        list: widths of the thumbnails that were made
     """
-    try:
-        if os.path.exists(video_path):
-            os.remove(video_path)
-            print(f"Successfully deleted video: {video_path}")
-        else:
-            print(f"Video file not found: {video_path}")
-
-        if os.path.exists(picture_path):
-            os.remove(picture_path)
-            print(f"Successfully deleted picture: {picture_path}")
-        else:
-            print(f"Picture file not found: {picture_path}")
-
-        return True
-    except Exception as e:
-        print(f"Error deleting video or picture file: {e}")
-        return False
+    picture = cv2.imread(picture_path)
+    if picture is None:
+        print(f"Error: Could not read picture for thumbnails. Path: '{picture_path}'.")
+        return []
+
+    made = []
+    for width in sorted(THUMBNAIL_WIDTHS, reverse=True):
+        if width > picture.shape[1]:
+            continue
+        height = max(1, round(picture.shape[0] * width / picture.shape[1]))
+        # INTER_AREA averages the pixels, no aliasing when shrinking
+        picture = cv2.resize(picture, (width, height), interpolation=cv2.INTER_AREA)
+        for extension, params in THUMBNAIL_FORMATS.items():
+            cv2.imwrite(thumbnail_path(picture_path, width, extension), picture, params)
+        made.append(width)
+    return sorted(made)
+
+def hls_dir(video_path):
+    """Folder with the HLS renditions of a video (next to the mp4)"""
+    return os.path.splitext(video_path)[0] + "_hls"